@@ -13,7 +13,7 @@ import os
 import tbsim.dynamics as dynamics
 import tbsim.models.base_models as base_models
 import numpy as np
-from tbsim.models.diffuser_helpers import MapEncoder,convert_state_to_state_and_action,unicyle_forward_dynamics
+from tbsim.models.diffuser_helpers import MapEncoder,convert_state_to_state_and_action,unicyle_forward_dynamics,TrajNormalizer,get_norm_info
 class UnifiedTrainer(pl.LightningModule):
     def __init__(self, algo_config,train_config, modality_shapes,
                  do_log=True, guidance_config=None, constraint_config=None,train_mode="vae", vae_model_path=None):
@@ -66,15 +66,16 @@ class UnifiedTrainer(pl.LightningModule):
                                                 normalization=True)
         
 
-        diffuser_norm_info = algo_config.nusc_norm_info.diffuser
+        diffuser_norm_info = get_norm_info(algo_config, "diffuser", algo_config.nusc_norm_info.diffuser)
         norm_add_coeffs = diffuser_norm_info[0]
         norm_div_coeffs = diffuser_norm_info[1]
         self.add_coeffs = np.array(norm_add_coeffs).astype('float32')
         self.div_coeffs = np.array(norm_div_coeffs).astype('float32') 
+        self.traj_norm = TrajNormalizer(self.add_coeffs, self.div_coeffs)
 
 
-        agent_hist_norm_info = algo_config.nusc_norm_info.agent_hist
-        neighbor_hist_norm_info = algo_config.nusc_norm_info.neighbor_hist
+        agent_hist_norm_info = get_norm_info(algo_config, "agent_hist", algo_config.nusc_norm_info.agent_hist)
+        neighbor_hist_norm_info = get_norm_info(algo_config, "neighbor_hist", algo_config.nusc_norm_info.neighbor_hist)
 
 
                 
@@ -357,14 +358,7 @@ class UnifiedTrainer(pl.LightningModule):
             squeeze_time_dim = True
 
 
-        add_coeffs = self.add_coeffs[chosen_inds][None,None] # 1 x 1 x D     #[1,1,4]
-        div_coeffs = self.div_coeffs[chosen_inds][None,None] # 1 x 1 x D     #[1,1,4]
-
-        # TODO make these a buffer so they're put on the device automatically
-        device = target_traj_orig.get_device()
-        dx_add = torch.tensor(add_coeffs, device=device)
-        dx_div = torch.tensor(div_coeffs, device=device)
-        target_traj = (target_traj_orig + dx_add) / dx_div
+        target_traj = self.traj_norm.scale(target_traj_orig, chosen_inds)
         if squeeze_time_dim:
             target_traj = target_traj.squeeze(1) 
         return target_traj 
@@ -375,14 +369,7 @@ class UnifiedTrainer(pl.LightningModule):
         '''
         if len(chosen_inds) == 0:
             chosen_inds = self.default_chosen_inds
-        add_coeffs = self.add_coeffs[chosen_inds][None,None] # 1 x 1 x D
-        div_coeffs = self.div_coeffs[chosen_inds][None,None] # 1 x 1 x D
-
-        device = target_traj_orig.get_device()
-        dx_add = torch.tensor(add_coeffs, device=device)
-        dx_div = torch.tensor(div_coeffs, device=device) 
-
-        target_traj = target_traj_orig * dx_div - dx_add
+        target_traj = self.traj_norm.descale(target_traj_orig, chosen_inds)
         
 
         return target_traj
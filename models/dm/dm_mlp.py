@@ -39,15 +39,24 @@ class MLPResNetwork(nn.Module):
             )
             for _ in range(num_res_blocks)
         ])
-    def forward(self,x,aux_info,time):
-
-        t_emb = self.time_mlp(time) # [B, time_dim=128]
-        context = aux_info['context']#[B,256]
-        cond = torch.cat([t_emb, context], dim=-1)#[B,128+256]
-
+    def forward(self,x,aux_info,time,t_emb=None):
+        '''
+        - x: [M*N, latent] with N samples per conditioning row
+        - aux_info['context']: [M, cond], shared by the N samples of a row instead of repeated
+        - time: [M*N] timesteps, equal across the samples of a row
+        - t_emb: optional precomputed time embedding, [time_dim] for all rows or [M, time_dim]
+        '''
+        context = aux_info['context']#[M,256]
+        M = context.shape[0]
+        N = x.shape[0] // M
+        if t_emb is None:
+            t_emb = self.time_mlp(time.reshape(M, N)[:, 0]) # [M, time_dim=128]
+        elif t_emb.dim() == 1:
+            t_emb = t_emb.expand(M, -1)
+        cond = torch.cat([t_emb, context], dim=-1).unsqueeze(1)#[M,1,128+256], broadcast over samples
+
+        x = x.reshape(M, N, -1)
         for block in self.blocks:
             x = block(x, cond)
 
-        
-        return x
-       
+        return x.reshape(M * N, -1)
@@ -9,6 +9,14 @@ import tbsim.utils.tensor_utils as TensorUtils
 from torch.distributions import Normal
 import torch
 import numpy as np
+import math
+
+def normal_log_prob(x, mean, log_sigma):
+    '''
+    Closed-form diagonal Gaussian log-density, elementwise equal to Normal(mean, log_sigma.exp()).log_prob(x)
+    '''
+    return -((x - mean) ** 2) / (2 * torch.exp(2 * log_sigma)) - log_sigma - 0.5 * math.log(2 * math.pi)
+
 class DmModel(nn.Module):
     def __init__(
         self,
@@ -21,7 +29,6 @@ class DmModel(nn.Module):
     ):
         super().__init__()
         self.n_timesteps = int(n_timesteps)
-        self.stride = 1
         betas = cosine_beta_schedule(n_timesteps)
         alphas = 1. - betas
         alphas_cumprod = torch.cumprod(alphas, axis=0)
@@ -61,6 +68,10 @@ class DmModel(nn.Module):
        
         return z_0_recon
 
+    def time_embeddings(self):
+        '''Time embedding of every timestep of the schedule, [n_timesteps, time_dim]'''
+        return self.model.time_mlp(torch.arange(self.n_timesteps, device=self.betas.device))
+
     def q_sample(self, x_start, t, noise):        
         sample = (
             extract(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
@@ -75,7 +86,29 @@ class DmModel(nn.Module):
                 extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
             )
   
-    def forward(self,batch,aux_info,algo_config):
+    def get_sample_timesteps(self, num_steps):
+        '''
+        Descending subsequence of the training schedule visited by the sampler,
+        evenly spaced and always ending at t=0.
+        '''
+        num_steps = int(min(max(num_steps, 1), self.n_timesteps))
+        steps = np.linspace(0, self.n_timesteps - 1, num_steps).round().astype(int)
+        return [int(i) for i in reversed(np.unique(steps))]
+
+    def forward(self,batch,aux_info,algo_config,return_traj=True,traj_buffer=None):
+        '''
+        Sample latents by reverse diffusion.
+        algo_config.sampler selects the update:
+            "ddpm": ancestral sampling; with num_sample_steps < n_timesteps it skips steps
+                    using the posterior of the strided schedule (DDIM with eta=1)
+            "ddim": DDIM update with stochasticity algo_config.ddim_eta (0 is deterministic)
+        Only the full-length "ddpm" trajectory matches the per-step posterior used by x_tminus1_mean,
+        so RL fine-tuning (GuideDMLightningModule) only accepts that sampler.
+
+        The per-step records (x_t, x_tminus1, mean_t, sigma_t, t) are only needed for RL fine-tuning:
+            return_traj=False keeps none of them and returns None in their place (rollout / inference)
+            traj_buffer (DenoiseTrajBuffer) streams them into preallocated storage keeping the last steps
+        '''
         batch_size = batch['history_positions'].size()[0]
         shape = (batch_size,algo_config.num_samp,algo_config.vae.latent_size)#[B,N=1,128]
         #NOTE:p_sample_loop:
@@ -83,43 +116,83 @@ class DmModel(nn.Module):
         device = self.betas.device
         x = torch.randn(shape, device=device)#[B,N,128]
         x = TensorUtils.join_dimensions(x, begin_axis=0, end_axis=2)#[B*N,128]
-        noise_all = torch.randn(
-            x.shape[0],  # B*N
-            self.n_timesteps,  # total steps
-            algo_config.vae.latent_size,  # D
-            device=device
-        )#[B,100,128]
 
-        aux_info = TensorUtils.repeat_by_expand_at(aux_info, repeats=algo_config.num_samp, dim=0)
+        # the conditioning stays [B, ...]: MLPResNetwork broadcasts it over the num_samp samples of each agent
+        # and the time embeddings of the whole schedule are computed once
+        t_embs = self.time_embeddings()#[n_timesteps,time_dim]
+
+        sampler = algo_config.get("sampler", "ddpm")
+        num_steps = algo_config.get("num_sample_steps", None) or self.n_timesteps
+        steps = self.get_sample_timesteps(num_steps)
+        if sampler == "ddpm":
+            eta = 1.0
+        elif sampler == "ddim":
+            eta = algo_config.get("ddim_eta", 0.0)
+        else:
+            raise ValueError(f"Unknown sampler: {sampler}")
+        full_ddpm = sampler == "ddpm" and len(steps) == self.n_timesteps
 
-        steps = [i for i in reversed(range(0, self.n_timesteps, self.stride))]
         log_probs = []
         traj_data = []
-        for i in steps:
+        if traj_buffer is not None:
+            traj_buffer.reset()
+        for i, prev_i in zip(steps, steps[1:] + [-1]):
             timesteps = torch.full((x.shape[0],), i, device=device, dtype=torch.long)#[99,99,99,99...B个]
-            noise_t = noise_all[:, i, :]#[B,128]
-            x_tminus1, mean_t, sigma_t  = self.x_minus1(x,timesteps,noise_t,aux_info)
-
-            step_info = {
-            "x_t": x,
-            "x_tminus1": x_tminus1,
-            "mean_t": mean_t,
-            "sigma_t": sigma_t,
-            "t":timesteps
-        }
-            traj_data.append(step_info)
+            noise_t = torch.randn_like(x)#[B,128], drawn lazily instead of a [B,T,128] buffer
+            if full_ddpm:
+                x_tminus1, mean_t, sigma_t  = self.x_minus1(x,timesteps,noise_t,aux_info,t_emb=t_embs[i])
+            else:
+                prev_timesteps = torch.full((x.shape[0],), prev_i, device=device, dtype=torch.long)
+                x_tminus1, mean_t, sigma_t = self.x_skip(x,timesteps,prev_timesteps,noise_t,aux_info,eta,t_emb=t_embs[i])
+
+            if return_traj or traj_buffer is not None:
+                step_info = {
+                "x_t": x,
+                "x_tminus1": x_tminus1,
+                "mean_t": mean_t,
+                "sigma_t": sigma_t,
+                "t":timesteps
+            }
+                if traj_buffer is not None:
+                    traj_buffer.push(step_info)
+                else:
+                    traj_data.append(step_info)
             # log_probs.append(log_prob_step)
 
             x = x_tminus1 
        
         # #TODO:添加对于静止车辆的过滤
         
-        
+        if traj_buffer is not None:
+            return x, traj_buffer.steps()
+        if not return_traj:
+            return x, None
         return x, traj_data
+
+    def x_skip(self,x,t,t_prev,noise,aux_info,eta,t_emb=None):
+        '''
+        Generalized DDIM step from t to t_prev < t (t_prev=-1 denotes the clean sample).
+        eta=1 recovers the ancestral posterior of the strided schedule, eta=0 is deterministic.
+        '''
+        noise_recon = self.model(x, aux_info, t, t_emb=t_emb)#[B,128]
+        x_0_recon = self.predict_start_from_noise(x, t=t, noise=noise_recon)#[B,128]
+
+        alpha_t = extract(self.alphas_cumprod, t, x.shape)
+        alpha_prev = torch.where(
+            t_prev >= 0,
+            self.alphas_cumprod.gather(-1, t_prev.clamp(min=0)),
+            torch.ones_like(t_prev, dtype=self.alphas_cumprod.dtype),
+        ).reshape(alpha_t.shape)
+
+        sigma = eta * torch.sqrt((1. - alpha_prev) / (1. - alpha_t) * (1. - alpha_t / alpha_prev))
+        dir_coef = torch.sqrt(torch.clamp(1. - alpha_prev - sigma ** 2, min=0.))
+        model_mean = torch.sqrt(alpha_prev) * x_0_recon + dir_coef * noise_recon
+        x_tminus1 = model_mean + sigma * noise
+        return x_tminus1,model_mean,sigma
        
-    def x_minus1(self,x,t,noise,aux_info):
+    def x_minus1(self,x,t,noise,aux_info,t_emb=None):
         b = x.shape[0]
-        model_mean, posterior_variance,model_log_variance = self.x_tminus1_mean(x=x, t=t,aux_info=aux_info)
+        model_mean, posterior_variance,model_log_variance = self.x_tminus1_mean(x=x, t=t,aux_info=aux_info,t_emb=t_emb)
         sigma = (0.5 * model_log_variance).exp()
         
         
@@ -132,8 +205,9 @@ class DmModel(nn.Module):
         # log_prob_step = dist.log_prob(x_tminus1).sum(dim=-1)
         return x_tminus1,model_mean,sigma
    
-    def x_tminus1_mean(self,x,t,aux_info):
-        noise_recon = self.model(x, aux_info, t)#[B,128]
+    def x_tminus1_mean(self,x,t,aux_info,t_emb=None):
+        '''aux_info holds one conditioning row per x row, or per group of x.shape[0] // B consecutive samples'''
+        noise_recon = self.model(x, aux_info, t, t_emb=t_emb)#[B,128]
         x_0_recon = self.predict_start_from_noise(x, t=t, noise=noise_recon)#[B,128]
         model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start=x_0_recon, x_t=x, t=t)
 
@@ -0,0 +1,53 @@
+import torch
+
+
+class DenoiseTrajBuffer(object):
+    '''
+    Fixed-capacity ring buffer for the per-step records produced by DmModel.forward.
+    Storage is allocated once on the first push and reused across sampling calls,
+    so only the last `capacity` denoising steps are kept alive.
+    '''
+    KEYS = ("x_t", "x_tminus1", "mean_t", "sigma_t", "t")
+
+    def __init__(self, capacity):
+        assert capacity > 0, "capacity must be positive"
+        self.capacity = int(capacity)
+        self._storage = None
+        self._ptr = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def reset(self):
+        self._ptr = 0
+        self._size = 0
+
+    def _allocate(self, step_info):
+        self._storage = {
+            k: torch.empty((self.capacity,) + tuple(step_info[k].shape),
+                           dtype=step_info[k].dtype,
+                           device=step_info[k].device)
+            for k in self.KEYS
+        }
+
+    def push(self, step_info):
+        if self._storage is None or any(
+            self._storage[k].shape[1:] != step_info[k].shape
+            or self._storage[k].device != step_info[k].device
+            for k in self.KEYS
+        ):
+            self._allocate(step_info)
+        for k in self.KEYS:
+            self._storage[k][self._ptr].copy_(step_info[k].detach())
+        self._ptr = (self._ptr + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def steps(self):
+        '''
+        Stored steps in sampling order, as the list of dicts DmModel.forward would return.
+        The tensors are views into the buffer and are overwritten by the next sampling call.
+        '''
+        start = (self._ptr - self._size) % self.capacity
+        order = [(start + i) % self.capacity for i in range(self._size)]
+        return [{k: self._storage[k][j] for k in self.KEYS} for j in order]
@@ -110,14 +110,17 @@ class LSTMVAE(nn.Module):
 
         return reconstruct_output,mean,logvar
 
-    def getZ(self,x, context):
+    def encode(self,x, context):
         batch_size, seq_len, feature_dim = x.shape
-        enc_hidden = self.lstm_enc(x,context) #([1,B,hidden],[1,B,hidden])
-        enc_h = enc_hidden[0].view(batch_size, self.hidden_size).to(self.device)#[B, hidden_layer]
+        enc_hidden = self.lstm_enc(x,context) #([layers,B,hidden],[layers,B,hidden])
+        enc_h = enc_hidden[0][-1].view(batch_size, self.hidden_size).to(self.device)#[B, hidden_layer]
         
         mean = self.mu(enc_h) #[B,latent:128]
         logvar = self.var(enc_h)
+        return mean,logvar
 
+    def getZ(self,x, context):
+        mean,logvar = self.encode(x,context)
         z = self.reparametize(mean,logvar)#[B,128]
 
         return z
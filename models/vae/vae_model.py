@@ -7,7 +7,7 @@ from tbsim.utils.batch_utils import batch_utils
 import tbsim.utils.tensor_utils as TensorUtils
 import tbsim.dynamics as dynamics
 import tbsim.models.base_models as base_models
-from tbsim.models.diffuser_helpers import MapEncoder,convert_state_to_state_and_action,unicyle_forward_dynamics
+from tbsim.models.diffuser_helpers import MapEncoder,convert_state_to_state_and_action,unicyle_forward_dynamics,TrajNormalizer,get_norm_info
 
 class VaeModel(nn.Module):
     def __init__(self, algo_config,train_config, modality_shapes):
@@ -52,11 +52,12 @@ class VaeModel(nn.Module):
                                                 normalization=True)
         
 
-        diffuser_norm_info = algo_config.nusc_norm_info.diffuser
+        diffuser_norm_info = get_norm_info(algo_config, "diffuser", algo_config.nusc_norm_info.diffuser)
         norm_add_coeffs = diffuser_norm_info[0]
         norm_div_coeffs = diffuser_norm_info[1]
         self.add_coeffs = np.array(norm_add_coeffs).astype('float32')
         self.div_coeffs = np.array(norm_div_coeffs).astype('float32') 
+        self.traj_norm = TrajNormalizer(self.add_coeffs, self.div_coeffs)
               
         self.horizon = algo_config.horizon
         self.dt = 0.1
@@ -64,6 +65,8 @@ class VaeModel(nn.Module):
         self._dynamics_type = algo_config.dynamics.type
         self._dynamics_kwargs=algo_config.dynamics
         self._create_dynamics()
+        # 'exact_parallel' matches 'chain' (bounds included) without the per-step python loop
+        self.forward_dynamics_mode = algo_config.dynamics.get("forward_mode", "exact_parallel")
    
         vae_config = algo_config.vae             
         self.lstmvae = LSTMVAE(input_size=observation_dim+action_dim,
@@ -150,11 +153,12 @@ class VaeModel(nn.Module):
         scaled_output = self.convert_action_to_state_and_action(scaled_actions,aux_info['curr_states'])
         return scaled_output
   
-    def convert_action_to_state_and_action(self, x_out, curr_states, scaled_input=True, descaled_output=False):
+    def convert_action_to_state_and_action(self, x_out, curr_states, scaled_input=True, descaled_output=False, mode=None):
         '''
         Apply dynamics on input action trajectory to get state+action trajectory
         Input:
             x_out: (batch_size, num_steps, 2). scaled action trajectory
+            mode: forward dynamics mode, defaults to self.forward_dynamics_mode
         Output:
             x_out: (batch_size, num_steps, 6). scaled state+action trajectory
         '''
@@ -170,7 +174,7 @@ class VaeModel(nn.Module):
             initial_states=curr_states,
             actions=x_out,
             step_time=self.dt,
-            mode='chain'
+            mode=self.forward_dynamics_mode if mode is None else mode
         )
 
         x_out_all = torch.cat([x_out_state, x_out], dim=-1)
@@ -215,14 +219,7 @@ class VaeModel(nn.Module):
             squeeze_time_dim = True
 
 
-        add_coeffs = self.add_coeffs[chosen_inds][None,None] # 1 x 1 x D     #[1,1,4]
-        div_coeffs = self.div_coeffs[chosen_inds][None,None] # 1 x 1 x D     #[1,1,4]
-
-        # TODO make these a buffer so they're put on the device automatically
-        device = target_traj_orig.get_device()
-        dx_add = torch.tensor(add_coeffs, device=device)
-        dx_div = torch.tensor(div_coeffs, device=device)
-        target_traj = (target_traj_orig + dx_add) / dx_div
+        target_traj = self.traj_norm.scale(target_traj_orig, chosen_inds)
         if squeeze_time_dim:
             target_traj = target_traj.squeeze(1) 
         return target_traj 
@@ -233,14 +230,7 @@ class VaeModel(nn.Module):
         '''
         if len(chosen_inds) == 0:
             chosen_inds = self.default_chosen_inds
-        add_coeffs = self.add_coeffs[chosen_inds][None,None] # 1 x 1 x D
-        div_coeffs = self.div_coeffs[chosen_inds][None,None] # 1 x 1 x D
-
-        device = target_traj_orig.get_device()
-        dx_add = torch.tensor(add_coeffs, device=device)
-        dx_div = torch.tensor(div_coeffs, device=device) 
-
-        target_traj = target_traj_orig * dx_div - dx_add
+        target_traj = self.traj_norm.descale(target_traj_orig, chosen_inds)
         
 
         return target_traj
@@ -18,6 +18,8 @@ from tbsim.utils.config_utils import translate_pass_trajdata_cfg
 from trainers.dm_trainer import DMLightningModule
 from tbsim.evaluation.env_builders import EnvUnifiedBuilder
 from tbsim.utils.scene_edit_utils import get_trajdata_renderer
+from tbsim.policies.wrappers import RolloutWrapper
+from tbsim.utils.timer import Timers
 def run_scene_editor(eval_cfg,policy_cfg, save_cfg, data_to_disk, render_to_video, render_to_img, render_cfg):
     set_global_batch_type("trajdata")
     set_global_trajdata_batch_env(eval_cfg.trajdata_source_test[0])
@@ -64,7 +66,9 @@ def run_scene_editor(eval_cfg,policy_cfg, save_cfg, data_to_disk, render_to_vide
     
 
 
-    result_stats = None
+    policy = RolloutWrapper(agents_policy=policy)
+    timers = Timers()
+    result_stats = dict()
     scene_i = 0
     eval_scenes = eval_cfg.eval_scenes
     while scene_i < eval_cfg.num_scenes_to_evaluate:
@@ -72,49 +76,112 @@ def run_scene_editor(eval_cfg,policy_cfg, save_cfg, data_to_disk, render_to_vide
         scene_i += eval_cfg.num_scenes_per_batch
         print('scene_indices', scene_indices)
 
-        scenes_valid = env.reset(scene_indices=scene_indices, start_frame_index=None)
-        scene_indices = [si for si, sval in zip(scene_indices, scenes_valid) if sval]
-        if len(scene_indices) == 0:
+        start_frame_index = [[policy_cfg.algo.history_num_frames+1] * eval_cfg.num_sim_per_scene] * len(scene_indices)
+        print('Starting frames in current scenes:', start_frame_index)
+        sim_scene_indices, sim_start_frames, sim_ids = pack_simulations(
+            scene_indices, start_frame_index, eval_cfg.num_sim_per_scene)
+
+        stats, _ = run_batched_rollout(
+            env,
+            policy,
+            sim_scene_indices,
+            sim_start_frames,
+            sim_ids,
+            device=device,
+            timers=timers,
+            obs_to_torch=obs_to_torch,
+            n_step_action=eval_cfg.n_step_action,
+            h5_path=eval_cfg.experience_hdf5_path if data_to_disk else None,
+        )
+        if stats is None:
             print('no valid scenes in this batch, skipping...')
             torch.cuda.empty_cache()
             continue
-        
-        start_frame_index = [[policy_cfg.algo.history_num_frames+1]] * len(scene_indices)
-        print('Starting frames in current scenes:', start_frame_index)
-        for ei in range(eval_cfg.num_sim_per_scene):
-            guidance_config = None
-            constraint_config = None
-            cur_start_frames = [scene_start[ei] for scene_start in start_frame_index]
-            scenes_valid = env.reset(scene_indices=scene_indices, start_frame_index=cur_start_frames)
-            sim_scene_indices = [si for si, sval in zip(scene_indices, scenes_valid) if sval]
-            sim_start_frames = [sframe for sframe, sval in zip(cur_start_frames, scenes_valid) if sval]
-            if len(sim_scene_indices) == 0:
-                torch.cuda.empty_cache()
-                continue
-
-        done  = env.is_done()
-        while not done:
-            obs = env.get_observation()
-            action = policy.get_action(obs)   # policy里包含dm+rl guidance
-            env.step(action)
-            done = env.is_done()
-
-
-
-
-
-
-
-
-
-
-
-        print("1111111111111111111111111111111111111111111111")
-
-  
-
-
 
+        for k, v in stats.items():
+            result_stats.setdefault(k, []).extend(TensorUtils.to_list(v))
+        json.dump(result_stats, open(os.path.join(eval_cfg.results_dir, "stats.json"), "w+"), indent=4)
+
+    print(timers)
+
+
+def pack_simulations(scene_indices, start_frame_index, num_sim_per_scene):
+    """
+    Flatten every (scene, simulation) variant into one batch of simulated instances.
+
+    Args:
+        scene_indices (list): dataset scene indices
+        start_frame_index (list): per scene, a list of @num_sim_per_scene starting frames
+        num_sim_per_scene (int): number of simulations per scene
+
+    Returns:
+        sim_scene_indices (list): dataset scene index of each instance (may repeat)
+        sim_start_frames (list): starting frame of each instance
+        sim_ids (list): unique instance ids, scene_index * num_sim_per_scene + sim index
+    """
+    sim_scene_indices = []
+    sim_start_frames = []
+    sim_ids = []
+    for si, scene_start in zip(scene_indices, start_frame_index):
+        for ei in range(num_sim_per_scene):
+            sim_scene_indices.append(si)
+            sim_start_frames.append(scene_start[ei])
+            sim_ids.append(si * num_sim_per_scene + ei)
+    return sim_scene_indices, sim_start_frames, sim_ids
+
+
+def run_batched_rollout(env, policy, scene_indices, start_frames, sim_ids, device, timers,
+                        obs_to_torch=True, n_step_action=1, h5_path=None, flush_every=None):
+    """
+    Run one closed-loop episode for a packed batch of simulated instances, querying the policy
+    once per step for the whole batch. Per-stage timing is accumulated in @timers.
+    If @h5_path is given, the rollout log is streamed to it every @flush_every steps
+    (only at the end of the episode if None).
+
+    Returns:
+        stats (dict): per-instance metrics plus "scene_index" and "sim_id", or None if no instance is valid
+        info (dict): env info of the episode
+    """
+    scenes_valid = env.reset(scene_indices=scene_indices, start_frame_index=start_frames, sim_ids=sim_ids)
+    if not all(scenes_valid):
+        # reset again so that scene indices stay aligned with the simulated scenes
+        scene_indices = [si for si, sval in zip(scene_indices, scenes_valid) if sval]
+        start_frames = [sframe for sframe, sval in zip(start_frames, scenes_valid) if sval]
+        sim_ids = [sid for sid, sval in zip(sim_ids, scenes_valid) if sval]
+        if len(scene_indices) == 0:
+            return None, None
+        env.reset(scene_indices=scene_indices, start_frame_index=start_frames, sim_ids=sim_ids)
+
+    counter = 0
+    done = env.is_done()
+    while not done:
+        timers.tic("step")
+        with timers.timed("obs"):
+            obs = env.get_observation()
+        with timers.timed("to_torch"):
+            if obs_to_torch:
+                obs_torch = TensorUtils.to_torch(obs, device=device, ignore_if_unspecified=True)
+            else:
+                obs_torch = obs
+        with timers.timed("network"):
+            action = policy.get_action(obs_torch, step_index=counter)
+        with timers.timed("env_step"):
+            env.step(action, num_steps_to_take=n_step_action, render=False)
+        timers.toc("step")
+        counter += n_step_action
+        done = env.is_done()
+        if h5_path is not None and flush_every is not None and counter % flush_every < n_step_action:
+            with timers.timed("flush"):
+                env.logger.flush_hdf5(h5_path)
+
+    if h5_path is not None:
+        with timers.timed("flush"):
+            env.logger.flush_hdf5(h5_path)
+    stats = env.get_metrics()
+    stats["scene_index"] = np.array(scene_indices)
+    stats["sim_id"] = np.array(sim_ids)
+    info = env.get_info()
+    return stats, info
 
 
 if __name__ == "__main__":
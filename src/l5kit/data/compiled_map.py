@@ -0,0 +1,180 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Optional, Union
+from uuid import uuid4
+
+import numpy as np
+
+
+COMPILED_MAP_VERSION = 1
+META_FILE = "meta.json"
+
+
+def get_compiled_map_path(protobuf_map_path: str, world_to_ecef: np.ndarray) -> str:
+    """Default location of the compiled version of a protobuf map: a folder next to it, one per world_to_ecef
+    (coordinates are compiled in the world reference system)
+
+    Args:
+        protobuf_map_path (str): path to the protobuf file
+        world_to_ecef (np.ndarray): transformation matrix from world coordinates to ECEF
+
+    Returns:
+        str: the compiled map folder
+    """
+    key = hashlib.md5(np.ascontiguousarray(world_to_ecef, dtype=np.float64).tobytes()).hexdigest()[:16]
+    return os.path.join(f"{protobuf_map_path}.compiled", key)
+
+
+def _source_info(protobuf_map_path: str) -> dict:
+    stat = os.stat(protobuf_map_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class CompiledMap:
+    """
+    Flat, memory-mapped arrays compiled from a protobuf map by MapAPI.compile:
+    - ids: the element ids (as bytes) in protobuf order, with `ids_order` sorting them for look-ups;
+    - element_* arrays: per element properties (lane / crosswalk index, traffic light flags);
+    - lanes_* / crosswalks_* arrays: coordinates in world ref system, variable length ones are concatenated
+    with an `_indptr` array of offsets (CSR layout).
+
+    Arrays are opened with mmap_mode="r", so opening a map costs a few file opens and processes
+    reading the same map share its pages. Pickling only stores the path.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != COMPILED_MAP_VERSION:
+            raise ValueError(f"compiled map {path} has version {self.meta['version']}, "
+                             f"expected {COMPILED_MAP_VERSION}")
+        self.arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+                       for name in self.meta["arrays"]}
+
+    def __getstate__(self) -> dict:
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["path"])  # type: ignore
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name]
+
+    def __len__(self) -> int:
+        return len(self.arrays["ids"])
+
+    def index(self, element_id: Union[str, bytes]) -> int:
+        """
+        Get the protobuf index of an element from its id in O(log(N))
+
+        Args:
+            element_id (Union[str, bytes]): the element id
+
+        Returns:
+            int: the index of the element
+        """
+        ids, ids_order = self.arrays["ids"], self.arrays["ids_order"]
+        key = element_id.encode(self.meta["encoding"]) if isinstance(element_id, str) else element_id
+        # the last of equal ids is kept (as in MapAPI.ids_to_el), ids_order is a stable sort
+        pos = int(np.searchsorted(ids, key, side="right", sorter=ids_order)) - 1
+        if pos < 0 or ids[ids_order[pos]] != key:
+            raise KeyError(element_id)
+        return int(ids_order[pos])
+
+    def get_slice(self, name: str, idx: int) -> np.ndarray:
+        """
+        Get the idx-th element of a CSR array
+
+        Args:
+            name (str): name of the concatenated array (its offsets are in `name_indptr`)
+            idx (int): index of the element
+
+        Returns:
+            np.ndarray: a read-only view of the element
+        """
+        indptr = self.arrays[f"{name}_indptr"]
+        return self.arrays[name][indptr[idx]: indptr[idx + 1]]
+
+    def is_valid_for(self, protobuf_map_path: str) -> bool:
+        """Check that the map was compiled from this version of the protobuf file"""
+        return bool(self.meta["source"] == _source_info(protobuf_map_path))
+
+    @staticmethod
+    def open(path: str, protobuf_map_path: Optional[str] = None) -> Optional["CompiledMap"]:
+        """
+        Open a compiled map if it exists and (if the protobuf path is given) if it's up to date with it
+
+        Args:
+            path (str): the compiled map folder
+            protobuf_map_path (Optional[str]): the protobuf file it should be compiled from
+
+        Returns:
+            Optional[CompiledMap]: the compiled map, None if missing or stale
+        """
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            return None
+        compiled_map = CompiledMap(path)
+        if protobuf_map_path is not None and not compiled_map.is_valid_for(protobuf_map_path):
+            return None
+        return compiled_map
+
+    @staticmethod
+    def write(path: str, protobuf_map_path: str, arrays: Dict[str, np.ndarray], meta: dict) -> "CompiledMap":
+        """
+        Write the arrays of a compiled map. The folder is written aside and moved in place at the end,
+        so readers never see a partial map.
+
+        Args:
+            path (str): the compiled map folder
+            protobuf_map_path (str): the protobuf file the arrays are compiled from
+            arrays (Dict[str, np.ndarray]): the arrays to store
+            meta (dict): additional information stored in the meta file
+
+        Returns:
+            CompiledMap: the compiled map
+        """
+        tmp_path = f"{path}.{uuid4()}.tmp"
+        os.makedirs(tmp_path)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(array))
+
+        meta = dict(meta, version=COMPILED_MAP_VERSION, source=_source_info(protobuf_map_path),
+                    arrays=sorted(arrays))
+        with open(os.path.join(tmp_path, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        return CompiledMap(path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compile a protobuf semantic map into memory-mappable arrays")
+    parser.add_argument("--map", type=str, required=True, help="path to the protobuf semantic map")
+    parser.add_argument("--meta", type=str, required=True, help="path to the dataset meta.json (for world_to_ecef)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="output folder (defaults to the one MapAPI looks for next to the map)")
+    parser.add_argument("--interpolation_points", type=int, nargs="+", default=None,
+                        help="number of points of the precomputed lanes interpolations (INTER_ENSURE_LEN)")
+    args = parser.parse_args()
+
+    from l5kit.configs.config import load_metadata
+    from l5kit.data.map_api import COMPILED_INTERPOLATION_POINTS, MapAPI
+
+    world_to_ecef = np.array(load_metadata(args.meta)["world_to_ecef"], dtype=np.float64)
+    output = args.output if args.output is not None else get_compiled_map_path(args.map, world_to_ecef)
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    interpolation_points = args.interpolation_points or COMPILED_INTERPOLATION_POINTS
+
+    compiled_map = MapAPI(args.map, world_to_ecef).compile(output, interpolation_points)
+    print(f"compiled {len(compiled_map)} elements into {compiled_map.path}")
+
+
+if __name__ == "__main__":
+    main()
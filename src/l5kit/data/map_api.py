@@ -1,6 +1,7 @@
+import os
 from enum import IntEnum
 from functools import lru_cache
-from typing import Iterator, no_type_check, Sequence, Union
+from typing import Dict, Iterator, no_type_check, Optional, Sequence, Union
 
 import numpy as np
 import pymap3d as pm
@@ -9,11 +10,14 @@ from l5kit.configs.config import load_metadata
 from l5kit.data import DataManager
 
 from ..geometry import transform_points
+from .compiled_map import CompiledMap, get_compiled_map_path
 from .proto.road_network_pb2 import GeoFrame, GlobalId, MapElement, MapFragment
 
 
 CACHE_SIZE = int(1e5)
 ENCODING = "utf-8"
+# number of points of the lanes interpolations stored by default in a compiled map (see MapAPI.compile)
+COMPILED_INTERPOLATION_POINTS = (20,)
 
 
 class InterpolationMethod(IntEnum):
@@ -28,29 +32,69 @@ class TLFacesColors(IntEnum):
 
 
 class MapAPI:
-    def __init__(self, protobuf_map_path: str, world_to_ecef: np.ndarray):
+    def __init__(self, protobuf_map_path: str, world_to_ecef: np.ndarray, compiled_map_path: Optional[str] = None):
         """
         Interface to the raw protobuf map file with the following features:
         - access to element using ID is O(1);
         - access to coordinates in world ref system for a set of elements is O(1) after first access (lru cache)
         - object support iteration using __getitem__ protocol
 
+        If a compiled version of the map (see `compile`) is available, coordinates, bounds and traffic control
+        information are read from its memory-mapped arrays instead. The protobuf is then only parsed when
+        raw elements are accessed (`elements`, `__getitem__`), so opening the map is almost free and processes
+        reading the same compiled map share its memory.
+
         Args:
             protobuf_map_path (str): path to the protobuf file
             world_to_ecef (np.ndarray): transformation matrix from world coordinates to ECEF (dataset dependent)
+            compiled_map_path (Optional[str]): path to a compiled version of the map. If None, the default one
+            next to the protobuf file is used when it exists and is up to date
         """
         self.protobuf_map_path = protobuf_map_path
         self.ecef_to_world = np.linalg.inv(world_to_ecef)
+        self.world_to_ecef = np.asarray(world_to_ecef, dtype=np.float64)
 
-        with open(protobuf_map_path, "rb") as infile:
-            mf = MapFragment()
-            mf.ParseFromString(infile.read())
+        self._elements: Optional[Sequence[MapElement]] = None
+        self._ids_to_el: Optional[Dict[str, int]] = None
 
-        self.elements = mf.elements
-        self.ids_to_el = {self.id_as_str(el.id): idx for idx, el in enumerate(self.elements)}  # store a look-up table
+        if compiled_map_path is None:
+            self.compiled_map = CompiledMap.open(get_compiled_map_path(protobuf_map_path, world_to_ecef),
+                                                 protobuf_map_path)
+        else:
+            self.compiled_map = CompiledMap.open(compiled_map_path, protobuf_map_path)
+            if self.compiled_map is None:
+                raise ValueError(f"{compiled_map_path} is not an up to date compiled map of {protobuf_map_path}")
 
         self.bounds_info = self.get_bounds()  # store bound for semantic elements for fast look-up
 
+    def _parse_protobuf(self) -> None:
+        with open(self.protobuf_map_path, "rb") as infile:
+            mf = MapFragment()
+            mf.ParseFromString(infile.read())
+
+        self._elements = mf.elements
+        self._ids_to_el = {self.id_as_str(el.id): idx for idx, el in enumerate(self._elements)}  # look-up table
+
+    @property
+    def elements(self) -> Sequence[MapElement]:
+        """The protobuf elements, parsed on first access"""
+        if self._elements is None:
+            self._parse_protobuf()
+        return self._elements  # type: ignore
+
+    @property
+    def ids_to_el(self) -> Dict[str, int]:
+        """Look-up table from element id to element index, built on first access"""
+        if self._ids_to_el is None:
+            self._parse_protobuf()
+        return self._ids_to_el  # type: ignore
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        if self.compiled_map is not None:  # the protobuf is parsed again if needed
+            state["_elements"] = state["_ids_to_el"] = None
+        return state
+
     @staticmethod
     def from_cfg(data_manager: DataManager, cfg: dict) -> "MapAPI":
         """Build a MapAPI object starting from a config file and a data manager
@@ -147,9 +191,19 @@ class MapAPI:
         Returns:
             dict: a dict with the two boundaries coordinates as (Nx3) XYZ arrays
         """
+        if self.compiled_map is not None:
+            lane_idx = self._compiled_lane_index(element_id)
+            return {
+                "xyz_left": np.array(self.compiled_map.get_slice("lanes_left_xyz", lane_idx)),
+                "xyz_right": np.array(self.compiled_map.get_slice("lanes_right_xyz", lane_idx)),
+            }
+
         element = self[element_id]
         assert self.is_lane(element)
+        return self._unpack_lane_coords(element)
 
+    @no_type_check
+    def _unpack_lane_coords(self, element: MapElement) -> dict:
         lane = element.element.lane
         left_boundary = lane.left_boundary
         right_boundary = lane.right_boundary
@@ -169,6 +223,11 @@ class MapAPI:
 
         return {"xyz_left": xyz_left, "xyz_right": xyz_right}
 
+    def _compiled_lane_index(self, element_id: str) -> int:
+        lane_idx = int(self.compiled_map["element_lane_index"][self.compiled_map.index(element_id)])  # type: ignore
+        assert lane_idx >= 0, f"{element_id} is not a lane"
+        return lane_idx
+
     @staticmethod
     def interpolate(xyz: np.ndarray, step: float, method: InterpolationMethod) -> np.ndarray:
         """
@@ -205,6 +264,10 @@ class MapAPI:
 
     @lru_cache(maxsize=CACHE_SIZE)
     def get_lane_traffic_control_ids(self, element_id: str) -> set:
+        if self.compiled_map is not None:
+            lane_idx = self._compiled_lane_index(element_id)
+            return set(tc_id.decode(ENCODING) for tc_id in self.compiled_map.get_slice("lanes_tc_ids", lane_idx))
+
         lane = self[element_id].element.lane
         return set([MapAPI.id_as_str(la_tc) for la_tc in lane.traffic_controls])
 
@@ -212,7 +275,8 @@ class MapAPI:
     def get_lane_as_interpolation(self, element_id: str, step: float, method: InterpolationMethod) -> dict:
         """
         Perform an interpolation of the left and right lanes and compute the midlane.
-        See interpolate for details about the different interpolation methods
+        See interpolate for details about the different interpolation methods.
+        If the map is compiled with this number of points, INTER_ENSURE_LEN interpolations are read from it.
 
         Args:
             element_id (str): lane id
@@ -222,12 +286,26 @@ class MapAPI:
         Returns:
             dict: same as `get_lane_coords` but overwrite xyz values for the lanes
         """
+        if (
+                self.compiled_map is not None
+                and method == InterpolationMethod.INTER_ENSURE_LEN
+                and int(step) in self.compiled_map.meta["interpolation_points"]
+        ):
+            lane_xyz = self.compiled_map[f"lanes_interp_{int(step)}"][self._compiled_lane_index(element_id)]
+            return {"xyz_left": np.array(lane_xyz[0]), "xyz_right": np.array(lane_xyz[1]),
+                    "xyz_midlane": np.array(lane_xyz[2])}
+
         lane_dict = self.get_lane_coords(element_id)
-        xyz_left = lane_dict["xyz_left"]
-        xyz_right = lane_dict["xyz_right"]
+        lane_dict.update(self._interpolate_lane(lane_dict["xyz_left"], lane_dict["xyz_right"], step, method))
+        return lane_dict
 
-        lane_dict["xyz_left"] = self.interpolate(xyz_left, step, method)
-        lane_dict["xyz_right"] = self.interpolate(xyz_right, step, method)
+    @staticmethod
+    def _interpolate_lane(xyz_left: np.ndarray, xyz_right: np.ndarray, step: float,
+                          method: InterpolationMethod) -> dict:
+        lane_dict = {
+            "xyz_left": MapAPI.interpolate(xyz_left, step, method),
+            "xyz_right": MapAPI.interpolate(xyz_right, step, method),
+        }
 
         # to compute midlane we average between left and right bounds
         # but to do that we need them to have the same numbers of points
@@ -235,8 +313,8 @@ class MapAPI:
         if method != InterpolationMethod.INTER_ENSURE_LEN:
             mid_steps = max(len(xyz_left), len(xyz_right))
             # recompute lanes using fixed length
-            xyz_left = self.interpolate(xyz_left, mid_steps, InterpolationMethod.INTER_ENSURE_LEN)
-            xyz_right = self.interpolate(xyz_right, mid_steps, InterpolationMethod.INTER_ENSURE_LEN)
+            xyz_left = MapAPI.interpolate(xyz_left, mid_steps, InterpolationMethod.INTER_ENSURE_LEN)
+            xyz_right = MapAPI.interpolate(xyz_right, mid_steps, InterpolationMethod.INTER_ENSURE_LEN)
 
         else:
             xyz_left = lane_dict["xyz_left"]
@@ -245,7 +323,7 @@ class MapAPI:
         xyz_midlane = (xyz_left + xyz_right) / 2
 
         # interpolate xyz for midlane with the selected interpolation
-        lane_dict["xyz_midlane"] = self.interpolate(xyz_midlane, step, method)
+        lane_dict["xyz_midlane"] = MapAPI.interpolate(xyz_midlane, step, method)
         return lane_dict
 
     @staticmethod
@@ -277,8 +355,17 @@ class MapAPI:
         Returns:
             dict: a dict with the polygon coordinates as an (Nx3) XYZ array
         """
+        if self.compiled_map is not None:
+            crosswalk_idx = int(self.compiled_map["element_crosswalk_index"][self.compiled_map.index(element_id)])
+            assert crosswalk_idx >= 0, f"{element_id} is not a crosswalk"
+            return {"xyz": np.array(self.compiled_map.get_slice("crosswalks_xyz", crosswalk_idx))}
+
         element = self[element_id]
         assert self.is_crosswalk(element)
+        return self._unpack_crosswalk_coords(element)
+
+    @no_type_check
+    def _unpack_crosswalk_coords(self, element: MapElement) -> dict:
         traffic_element = element.element.traffic_control_element
 
         xyz = self.unpack_deltas_cm(
@@ -299,7 +386,14 @@ class MapAPI:
         Returns:
             True if the element is a traffic light
         """
-        element = self[element_id]
+        if self.compiled_map is not None:
+            return bool(self.compiled_map["element_is_traffic_light"][self.compiled_map.index(element_id)])
+
+        return self._is_traffic_light_element(self[element_id])
+
+    @staticmethod
+    @no_type_check
+    def _is_traffic_light_element(element: MapElement) -> bool:
         if not element.element.HasField("traffic_control_element"):
             return False
         traffic_el = element.element.traffic_control_element
@@ -332,7 +426,15 @@ class MapAPI:
         Returns:
             True if the element is a traffic light face with the given color
         """
-        element = self[element_id]
+        if self.compiled_map is not None:
+            face_colors = int(self.compiled_map["element_tl_face_colors"][self.compiled_map.index(element_id)])
+            return bool(face_colors & (1 << TLFacesColors[color.upper()]))
+
+        return self._is_traffic_face_color_element(self[element_id], color)
+
+    @staticmethod
+    @no_type_check
+    def _is_traffic_face_color_element(element: MapElement, color: str) -> bool:
         if not element.element.HasField("traffic_control_element"):
             return False
         traffic_el = element.element.traffic_control_element
@@ -393,6 +495,17 @@ class MapAPI:
         Returns:
             dict: keys are classes of elements, values are dict with `bounds` and `ids` keys
         """
+        if self.compiled_map is not None:
+            ids = self.compiled_map["ids"]
+            lanes_ids = ids[self.compiled_map["lanes_element"]]
+            crosswalks_ids = ids[self.compiled_map["crosswalks_element"]]
+            return {
+                "lanes": {"bounds": np.array(self.compiled_map["lanes_bounds"]),
+                          "ids": [el_id.decode(ENCODING) for el_id in lanes_ids]},
+                "crosswalks": {"bounds": np.array(self.compiled_map["crosswalks_bounds"]),
+                               "ids": [el_id.decode(ENCODING) for el_id in crosswalks_ids]},
+            }
+
         lanes_ids = []
         crosswalks_ids = []
 
@@ -427,6 +540,92 @@ class MapAPI:
             "crosswalks": {"bounds": crosswalks_bounds, "ids": crosswalks_ids},
         }
 
+    def compile(self, output_path: Optional[str] = None,
+                interpolation_points: Sequence[int] = COMPILED_INTERPOLATION_POINTS) -> CompiledMap:
+        """
+        Compile the protobuf map into flat memory-mappable arrays: lanes boundaries and traffic controls,
+        crosswalks polygons, traffic lights and faces information, bounds and an index from element ids.
+        Lanes midlanes are also stored for INTER_ENSURE_LEN interpolations with `interpolation_points` points.
+        MapAPI objects created after this call use the compiled map (if it's written to the default path).
+
+        Args:
+            output_path (Optional[str]): where to write the compiled map, defaults to a folder next to the protobuf
+            interpolation_points (Sequence[int]): number of points of the precomputed lanes interpolations
+
+        Returns:
+            CompiledMap: the compiled map
+        """
+        if output_path is None:
+            output_path = get_compiled_map_path(self.protobuf_map_path, self.world_to_ecef)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        for num_points in interpolation_points:
+            assert num_points > 1, "interpolation_points must be at least 2"
+
+        num_elements = len(self.elements)
+        element_lane_index = np.full(num_elements, -1, dtype=np.int64)
+        element_crosswalk_index = np.full(num_elements, -1, dtype=np.int64)
+        element_is_traffic_light = np.zeros(num_elements, dtype=bool)
+        element_tl_face_colors = np.zeros(num_elements, dtype=np.uint8)
+
+        lanes_element, lanes_left, lanes_right, lanes_tc_ids = [], [], [], []
+        lanes_interp: Dict[int, list] = {num_points: [] for num_points in interpolation_points}
+        crosswalks_element, crosswalks_xyz = [], []
+
+        for idx, element in enumerate(self.elements):
+            if self.is_lane(element):
+                element_lane_index[idx] = len(lanes_element)
+                lanes_element.append(idx)
+                lane = self._unpack_lane_coords(element)
+                lanes_left.append(lane["xyz_left"])
+                lanes_right.append(lane["xyz_right"])
+                lanes_tc_ids.append([la_tc.id for la_tc in element.element.lane.traffic_controls])
+                for num_points, lane_interps in lanes_interp.items():
+                    lane_interp = self._interpolate_lane(lane["xyz_left"], lane["xyz_right"], num_points,
+                                                         InterpolationMethod.INTER_ENSURE_LEN)
+                    lane_interps.append([lane_interp["xyz_left"], lane_interp["xyz_right"],
+                                         lane_interp["xyz_midlane"]])
+
+            if self.is_crosswalk(element):
+                element_crosswalk_index[idx] = len(crosswalks_element)
+                crosswalks_element.append(idx)
+                crosswalks_xyz.append(self._unpack_crosswalk_coords(element)["xyz"])
+
+            element_is_traffic_light[idx] = self._is_traffic_light_element(element)
+            for color in TLFacesColors:
+                if self._is_traffic_face_color_element(element, color.name.lower()):
+                    element_tl_face_colors[idx] |= 1 << color
+
+        ids = np.array([element.id.id for element in self.elements], dtype=bytes)
+        arrays = {
+            "ids": ids,
+            "ids_order": np.argsort(ids, kind="stable"),
+            "element_lane_index": element_lane_index,
+            "element_crosswalk_index": element_crosswalk_index,
+            "element_is_traffic_light": element_is_traffic_light,
+            "element_tl_face_colors": element_tl_face_colors,
+            "lanes_element": np.array(lanes_element, dtype=np.int64),
+            "lanes_bounds": np.array([_xy_bounds(np.concatenate(xyz)) for xyz in zip(lanes_left, lanes_right)],
+                                     dtype=np.float64).reshape((-1, 2, 2)),
+            "crosswalks_element": np.array(crosswalks_element, dtype=np.int64),
+            "crosswalks_bounds": np.array([_xy_bounds(xyz) for xyz in crosswalks_xyz],
+                                          dtype=np.float64).reshape((-1, 2, 2)),
+        }
+        arrays.update(_concatenate("lanes_left_xyz", lanes_left, np.empty((0, 3), dtype=np.float64)))
+        arrays.update(_concatenate("lanes_right_xyz", lanes_right, np.empty((0, 3), dtype=np.float64)))
+        arrays.update(_concatenate("lanes_tc_ids", [np.array(tc_ids, dtype=bytes) for tc_ids in lanes_tc_ids],
+                                   np.empty(0, dtype="S1")))
+        arrays.update(_concatenate("crosswalks_xyz", crosswalks_xyz, np.empty((0, 3), dtype=np.float64)))
+        for num_points, lane_interps in lanes_interp.items():
+            arrays[f"lanes_interp_{num_points}"] = np.array(lane_interps, dtype=np.float64).reshape(
+                (-1, 3, num_points, 3))
+
+        meta = {
+            "encoding": ENCODING,
+            "world_to_ecef": self.world_to_ecef.tolist(),
+            "interpolation_points": [int(num_points) for num_points in interpolation_points],
+        }
+        return CompiledMap.write(output_path, self.protobuf_map_path, arrays, meta)
+
     @no_type_check
     def __getitem__(self, item: Union[int, str, bytes]) -> MapElement:
         if isinstance(item, str):
@@ -439,8 +638,22 @@ class MapAPI:
             raise TypeError("only str, bytes and int are allowed in API __getitem__")
 
     def __len__(self) -> int:
+        if self.compiled_map is not None:
+            return len(self.compiled_map)
         return len(self.elements)
 
     def __iter__(self) -> Iterator:
         for i in range(len(self)):
             yield self[i]
+
+
+def _xy_bounds(xyz: np.ndarray) -> np.ndarray:
+    """[[min_x, min_y], [max_x, max_y]] of a set of points"""
+    return np.stack([np.min(xyz, axis=0)[:2], np.max(xyz, axis=0)[:2]])
+
+
+def _concatenate(name: str, arrays: Sequence[np.ndarray], empty: np.ndarray) -> Dict[str, np.ndarray]:
+    """Concatenate variable length arrays and their offsets (`name_indptr`) in the CompiledMap layout"""
+    indptr = np.zeros(len(arrays) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(array) for array in arrays])
+    return {name: np.concatenate(arrays) if len(arrays) else empty, f"{name}_indptr": indptr}
@@ -4,7 +4,7 @@ import os
 import pprint
 import sys
 import warnings
-from collections import Counter, defaultdict
+from collections import Counter
 from functools import partial
 from multiprocessing import cpu_count, Pool
 from pathlib import Path
@@ -36,6 +36,7 @@ else:
 TH_YAW_DEGREE = 30
 TH_EXTENT_RATIO = 1.1
 TH_DISTANCE_AV = 50
+SCENE_CHUNKS_PER_WORKER = 4
 
 
 def in_consecutive_frame(frame_idx: int, past_frame_idx: int) -> bool:
@@ -73,6 +74,81 @@ def update_mask(mask: np.ndarray, agent_list: list) -> None:
         mask[mask_idx][1] = len(agent_list) - idx_el - 1  # future information
 
 
+def _get_valid_agents_mask(
+        frames: np.ndarray,
+        agents: np.ndarray,
+        frames_group: np.ndarray,
+        th_agent_filter_probability_threshold: float,
+        th_yaw_degree: float,
+        th_extent_ratio: float,
+        th_distance_av: float,
+) -> Tuple[np.ndarray, Counter]:
+    """
+    Columnar implementation of the filters of get_valid_agents.
+    Agents are sorted by (group, track_id, index) so that the states of a track are contiguous, the filters are
+    evaluated on all the agents at once and the past/future counters of each run of valid states come from a
+    segmented cumulative count.
+
+    Args:
+        frames (np.ndarray): frames, with agent_index_interval relative to agents
+        agents (np.ndarray): agents of the frames
+        frames_group (np.ndarray): group of each frame (e.g. the scene), tracks are not linked across groups
+
+    Returns:
+        Tuple[np.ndarray, Counter]: the (past, future) mask of the agents and the report
+    """
+    agents_mask = np.zeros((len(agents), 2), dtype=np.uint32)
+    report: Counter = Counter()
+
+    agents_per_frame = frames["agent_index_interval"][:, 1] - frames["agent_index_interval"][:, 0]
+    agents_frame = np.repeat(np.arange(len(frames)), agents_per_frame)
+    agents_group = frames_group[agents_frame]
+
+    # ==== POINT-WISE FILTERS
+    of_interest = _get_label_filter(agents["label_probabilities"], th_agent_filter_probability_threshold)
+    av_distance = np.linalg.norm(frames["ego_translation"][agents_frame, :2] - agents["centroid"], axis=-1)
+    close_to_av = av_distance < th_distance_av
+    report["reject_th_agent_filter_probability_threshold"] += int(np.sum(~of_interest))
+    report["reject_th_AV_distance"] += int(np.sum(of_interest & ~close_to_av))
+    point_valid = of_interest & close_to_av
+
+    # ==== COUPLE-WISE FILTERS (between consecutive states of a track that both passed the point-wise ones)
+    order = np.lexsort((np.arange(len(agents)), agents["track_id"], agents_group))
+    track, group = agents["track_id"][order], agents_group[order]
+    frame, valid = agents_frame[order], point_valid[order]
+    yaw = agents["yaw"][order]
+    area = agents["extent"][order, 0] * agents["extent"][order, 1]
+
+    couple = (track[1:] == track[:-1]) & (group[1:] == group[:-1]) & valid[1:] & valid[:-1]
+    hole = couple & (frame[1:] != frame[:-1] + 1)
+    yaw_degrees = np.abs(angular_distance(yaw[1:], yaw[:-1])) * 180 / np.pi
+    yaw_change = couple & ~hole & ~(yaw_degrees < th_yaw_degree)
+    area_min, area_max = np.minimum(area[1:], area[:-1]), np.maximum(area[1:], area[:-1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        extent_ok = (area_min >= 0.01) & (area_max / area_min < th_extent_ratio)
+    extent_change = couple & ~hole & ~yaw_change & ~extent_ok
+    report["reject_th_hole"] += int(np.sum(hole))
+    report["reject_th_yaw"] += int(np.sum(yaw_change))
+    report["reject_th_extent"] += int(np.sum(extent_change))
+
+    # a run of valid states starts where a state is not chained to the previous one
+    chained = np.concatenate([[False], couple & ~(hole | yaw_change | extent_change)])
+    run_start = (~chained)[valid]
+    run_starts = np.flatnonzero(run_start)
+    run_lengths = np.diff(np.append(run_starts, len(run_start)))
+    run_idx = np.cumsum(run_start) - 1
+    past = np.arange(len(run_start)) - run_starts[run_idx]
+    future = run_lengths[run_idx] - past - 1
+
+    # agents rejected by the point-wise filters have neither past nor future
+    agents_mask[order[valid], 0] = past
+    agents_mask[order[valid], 1] = future
+
+    report["total_reject"] = sum([v for v in report.values()])
+    report["total_agent_frames"] = len(agents_mask)
+    return agents_mask, report
+
+
 def get_valid_agents(
         frames_range: np.ndarray,
         dataset: ChunkedDataset,
@@ -95,66 +171,42 @@ def get_valid_agents(
     agents = dataset.agents[agents_range_start:agents_range_end]
     frames["agent_index_interval"] -= agents_range_start  # sync frame and agents again
 
-    agents_dict = defaultdict(list)
-
     # for every agent in the .zarr -> (available_past_frame, available_future_frames) using this agent_threshold
     # this means a single mask can be used to generate all configurations of future and past frames
-    agents_mask = np.zeros((len(agents), 2), dtype=np.uint32)
+    agents_mask, report = _get_valid_agents_mask(
+        frames, agents, np.zeros(len(frames), dtype=np.int64), th_agent_filter_probability_threshold,
+        th_yaw_degree, th_extent_ratio, th_distance_av,
+    )
+    return agents_mask, report, (agents_range_start, agents_range_end)
 
-    report: Counter = Counter()
 
-    # filter here for point-wise to speed up
-    of_interest = _get_label_filter(agents["label_probabilities"], th_agent_filter_probability_threshold)
-    global_agent_idx = -1
-    for frame_idx in range(len(frames)):
-        frame = frames[frame_idx]
-        agents_frame = agents[slice(*(frame["agent_index_interval"]))]
-
-        for agent in agents_frame:
-            global_agent_idx += 1
-            # store info we need for couple and sequence filters
-            agents_dict[agent["track_id"]].append((frame_idx, global_agent_idx, agent))
-
-            # ==== POINT-WISE FILTERS
-            if not of_interest[global_agent_idx]:
-                update_mask(agents_mask, agents_dict[agent["track_id"]][:-1])
-                report["reject_th_agent_filter_probability_threshold"] += 1
-                agents_dict[agent["track_id"]] = []
-                continue
-
-            if not in_av_distance(frame["ego_translation"], agent["centroid"], th_distance_av):
-                update_mask(agents_mask, agents_dict[agent["track_id"]][:-1])
-                report["reject_th_AV_distance"] += 1
-                agents_dict[agent["track_id"]] = []
-                continue
-
-            # ==== COUPLE-WISE FILTERS
-            if len(agents_dict[agent["track_id"]]) > 1:
-                p_frame_idx, p_global_agent_idx, p_agent = agents_dict[agent["track_id"]][-2]  # get prev element
-
-                if not in_consecutive_frame(frame_idx, p_frame_idx):
-                    update_mask(agents_mask, agents_dict[agent["track_id"]][:-1])
-                    report["reject_th_hole"] += 1
-                    agents_dict[agent["track_id"]] = agents_dict[agent["track_id"]][-1:]
-                    continue
-                if not in_angular_distance(p_agent["yaw"], agent["yaw"], th_yaw_degree):
-                    update_mask(agents_mask, agents_dict[agent["track_id"]][:-1])
-                    report["reject_th_yaw"] += 1
-                    agents_dict[agent["track_id"]] = agents_dict[agent["track_id"]][-1:]
-                    continue
-                if not in_extent_ratio(p_agent["extent"], agent["extent"], th_extent_ratio):
-                    update_mask(agents_mask, agents_dict[agent["track_id"]][:-1])
-                    report["reject_th_extent"] += 1
-                    agents_dict[agent["track_id"]] = agents_dict[agent["track_id"]][-1:]
-                    continue
-
-    # update what is left inside the dict
-    for track_id, agent_list in agents_dict.items():
-        update_mask(agents_mask, agent_list)
-        agents_dict[track_id] = []
+def get_valid_agents_scenes(
+        scenes_range: np.ndarray,
+        dataset: ChunkedDataset,
+        th_agent_filter_probability_threshold: float,
+        th_yaw_degree: float,
+        th_extent_ratio: float,
+        th_distance_av: float,
+) -> Tuple[np.ndarray, Counter, tuple]:
+    """
+    Same as get_valid_agents for a range of consecutive scenes read in one go.
+    Tracks are not linked across scenes, so the result is the one of calling get_valid_agents on each scene.
+    """
+    scenes = dataset.scenes[slice(*scenes_range)]
+    frames_range = (scenes[0]["frame_index_interval"][0], scenes[-1]["frame_index_interval"][1])
+    frames = dataset.frames[slice(*frames_range)]
+    agents_range_start = frames[0]["agent_index_interval"][0]
+    agents_range_end = frames[-1]["agent_index_interval"][1]
 
-    report["total_reject"] = sum([v for v in report.values()])
-    report["total_agent_frames"] = len(agents_mask)
+    agents = dataset.agents[agents_range_start:agents_range_end]
+    frames["agent_index_interval"] -= agents_range_start  # sync frame and agents again
+
+    frames_per_scene = scenes["frame_index_interval"][:, 1] - scenes["frame_index_interval"][:, 0]
+    frames_scene = np.repeat(np.arange(len(scenes)), frames_per_scene)
+    agents_mask, report = _get_valid_agents_mask(
+        frames, agents, frames_scene, th_agent_filter_probability_threshold,
+        th_yaw_degree, th_extent_ratio, th_distance_av,
+    )
     return agents_mask, report, (agents_range_start, agents_range_end)
 
 
@@ -173,11 +225,15 @@ def select_agents(
     if agents_mask_path.exists():
         raise FileExistsError(f"{th_agent_prob} exists already! only one is supported!")
 
-    frame_index_intervals = zarr_dataset.scenes["frame_index_interval"]
+    # consecutive scenes are processed together, a few chunks per worker to balance the load
+    num_scenes = len(zarr_dataset.scenes)
+    num_chunks = min(num_scenes, cpu_count() * SCENE_CHUNKS_PER_WORKER)
+    chunk_bounds = np.linspace(0, num_scenes, num_chunks + 1).astype(np.int64)
+    scenes_ranges = np.stack([chunk_bounds[:-1], chunk_bounds[1:]], axis=-1)
 
     # build a partial with all args except the first one (will be passed by threads)
     get_valid_agents_partial = partial(
-        get_valid_agents,
+        get_valid_agents_scenes,
         dataset=zarr_dataset,
         th_agent_filter_probability_threshold=th_agent_prob,
         th_yaw_degree=th_yaw_degree,
@@ -203,11 +259,11 @@ def select_agents(
     report: Counter = Counter()
     print("starting pool...")
     with Pool(cpu_count()) as pool:
-        tasks = tqdm(enumerate(pool.imap_unordered(get_valid_agents_partial, frame_index_intervals)))
+        tasks = tqdm(enumerate(pool.imap_unordered(get_valid_agents_partial, scenes_ranges)))
         for idx, (mask, count, agents_range) in tasks:
             report += count
             agents_mask[agents_range[0]: agents_range[1]] = mask
-            tasks.set_description(f"{idx + 1}/{len(frame_index_intervals)}")
+            tasks.set_description(f"{idx + 1}/{len(scenes_ranges)}")
         print("collecting results..")
 
     agents_cfg = {
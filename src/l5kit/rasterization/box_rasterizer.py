@@ -5,7 +5,7 @@ import numpy as np
 
 from l5kit.data.zarr_dataset import AGENT_DTYPE
 
-from ..data.filter import filter_agents_by_labels, filter_agents_by_track_id
+from ..data.filter import filter_agents_by_labels
 from ..geometry import rotation33_as_yaw, transform_points
 from .rasterizer import EGO_EXTENT_HEIGHT, EGO_EXTENT_LENGTH, EGO_EXTENT_WIDTH, Rasterizer
 from .render_context import RenderContext
@@ -78,6 +78,39 @@ def draw_boxes(
     return im
 
 
+def draw_boxes_channels(
+        raster_size: Tuple[int, int],
+        raster_from_world: np.ndarray,
+        agents: np.ndarray,
+        channels: np.ndarray,
+        num_channels: int,
+        color: int = 255,
+) -> np.ndarray:
+    """Draw the boxes of agents in their own channel of a stack of GRAY images.
+    Box corners of all the agents are computed and projected on the image space in one sweep,
+    then cv2 draws the boxes of each channel with a single call (as in draw_boxes).
+
+    :param raster_size: Desired output raster image size
+    :param raster_from_world: Transformation matrix to transform from world to image coordinate
+    :param agents: An array of agents to be drawn
+    :param channels: The channel of each agent, an int array of the same length of agents
+    :param num_channels: Number of channels of the output
+    :param color: Single int color
+    :return: the images as an array of shape (num_channels, raster_size[1], raster_size[0])
+    """
+    im = np.zeros((num_channels, raster_size[1], raster_size[0]), dtype=np.uint8)
+    if len(agents) == 0:
+        return im
+
+    box_world_coords = get_box_world_coords(agents)
+    box_raster_coords = transform_points(box_world_coords.reshape((-1, 2)), raster_from_world)
+    box_raster_coords = cv2_subpixel(box_raster_coords.reshape((-1, 4, 2)))
+    for channel in np.unique(channels):
+        # each channel is a contiguous view, so cv2 draws in place
+        cv2.fillPoly(im[channel], box_raster_coords[channels == channel], color=color, **CV2_SUB_VALUES)
+    return im
+
+
 class BoxRasterizer(Rasterizer):
     def __init__(
         self,
@@ -85,6 +118,7 @@ class BoxRasterizer(Rasterizer):
         filter_agents_threshold: float,
         history_num_frames: int,
         render_ego_history: bool = True,
+        output_uint8: bool = False,
     ) -> None:
         """This is a rasterizer class used for rendering agents' bounding boxes on the raster image.
 
@@ -92,6 +126,7 @@ class BoxRasterizer(Rasterizer):
         :param filter_agents_threshold: Value between 0 and 1 used to filter uncertain agent detections
         :param history_num_frames: Number of past frames to be renderd on the raster
         :param render_ego_history: Option to render past ego states on the raster image
+        :param output_uint8: Return the raster as uint8 in [0, 255] instead of float32 in [0, 1]
         """
         super(BoxRasterizer, self).__init__()
         self.render_context = render_context
@@ -99,6 +134,7 @@ class BoxRasterizer(Rasterizer):
         self.filter_agents_threshold = filter_agents_threshold
         self.history_num_frames = history_num_frames
         self.render_ego_history = render_ego_history
+        self.output_uint8 = output_uint8
 
     def rasterize(
             self,
@@ -128,32 +164,43 @@ class BoxRasterizer(Rasterizer):
 
         raster_from_world = self.render_context.raster_from_world(ego_translation_m, ego_yaw_rad)
 
-        # this ensures we always end up with fixed size arrays, +1 is because current time is also in the history
-        out_shape = (self.raster_size[1], self.raster_size[0], self.history_num_frames + 1)
-        agents_images = np.zeros(out_shape, dtype=np.uint8)
-        ego_images = np.zeros(out_shape, dtype=np.uint8)
-
-        for i, (frame, agents) in enumerate(zip(history_frames, history_agents)):
-            agents = filter_agents_by_labels(agents, self.filter_agents_threshold)
-            # note the cast is for legacy support of dataset before April 2020
-            av_agent = get_ego_as_agent(frame).astype(agents.dtype)
-
-            if agent is None:
-                ego_agent = av_agent
-            else:
-                ego_agent = filter_agents_by_track_id(agents, agent["track_id"])
-                agents = np.append(agents, av_agent)  # add av_agent to agents
-                if len(ego_agent) > 0:  # check if ego_agent is in the frame
-                    agents = agents[agents != ego_agent[0]]  # remove ego_agent from agents
+        # gather the boxes of all frames with the channel they are drawn in:
+        # [agent_t, agent_t-1, agent_t-2, ego_t, ego_t-1, ego_t-2]
+        # +1 is because current time is also in the history
+        num_frames = min(len(history_frames), len(history_agents))
+        ego_offset = self.history_num_frames + 1
+        if num_frames > ego_offset:
+            raise ValueError(f"got {num_frames} history frames, at most history_num_frames + 1 = {ego_offset} "
+                             f"can be rasterized")
+        frames_agents = [filter_agents_by_labels(agents, self.filter_agents_threshold)
+                         for agents in history_agents[:num_frames]]
+        agents = np.concatenate(frames_agents) if num_frames else np.zeros(0, dtype=AGENT_DTYPE)
+        agents_frame = np.repeat(np.arange(num_frames), [len(agents) for agents in frames_agents])
+        # note the cast is for legacy support of dataset before April 2020
+        av_agents = np.concatenate([get_ego_as_agent(frame) for frame in history_frames[:num_frames]]
+                                   or [np.zeros(0, dtype=AGENT_DTYPE)]).astype(agents.dtype)
+        av_frame = np.arange(num_frames)
 
-            agents_images[..., i] = draw_boxes(self.raster_size, raster_from_world, agents, 255)
-            if len(ego_agent) > 0 and (self.render_ego_history or i == 0):
-                ego_images[..., i] = draw_boxes(self.raster_size, raster_from_world, ego_agent, 255)
-
-        # combine such that the image consists of [agent_t, agent_t-1, agent_t-2, ego_t, ego_t-1, ego_t-2]
-        out_im = np.concatenate((agents_images, ego_images), -1)
-
-        return out_im.astype(np.float32) / 255
+        if agent is None:
+            boxes = np.concatenate([agents, av_agents])
+            channels = np.concatenate([agents_frame, av_frame + ego_offset])
+        else:
+            # the selected agent is drawn as ego and the AV as any other agent
+            is_ego = agents["track_id"] == agent["track_id"]
+            boxes = np.concatenate([agents[~is_ego], av_agents, agents[is_ego]])
+            channels = np.concatenate([agents_frame[~is_ego], av_frame, agents_frame[is_ego] + ego_offset])
+
+        if not self.render_ego_history:  # only the current ego
+            keep = channels <= ego_offset
+            boxes, channels = boxes[keep], channels[keep]
+
+        out_im = draw_boxes_channels(self.raster_size, raster_from_world, boxes, channels, 2 * ego_offset)
+        out_im = out_im.transpose(1, 2, 0)
+        if self.output_uint8:
+            return np.ascontiguousarray(out_im)
+        out_im = out_im.astype(np.float32, order="C")
+        out_im /= 255
+        return out_im
 
     def to_rgb(self, in_im: np.ndarray, **kwargs: dict) -> np.ndarray:
         """This function is used to get an rgb image where agents further in the past have faded colors.
@@ -94,7 +94,8 @@ def build_rasterizer(cfg: dict, data_manager: DataManager) -> Rasterizer:
 
     elif map_type == "box_debug":
         return BoxRasterizer(render_context, filter_agents_threshold, history_num_frames,
-                             render_ego_history=render_ego_history)
+                             render_ego_history=render_ego_history,
+                             output_uint8=raster_cfg.get("output_uint8", False))
     elif map_type == "stub_debug":
         return StubRasterizer(render_context)
     else:
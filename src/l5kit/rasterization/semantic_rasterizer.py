@@ -1,6 +1,5 @@
-from collections import defaultdict
 from enum import IntEnum
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
 import cv2
 import numpy as np
@@ -72,6 +71,95 @@ def cv2_subpixel(coords: np.ndarray) -> np.ndarray:
     return coords
 
 
+class TessellatedMap:
+    """
+    Semantic map geometry interpolated once in the world reference system:
+    - lane polygons as a flat (2 * num_lanes, INTERPOLATION_POINTS, 2) array (left boundary, reversed right one);
+    - crosswalk polygons as concatenated points with offsets;
+    - the traffic control ids of each lane as integer codes (CSR layout), to resolve their colours in bulk.
+    Elements are in the order of the MapAPI bounds_info, so the bounds there index into these arrays.
+    """
+
+    # lane type codes: no active traffic light, then the colours of the faces
+    LANE_TYPES = [RasterEls.LANE_NOTL.name] + [color.name for color in TLFacesColors]
+
+    def __init__(self, map_api: MapAPI, interpolation_points: int = INTERPOLATION_POINTS):
+        self.map_api = map_api
+        self.interpolation_points = interpolation_points
+
+        lanes_ids = map_api.bounds_info["lanes"]["ids"]
+        self.lanes_bounds = map_api.bounds_info["lanes"]["bounds"]
+        self.lanes_area = np.zeros((len(lanes_ids) * 2, interpolation_points, 2))
+
+        self.tl_ids: List[str] = []
+        self.tl_id_to_code: Dict[str, int] = {}
+        lanes_tl_codes: List[int] = []
+        self.lanes_tl_indptr = np.zeros(len(lanes_ids) + 1, dtype=np.int64)
+
+        for idx, lane_id in enumerate(lanes_ids):
+            lane_coords = map_api.get_lane_as_interpolation(
+                lane_id, interpolation_points, InterpolationMethod.INTER_ENSURE_LEN
+            )
+            self.lanes_area[idx * 2] = lane_coords["xyz_left"][:, :2]
+            self.lanes_area[idx * 2 + 1] = lane_coords["xyz_right"][::-1, :2]
+
+            for tl_id in sorted(map_api.get_lane_traffic_control_ids(lane_id)):
+                if tl_id not in self.tl_id_to_code:
+                    self.tl_id_to_code[tl_id] = len(self.tl_ids)
+                    self.tl_ids.append(tl_id)
+                lanes_tl_codes.append(self.tl_id_to_code[tl_id])
+            self.lanes_tl_indptr[idx + 1] = len(lanes_tl_codes)
+
+        self.lanes_tl_codes = np.asarray(lanes_tl_codes, dtype=np.int64)
+        # colour of each traffic control id as an index into LANE_TYPES, resolved on first use (-1 is unresolved)
+        self.tl_colors = np.full(len(self.tl_ids), -1, dtype=np.int64)
+
+        crosswalks_xy = [np.zeros((0, 2))]
+        self.crosswalks_bounds = map_api.bounds_info["crosswalks"]["bounds"]
+        self.crosswalks_indptr = np.zeros(len(map_api.bounds_info["crosswalks"]["ids"]) + 1, dtype=np.int64)
+        for idx, crosswalk_id in enumerate(map_api.bounds_info["crosswalks"]["ids"]):
+            crosswalks_xy.append(map_api.get_crosswalk_coords(crosswalk_id)["xyz"][:, :2])
+            self.crosswalks_indptr[idx + 1] = self.crosswalks_indptr[idx] + len(crosswalks_xy[-1])
+        self.crosswalks_xy = np.concatenate(crosswalks_xy)
+
+    def get_lanes_area(self, lane_indices: np.ndarray) -> np.ndarray:
+        """Polygons (left and right boundaries) of the given lanes as an array (2 * len(lane_indices), P, 2)"""
+        return self.lanes_area[(lane_indices[:, None] * 2 + np.arange(2)).reshape(-1)]
+
+    def get_crosswalks_xy(self, crosswalk_indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Concatenated points of the given crosswalks and the offsets where each of them starts"""
+        starts = self.crosswalks_indptr[crosswalk_indices]
+        counts = self.crosswalks_indptr[crosswalk_indices + 1] - starts
+        points_idx = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return self.crosswalks_xy[points_idx], np.cumsum(counts)[:-1]
+
+    def get_lane_types(self, lane_indices: np.ndarray, active_tl_ids: Set[str]) -> np.ndarray:
+        """
+        Lane type code (index into LANE_TYPES) of each given lane: the colour of one of its active traffic
+        light faces, LANE_NOTL if it has none.
+        """
+        lane_types = np.zeros(len(lane_indices), dtype=np.int64)
+        active_codes = [self.tl_id_to_code[tl_id] for tl_id in active_tl_ids if tl_id in self.tl_id_to_code]
+        if len(active_codes) == 0 or len(lane_indices) == 0:
+            return lane_types
+        active = np.zeros(len(self.tl_ids), dtype=bool)
+        active[active_codes] = True
+
+        starts = self.lanes_tl_indptr[lane_indices]
+        counts = self.lanes_tl_indptr[lane_indices + 1] - starts
+        entries = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        entries_lane = np.repeat(np.arange(len(lane_indices)), counts)
+        entries_code = self.lanes_tl_codes[entries]
+
+        is_active = active[entries_code]
+        entries_lane, entries_code = entries_lane[is_active], entries_code[is_active]
+        for code in np.unique(entries_code[self.tl_colors[entries_code] < 0]):
+            color = self.map_api.get_color_for_face(self.tl_ids[code])
+            self.tl_colors[code] = self.LANE_TYPES.index(color)
+        lane_types[entries_lane] = self.tl_colors[entries_code]
+        return lane_types
+
+
 class SemanticRasterizer(Rasterizer):
     """
     Rasteriser for the vectorised semantic map (generally loaded from json files).
@@ -88,6 +176,7 @@ class SemanticRasterizer(Rasterizer):
         self.world_to_ecef = world_to_ecef
 
         self.mapAPI = MapAPI(semantic_map_path, world_to_ecef)
+        self.tessellated_map = TessellatedMap(self.mapAPI)
 
     def rasterize(
             self,
@@ -125,7 +214,7 @@ class SemanticRasterizer(Rasterizer):
             np.ndarray: RGB raster
 
         """
-
+        tess = self.tessellated_map
         img = 255 * np.ones(shape=(self.raster_size[1], self.raster_size[0], 3), dtype=np.uint8)
 
         # filter using half a radius from the center
@@ -134,47 +223,31 @@ class SemanticRasterizer(Rasterizer):
         # get active traffic light faces
         active_tl_ids = set(filter_tl_faces_by_status(tl_faces, "ACTIVE")["face_id"].tolist())
 
-        # get all lanes as interpolation so that we can transform them all together
-
-        lane_indices = indices_in_bounds(center_in_world, self.mapAPI.bounds_info["lanes"]["bounds"], raster_radius)
-        lanes_mask: Dict[str, np.ndarray] = defaultdict(lambda: np.zeros(len(lane_indices) * 2, dtype=np.bool))
-        lanes_area = np.zeros((len(lane_indices) * 2, INTERPOLATION_POINTS, 2))
-
-        for idx, lane_idx in enumerate(lane_indices):
-            lane_idx = self.mapAPI.bounds_info["lanes"]["ids"][lane_idx]
+        lane_indices = indices_in_bounds(center_in_world, tess.lanes_bounds, raster_radius)
+        crosswalk_indices = indices_in_bounds(center_in_world, tess.crosswalks_bounds, raster_radius)
+        lanes_area = tess.get_lanes_area(lane_indices)
+        crosswalks_xy, crosswalks_splits = tess.get_crosswalks_xy(crosswalk_indices)
 
-            # interpolate over polyline to always have the same number of points
-            lane_coords = self.mapAPI.get_lane_as_interpolation(
-                lane_idx, INTERPOLATION_POINTS, InterpolationMethod.INTER_ENSURE_LEN
-            )
-            lanes_area[idx * 2] = lane_coords["xyz_left"][:, :2]
-            lanes_area[idx * 2 + 1] = lane_coords["xyz_right"][::-1, :2]
-
-            lane_type = RasterEls.LANE_NOTL.name
-            lane_tl_ids = set(self.mapAPI.get_lane_traffic_control_ids(lane_idx))
-            for tl_id in lane_tl_ids.intersection(active_tl_ids):
-                lane_type = self.mapAPI.get_color_for_face(tl_id)
-
-            lanes_mask[lane_type][idx * 2: idx * 2 + 2] = True
+        # transform all the map points together
+        points = np.concatenate([lanes_area.reshape((-1, 2)), crosswalks_xy])
+        points = cv2_subpixel(transform_points(points, raster_from_world))
+        num_lanes_points = lanes_area.shape[0] * lanes_area.shape[1]
+        lanes_area, crosswalks = points[:num_lanes_points], points[num_lanes_points:]
 
-        if len(lanes_area):
-            lanes_area = cv2_subpixel(transform_points(lanes_area.reshape((-1, 2)), raster_from_world))
-
-            for lane_area in lanes_area.reshape((-1, INTERPOLATION_POINTS * 2, 2)):
+        if len(lane_indices):
+            for lane_area in lanes_area.reshape((-1, tess.interpolation_points * 2, 2)):
                 # need to for-loop otherwise some of them are empty
                 cv2.fillPoly(img, [lane_area], COLORS[RasterEls.ROAD.name], **CV2_SUB_VALUES)
 
-            lanes_area = lanes_area.reshape((-1, INTERPOLATION_POINTS, 2))
-            for name, mask in lanes_mask.items():  # draw each type of lane with its own color
-                cv2.polylines(img, lanes_area[mask], False, COLORS[name], **CV2_SUB_VALUES)
+            lanes_area = lanes_area.reshape((-1, tess.interpolation_points, 2))
+            lanes_type = np.repeat(tess.get_lane_types(lane_indices, active_tl_ids), 2)
+            types, first_seen = np.unique(lanes_type, return_index=True)
+            for lane_type in types[np.argsort(first_seen)]:  # draw each type of lane with its own color
+                cv2.polylines(img, lanes_area[lanes_type == lane_type], False,
+                              COLORS[tess.LANE_TYPES[lane_type]], **CV2_SUB_VALUES)
 
         # plot crosswalks
-        crosswalks = []
-        for idx in indices_in_bounds(center_in_world, self.mapAPI.bounds_info["crosswalks"]["bounds"], raster_radius):
-            crosswalk = self.mapAPI.get_crosswalk_coords(self.mapAPI.bounds_info["crosswalks"]["ids"][idx])
-            xy_cross = cv2_subpixel(transform_points(crosswalk["xyz"][:, :2], raster_from_world))
-            crosswalks.append(xy_cross)
-
+        crosswalks = np.split(crosswalks, crosswalks_splits) if len(crosswalk_indices) else []
         cv2.polylines(img, crosswalks, True, COLORS[RasterEls.CROSSWALK.name], **CV2_SUB_VALUES)
 
         return img
@@ -1,4 +1,4 @@
-from copy import deepcopy
+from copy import copy, deepcopy
 from dataclasses import dataclass
 from typing import Dict, List, Optional, Set, Tuple
 
@@ -110,6 +110,30 @@ class SimulationDataset:
             scene_dataset_batch[scene_idx] = scene_dataset
         return SimulationDataset(scene_dataset_batch, sim_cfg)
 
+    def split(self, num_shards: int) -> List["SimulationDataset"]:
+        """Split the scenes into (at most) num_shards SimulationDatasets over contiguous groups of scenes.
+        The shards share the scene datasets with this object, so they can be simulated independently.
+
+        :param num_shards: the number of shards
+        :return: the list of non-empty shards
+        """
+        if num_shards < 1:
+            raise ValueError(f"can't split into {num_shards} shards")
+
+        shards = []
+        for shard_indices in np.array_split(list(self.scene_dataset_batch), num_shards):
+            if not len(shard_indices):
+                continue
+            shard_indices = [int(scene_idx) for scene_idx in shard_indices]
+            shard = copy(self)
+            shard.scene_dataset_batch = {idx: self.scene_dataset_batch[idx] for idx in shard_indices}
+            shard.recorded_scene_dataset_batch = {
+                idx: self.recorded_scene_dataset_batch[idx] for idx in shard_indices
+            }
+            shard._agents_tracked = set([k for k in self._agents_tracked if k[0] in shard.scene_dataset_batch])
+            shards.append(shard)
+        return shards
+
     def get_min_len(self) -> int:
         """Return the minimum number of frames between the scenes
 
@@ -0,0 +1,255 @@
+import multiprocessing
+import traceback
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from l5kit.data import ChunkedDataset
+from l5kit.simulation.dataset import SimulationDataset
+
+
+#: rasterise the agents of a frame
+RASTERISE_AGENTS = "agents"
+#: rasterise ego of a frame
+RASTERISE_EGO = "ego"
+
+# arrays bigger than this (e.g. images) are moved through shared memory instead of being pickled
+MIN_SHARED_BYTES = 1 << 16
+_ALIGNMENT = 64
+
+
+class SimulationUpdates:
+    def __init__(self) -> None:
+        """Records the set_ego / set_agents calls made on a SimulationDataset, so that they can be
+        replayed on the copy of the dataset owned by a worker process.
+        It can be passed to ClosedLoopSimulator.update_ego and ClosedLoopSimulator.update_agents.
+        """
+        self.calls: List[Tuple[str, tuple]] = []
+
+    def set_ego(self, state_index: int, output_index: int, ego_translations: np.ndarray,
+                ego_yaws: np.ndarray) -> None:
+        self.calls.append(("set_ego", (state_index, output_index, ego_translations, ego_yaws)))
+
+    def set_agents(self, state_index: int, agents_infos: Dict[Tuple[int, int], np.ndarray]) -> None:
+        self.calls.append(("set_agents", (state_index, agents_infos)))
+
+    def apply(self, dataset: SimulationDataset) -> None:
+        """Replay the recorded calls on the dataset, in order
+
+        :param dataset: the simulation dataset to mutate
+        """
+        for name, args in self.calls:
+            getattr(dataset, name)(*args)
+        self.calls = []
+
+
+class _SharedArrayWriter:
+    def __init__(self, min_shared_bytes: int) -> None:
+        """Worker side of the shared memory output buffer.
+        The segment is reused across frames and replaced by a bigger one when it's too small.
+        The main process copies the arrays out (when collating) before sending the next request,
+        so a segment is never written while it's being read.
+
+        :param min_shared_bytes: arrays with at least this size are written in the segment
+        """
+        self.min_shared_bytes = min_shared_bytes
+        self.shm: Optional[SharedMemory] = None
+
+    def write(self, elements: List[Dict[str, Any]]) -> Tuple[Optional[str], List[Dict[str, Any]], list]:
+        """Move the big arrays of the elements into the segment
+
+        :param elements: the rasterised elements
+        :return: the segment name (None if unused), the elements without the big arrays and
+        for each element a dict mapping keys to (offset, shape, dtype) in the segment
+        """
+        layout: List[Dict[str, tuple]] = []
+        size = 0
+        for element in elements:
+            element_layout = {}
+            for key, value in element.items():
+                if isinstance(value, np.ndarray) and value.nbytes >= self.min_shared_bytes:
+                    element_layout[key] = (size, value.shape, value.dtype.str)
+                    size += -(-value.nbytes // _ALIGNMENT) * _ALIGNMENT
+            layout.append(element_layout)
+        if size == 0:
+            return None, elements, layout
+
+        if self.shm is None or self.shm.size < size:
+            size = max(size, 0 if self.shm is None else 2 * self.shm.size)
+            self.close()
+            self.shm = SharedMemory(create=True, size=size)
+
+        small_elements = []
+        for element, element_layout in zip(elements, layout):
+            for key, (offset, shape, dtype) in element_layout.items():
+                np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)[...] = element[key]
+            small_elements.append({k: v for k, v in element.items() if k not in element_layout})
+        return self.shm.name, small_elements, layout
+
+    def close(self) -> None:
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def _worker_loop(sim_dataset: SimulationDataset, conn: Connection, min_shared_bytes: int,
+                 unused_conns: List[Connection]) -> None:
+    """Serve the requests of a SimulationWorkerPool for a shard of scenes.
+    Each request first applies the updates computed from the model outputs, then rasterises a frame.
+
+    :param sim_dataset: the shard of scenes owned by this worker
+    :param conn: the connection to the main process
+    :param min_shared_bytes: arrays with at least this size are returned through shared memory
+    :param unused_conns: the other pipe ends inherited from the main process, closed here so that
+    the main process and the workers get EOF when the other side goes away
+    """
+    for unused_conn in unused_conns:
+        unused_conn.close()
+
+    writer = _SharedArrayWriter(min_shared_bytes)
+    try:
+        while True:
+            try:
+                command, updates, state_index, target = conn.recv()
+            except EOFError:  # the pool was terminated
+                return
+            try:
+                updates.apply(sim_dataset)
+                if command == "close":
+                    conn.send(("ok", {idx: dt.dataset for idx, dt in sim_dataset.scene_dataset_batch.items()}))
+                    return
+
+                if target == RASTERISE_AGENTS:
+                    elements = list(sim_dataset.rasterise_agents_frame_batch(state_index).values())
+                else:
+                    elements = sim_dataset.rasterise_frame_batch(state_index)
+                conn.send(("ok", writer.write(elements)))
+            except Exception:
+                conn.send(("error", traceback.format_exc()))
+                return
+    finally:
+        writer.close()
+
+
+class SimulationWorkerPool:
+    def __init__(self, sim_dataset: SimulationDataset, num_workers: int,
+                 min_shared_bytes: int = MIN_SHARED_BYTES) -> None:
+        """A pool of processes, each owning a shard of the scenes of a SimulationDataset.
+        Workers rasterise their scenes and apply the model updates to them, so that the main process
+        only runs the models. Requests are asynchronous: while the main process runs the model on one shard,
+        the other shards are being rasterised.
+
+        .. note:: the scenes of the main process dataset are not updated until close is called
+
+        :param sim_dataset: the simulation dataset to shard
+        :param num_workers: the number of worker processes (and shards)
+        :param min_shared_bytes: arrays with at least this size are returned through shared memory
+        """
+        if num_workers < 1:
+            raise ValueError(f"num_workers should be positive, got {num_workers}")
+
+        # fork avoids pickling the datasets (and their rasterisers) for the workers
+        start_methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context("fork" if "fork" in start_methods else None)
+        # the workers must share our resource tracker, otherwise the segments we attach to are reported as leaked
+        resource_tracker.ensure_running()
+
+        self.shards: List[List[int]] = []
+        self._conns: List[Connection] = []
+        self._processes: list = []
+        self._shms: List[Optional[SharedMemory]] = []
+        shards = sim_dataset.split(num_workers)
+        pipes = [ctx.Pipe() for _ in shards]
+        for shard, (parent_conn, child_conn) in zip(shards, pipes):
+            unused_conns = [c for pipe in pipes for c in pipe if c is not child_conn]
+            process = ctx.Process(target=_worker_loop, daemon=True,
+                                  args=(shard, child_conn, min_shared_bytes, unused_conns))
+            process.start()
+
+            self.shards.append(list(shard.scene_dataset_batch))
+            self._conns.append(parent_conn)
+            self._processes.append(process)
+            self._shms.append(None)
+
+        for _, child_conn in pipes:
+            child_conn.close()
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def submit(self, shard_idx: int, state_index: int, target: str, updates: SimulationUpdates) -> None:
+        """Apply the updates to a shard and start rasterising a frame
+
+        :param shard_idx: the shard index
+        :param state_index: the frame index to rasterise
+        :param target: RASTERISE_AGENTS or RASTERISE_EGO
+        :param updates: the updates to apply before rasterising
+        """
+        if target not in (RASTERISE_AGENTS, RASTERISE_EGO):
+            raise ValueError(f"unknown rasterisation target {target}")
+        self._conns[shard_idx].send(("rasterise", updates, state_index, target))
+
+    def result(self, shard_idx: int) -> List[Dict[str, np.ndarray]]:
+        """Wait for the frame of a shard. The big arrays are views on the shared memory segment of the worker,
+        they must be copied (e.g. collated) before the next submit to the same shard.
+
+        :param shard_idx: the shard index
+        :return: the rasterised elements, as returned by the SimulationDataset
+        """
+        name, elements, layout = self._recv(shard_idx)
+        if name is None:
+            return elements
+
+        shm = self._shms[shard_idx]
+        if shm is None or shm.name != name:
+            if shm is not None:
+                shm.close()
+            shm = self._shms[shard_idx] = SharedMemory(name=name)
+
+        for element, element_layout in zip(elements, layout):
+            for key, (offset, shape, dtype) in element_layout.items():
+                element[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        return elements
+
+    def close(self, updates: Optional[List[SimulationUpdates]] = None) -> Dict[int, ChunkedDataset]:
+        """Apply the last updates, stop the workers and collect the simulated scenes
+
+        :param updates: the updates to apply to each shard, if any
+        :return: a dict mapping the scene index to its simulated dataset
+        """
+        scene_datasets: Dict[int, ChunkedDataset] = {}
+        for shard_idx, conn in enumerate(self._conns):
+            shard_updates = updates[shard_idx] if updates is not None else SimulationUpdates()
+            conn.send(("close", shard_updates, None, None))
+            scene_datasets.update(self._recv(shard_idx))
+        self.terminate()
+        return scene_datasets
+
+    def terminate(self) -> None:
+        """Stop the workers and release the shared memory. Safe to call more than once."""
+        for shm in self._shms:
+            if shm is not None:
+                try:
+                    shm.close()
+                except BufferError:  # views still alive after an error, the mapping goes away with them
+                    pass
+        for conn in self._conns:
+            conn.close()
+        for process in self._processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self._shms, self._conns, self._processes = [], [], []
+
+    def _recv(self, shard_idx: int) -> Any:
+        try:
+            status, payload = self._conns[shard_idx].recv()
+        except EOFError:
+            raise RuntimeError(f"simulation worker for scenes {self.shards[shard_idx]} died unexpectedly")
+        if status == "error":
+            raise RuntimeError(f"simulation worker for scenes {self.shards[shard_idx]} failed:\n{payload}")
+        return payload
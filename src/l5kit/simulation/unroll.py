@@ -1,6 +1,6 @@
 from collections import defaultdict
 from enum import IntEnum
-from typing import DefaultDict, Dict, List, NamedTuple, Optional, Set, Tuple
+from typing import DefaultDict, Dict, List, NamedTuple, Optional, Set, Tuple, Union
 
 import numpy as np
 import torch
@@ -12,6 +12,7 @@ from l5kit.dataset import EgoDataset
 from l5kit.dataset.utils import move_to_device, move_to_numpy
 from l5kit.geometry import rotation33_as_yaw, transform_points
 from l5kit.simulation.dataset import SimulationConfig, SimulationDataset
+from l5kit.simulation.parallel import RASTERISE_AGENTS, RASTERISE_EGO, SimulationUpdates, SimulationWorkerPool
 
 
 class TrajectoryStateIndices(IntEnum):
@@ -144,7 +145,8 @@ class ClosedLoopSimulator:
                  model_ego: Optional[torch.nn.Module] = None,
                  model_agents: Optional[torch.nn.Module] = None,
                  keys_to_exclude: Tuple[str] = ("image",),
-                 mode: int = ClosedLoopSimulatorModes.L5KIT):
+                 mode: int = ClosedLoopSimulatorModes.L5KIT,
+                 num_workers: int = 0):
         """
         Create a simulation loop object capable of unrolling ego and agents
         :param sim_cfg: configuration for unroll
@@ -154,6 +156,8 @@ class ClosedLoopSimulator:
         :param model_agents: the model to be used for agents
         :param keys_to_exclude: keys to exclude from input/output (e.g. huge blobs)
         :param mode: the framework that uses the closed loop simulator
+        :param num_workers: if positive, the scenes are split between this many processes which rasterise them
+        while the models run in the main process (see unroll)
         """
         self.sim_cfg = sim_cfg
         if not sim_cfg.use_ego_gt and model_ego is None and mode == ClosedLoopSimulatorModes.L5KIT:
@@ -170,14 +174,26 @@ class ClosedLoopSimulator:
         self.dataset = dataset
 
         self.keys_to_exclude = set(keys_to_exclude)
+        if num_workers < 0:
+            raise ValueError(f"num_workers should be non negative, got {num_workers}")
+        self.num_workers = num_workers
 
     def unroll(self, scene_indices: List[int]) -> List[SimulationOutput]:
         """
-        Simulate the dataset for the given scene indices
+        Simulate the dataset for the given scene indices.
+
+        With num_workers > 0 the scenes are sharded across worker processes. Each worker rasterises its scenes
+        and applies the model updates to them, while the main process runs the models one shard at a time:
+        the rasterisation of the next step of a shard overlaps the forward of the other shards.
+        Scenes are simulated independently, so the result is the same except that the models see one shard
+        per forward instead of all the scenes.
+
         :param scene_indices: the scene indices we want to simulate
         :return: the simulated dataset
         """
         sim_dataset = SimulationDataset.from_dataset_indices(self.dataset, scene_indices, self.sim_cfg)
+        if self.num_workers > 0 and not (self.sim_cfg.use_agents_gt and self.sim_cfg.use_ego_gt):
+            return self._unroll_parallel(sim_dataset, scene_indices)
 
         agents_ins_outs: DefaultDict[int, List[List[UnrollInputOutput]]] = defaultdict(list)
         ego_ins_outs: DefaultDict[int, List[UnrollInputOutput]] = defaultdict(list)
@@ -190,12 +206,8 @@ class ClosedLoopSimulator:
             if not self.sim_cfg.use_agents_gt:
                 agents_input = sim_dataset.rasterise_agents_frame_batch(frame_index)
                 if len(agents_input):  # agents may not be available
-                    agents_input_dict = default_collate(list(agents_input.values()))
-                    agents_output_dict = self.model_agents(move_to_device(agents_input_dict, self.device))
-
-                    # for update we need everything as numpy
-                    agents_input_dict = move_to_numpy(agents_input_dict)
-                    agents_output_dict = move_to_numpy(agents_output_dict)
+                    agents_input_dict, agents_output_dict = self._forward(self.model_agents,
+                                                                          list(agents_input.values()))
 
                     if should_update:
                         self.update_agents(sim_dataset, next_frame_index, agents_input_dict, agents_output_dict)
@@ -209,11 +221,7 @@ class ClosedLoopSimulator:
             # EGO
             if not self.sim_cfg.use_ego_gt:
                 ego_input = sim_dataset.rasterise_frame_batch(frame_index)
-                ego_input_dict = default_collate(ego_input)
-                ego_output_dict = self.model_ego(move_to_device(ego_input_dict, self.device))
-
-                ego_input_dict = move_to_numpy(ego_input_dict)
-                ego_output_dict = move_to_numpy(ego_output_dict)
+                ego_input_dict, ego_output_dict = self._forward(self.model_ego, ego_input)
 
                 if should_update:
                     self.update_ego(sim_dataset, next_frame_index, ego_input_dict, ego_output_dict)
@@ -227,12 +235,96 @@ class ClosedLoopSimulator:
             simulated_outputs.append(SimulationOutput(scene_idx, sim_dataset, ego_ins_outs, agents_ins_outs))
         return simulated_outputs
 
+    def _unroll_parallel(self, sim_dataset: SimulationDataset, scene_indices: List[int]) -> List[SimulationOutput]:
+        """Same as unroll, with the scenes rasterised by a SimulationWorkerPool
+
+        :param sim_dataset: the simulation dataset of the scene indices
+        :param scene_indices: the scene indices we want to simulate
+        :return: the simulated dataset
+        """
+        agents_ins_outs: DefaultDict[int, List[List[UnrollInputOutput]]] = defaultdict(list)
+        ego_ins_outs: DefaultDict[int, List[UnrollInputOutput]] = defaultdict(list)
+
+        # every shard goes through the same steps, in the same order as the serial unroll
+        targets = []
+        if not self.sim_cfg.use_agents_gt:
+            targets.append(RASTERISE_AGENTS)
+        if not self.sim_cfg.use_ego_gt:
+            targets.append(RASTERISE_EGO)
+        steps = [(frame_index, target) for frame_index in range(len(sim_dataset)) for target in targets]
+
+        pool = SimulationWorkerPool(sim_dataset, self.num_workers)
+        try:
+            for shard_idx in range(len(pool)):
+                pool.submit(shard_idx, *steps[0], SimulationUpdates())
+
+            for step_idx, (frame_index, target) in enumerate(tqdm(steps, disable=not self.sim_cfg.show_info)):
+                next_frame_index = frame_index + 1
+                should_update = next_frame_index != len(sim_dataset)
+
+                agents_frame_in_out: Dict[int, List[UnrollInputOutput]] = {}
+                has_agents = False
+                for shard_idx in range(len(pool)):
+                    # updates are applied by the worker before it rasterises the next step
+                    updates = SimulationUpdates()
+                    inputs = pool.result(shard_idx)
+
+                    if target == RASTERISE_AGENTS:
+                        if len(inputs):  # agents may not be available
+                            has_agents = True
+                            agents_input_dict, agents_output_dict = self._forward(self.model_agents, inputs)
+                            if should_update:
+                                self.update_agents(updates, next_frame_index, agents_input_dict, agents_output_dict)
+                            agents_frame_in_out.update(self.get_agents_in_out(agents_input_dict, agents_output_dict,
+                                                                              self.keys_to_exclude))
+                    else:
+                        ego_input_dict, ego_output_dict = self._forward(self.model_ego, inputs)
+                        if should_update:
+                            self.update_ego(updates, next_frame_index, ego_input_dict, ego_output_dict)
+                        ego_frame_in_out = self.get_ego_in_out(ego_input_dict, ego_output_dict, self.keys_to_exclude)
+                        for scene_idx in pool.shards[shard_idx]:
+                            ego_ins_outs[scene_idx].append(ego_frame_in_out[scene_idx])
+                    del inputs  # release the shared memory views before the worker reuses them
+
+                    if step_idx + 1 < len(steps):
+                        pool.submit(shard_idx, *steps[step_idx + 1], updates)
+
+                # as in the serial unroll, frames without any agent across scenes are not recorded
+                if has_agents:
+                    for scene_idx in scene_indices:
+                        agents_ins_outs[scene_idx].append(agents_frame_in_out.get(scene_idx, []))
+
+            # the last step never updates, the simulated scenes are final
+            for scene_idx, scene_dataset in pool.close().items():
+                sim_dataset.scene_dataset_batch[scene_idx].dataset = scene_dataset
+        finally:
+            pool.terminate()
+
+        simulated_outputs: List[SimulationOutput] = []
+        for scene_idx in scene_indices:
+            simulated_outputs.append(SimulationOutput(scene_idx, sim_dataset, ego_ins_outs, agents_ins_outs))
+        return simulated_outputs
+
+    def _forward(self, model: torch.nn.Module,
+                 inputs: List[Dict[str, np.ndarray]]) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        """Collate the inputs and run the model on them
+
+        :param model: the ego or agents model
+        :param inputs: the rasterised elements
+        :return: the collated input dict and the output dict, both as numpy
+        """
+        input_dict = default_collate(inputs)
+        output_dict = model(move_to_device(input_dict, self.device))
+
+        # for update we need everything as numpy
+        return move_to_numpy(input_dict), move_to_numpy(output_dict)
+
     @staticmethod
-    def update_agents(dataset: SimulationDataset, frame_idx: int, input_dict: Dict[str, np.ndarray],
-                      output_dict: Dict[str, np.ndarray]) -> None:
+    def update_agents(dataset: Union[SimulationDataset, SimulationUpdates], frame_idx: int,
+                      input_dict: Dict[str, np.ndarray], output_dict: Dict[str, np.ndarray]) -> None:
         """Update the agents in frame_idx (across scenes) using agents_output_dict
 
-        :param dataset: the simulation dataset
+        :param dataset: the simulation dataset (or the updates of a worker's dataset)
         :param frame_idx: index of the frame to modify
         :param input_dict: the input to the agent model
         :param output_dict: the output of the agent model
@@ -319,11 +411,11 @@ class ClosedLoopSimulator:
         return ret_dict
 
     @staticmethod
-    def update_ego(dataset: SimulationDataset, frame_idx: int, input_dict: Dict[str, np.ndarray],
-                   output_dict: Dict[str, np.ndarray]) -> None:
+    def update_ego(dataset: Union[SimulationDataset, SimulationUpdates], frame_idx: int,
+                   input_dict: Dict[str, np.ndarray], output_dict: Dict[str, np.ndarray]) -> None:
         """Update ego across scenes for the given frame index.
 
-        :param dataset: The simulation dataset
+        :param dataset: The simulation dataset (or the updates of a worker's dataset)
         :param frame_idx: index of the frame to modify
         :param input_dict: the input to the ego model
         :param output_dict: the output of the ego model
@@ -0,0 +1,77 @@
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from l5kit.configs.config import load_metadata
+from l5kit.data import LocalDataManager
+from l5kit.data.map_api import InterpolationMethod, MapAPI
+
+
+@pytest.fixture(scope="function")
+def map_path(dmg: LocalDataManager, tmp_path: Path) -> str:
+    # copy the map so that the compiled one is written in tmp_path
+    map_path = str(tmp_path / "semantic_map.pb")
+    shutil.copy(dmg.require("semantic_map.pb"), map_path)
+    return map_path
+
+
+@pytest.fixture(scope="function")
+def world_to_ecef(dmg: LocalDataManager) -> np.ndarray:
+    return np.array(load_metadata(dmg.require("meta.json"))["world_to_ecef"], dtype=np.float64)
+
+
+def test_compiled_map(map_path: str, world_to_ecef: np.ndarray) -> None:
+    map_api = MapAPI(map_path, world_to_ecef)
+    assert map_api.compiled_map is None
+
+    compiled_map = map_api.compile(interpolation_points=(20, 5))
+    compiled_api = MapAPI(map_path, world_to_ecef)
+    assert compiled_api.compiled_map is not None
+    assert compiled_api.compiled_map.path == compiled_map.path
+    assert len(compiled_api) == len(map_api)
+
+    for key in ["lanes", "crosswalks"]:
+        assert compiled_api.bounds_info[key]["ids"] == map_api.bounds_info[key]["ids"]
+        assert np.allclose(compiled_api.bounds_info[key]["bounds"], map_api.bounds_info[key]["bounds"])
+
+    for lane_id in map_api.bounds_info["lanes"]["ids"]:
+        assert compiled_api.get_lane_traffic_control_ids(lane_id) == map_api.get_lane_traffic_control_ids(lane_id)
+        lane_coords = map_api.get_lane_coords(lane_id)
+        # 7 points are not compiled and are interpolated on the fly
+        for num_points in [20, 5, 7]:
+            lane = compiled_api.get_lane_as_interpolation(lane_id, num_points, InterpolationMethod.INTER_ENSURE_LEN)
+            xyz_left = MapAPI.interpolate(lane_coords["xyz_left"], num_points, InterpolationMethod.INTER_ENSURE_LEN)
+            xyz_right = MapAPI.interpolate(lane_coords["xyz_right"], num_points, InterpolationMethod.INTER_ENSURE_LEN)
+            assert np.allclose(lane["xyz_left"], xyz_left)
+            assert np.allclose(lane["xyz_right"], xyz_right)
+            assert np.allclose(lane["xyz_midlane"], MapAPI.interpolate(
+                (xyz_left + xyz_right) / 2, num_points, InterpolationMethod.INTER_ENSURE_LEN))
+
+    for crosswalk_id in map_api.bounds_info["crosswalks"]["ids"]:
+        assert np.allclose(compiled_api.get_crosswalk_coords(crosswalk_id)["xyz"],
+                           map_api.get_crosswalk_coords(crosswalk_id)["xyz"])
+
+    # only the path of the compiled map is pickled, and the protobuf is parsed lazily
+    unpickled_api = pickle.loads(pickle.dumps(compiled_api))
+    assert unpickled_api._elements is None
+    assert unpickled_api.bounds_info["lanes"]["ids"] == map_api.bounds_info["lanes"]["ids"]
+    assert len(unpickled_api.elements) == len(map_api.elements)
+
+
+def test_compiled_map_stale(map_path: str, world_to_ecef: np.ndarray) -> None:
+    compiled_map = MapAPI(map_path, world_to_ecef).compile()
+
+    # a map compiled for another world_to_ecef is not used
+    other_world_to_ecef = world_to_ecef.copy()
+    other_world_to_ecef[:3, 3] += 1
+    assert MapAPI(map_path, other_world_to_ecef).compiled_map is None
+
+    # nor one that's older than the protobuf
+    os.utime(map_path, ns=(0, 0))
+    assert MapAPI(map_path, world_to_ecef).compiled_map is None
+    with pytest.raises(ValueError):
+        MapAPI(map_path, world_to_ecef, compiled_map_path=compiled_map.path)
@@ -1,3 +1,4 @@
+from collections import Counter
 from functools import partial
 from pathlib import Path
 
@@ -5,7 +6,8 @@ import numpy as np
 import pytest
 
 from l5kit.data import ChunkedDataset
-from l5kit.dataset.select_agents import get_valid_agents, TH_DISTANCE_AV, TH_EXTENT_RATIO, TH_YAW_DEGREE
+from l5kit.dataset.select_agents import (get_valid_agents, get_valid_agents_scenes, TH_DISTANCE_AV, TH_EXTENT_RATIO,
+                                        TH_YAW_DEGREE)
 
 
 SCENE_LENGTH = 50
@@ -18,6 +20,14 @@ get_valid_agents_p = partial(
     th_distance_av=TH_DISTANCE_AV,
 )
 
+get_valid_agents_scenes_p = partial(
+    get_valid_agents_scenes,
+    th_agent_filter_probability_threshold=0,
+    th_yaw_degree=TH_YAW_DEGREE,
+    th_extent_ratio=TH_EXTENT_RATIO,
+    th_distance_av=TH_DISTANCE_AV,
+)
+
 
 @pytest.fixture()  # not shared in scope
 def dataset(tmp_path: Path) -> ChunkedDataset:
@@ -119,3 +129,30 @@ def test_get_valid_agents(dataset: ChunkedDataset) -> None:
     # we have a single valid agents, so the mask should decrease gently in the future and increase in the past
     assert np.all(np.diff(agents_mask[:, 0]) == 1)
     assert np.all(np.diff(agents_mask[:, 1]) == -1)
+
+
+def test_get_valid_agents_scenes(dataset: ChunkedDataset) -> None:
+    # split the scene in two, the same track should not be linked across scenes
+    split = SCENE_LENGTH // 2
+    dataset.scenes = np.zeros(2, dtype=dataset.scenes.dtype)
+    dataset.scenes[0]["frame_index_interval"] = (0, split)
+    dataset.scenes[1]["frame_index_interval"] = (split, SCENE_LENGTH)
+    dataset.agents[10]["yaw"] = np.radians(50)
+
+    agents_mask, report, agents_range = get_valid_agents_scenes_p(np.asarray([0, 2]), dataset)
+    assert agents_range == (0, SCENE_LENGTH)
+
+    # same result as processing each scene on its own
+    expected_report = Counter()
+    for scene_idx, expected_range in enumerate([(0, split), (split, SCENE_LENGTH)]):
+        frames_range = dataset.scenes[scene_idx]["frame_index_interval"]
+        scene_mask, scene_report, scene_agents_range = get_valid_agents_p(frames_range, dataset)
+        assert scene_agents_range == expected_range
+        assert np.array_equal(agents_mask[slice(*expected_range)], scene_mask)
+        expected_report += scene_report
+    assert report == expected_report
+
+    agents_mask = agents_mask.astype(np.int)
+    assert agents_mask[split - 1, 1] == 0
+    assert agents_mask[split, 0] == 0
+    assert agents_mask[10, 0] == agents_mask[10, 1] == 0
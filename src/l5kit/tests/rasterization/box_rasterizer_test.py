@@ -3,7 +3,7 @@ import pytest
 
 from l5kit.data import AGENT_DTYPE, ChunkedDataset, filter_agents_by_frames, LocalDataManager
 from l5kit.rasterization import build_rasterizer
-from l5kit.rasterization.box_rasterizer import draw_boxes, get_box_world_coords
+from l5kit.rasterization.box_rasterizer import draw_boxes, draw_boxes_channels, get_box_world_coords
 
 
 def test_empty_boxes() -> None:
@@ -34,6 +34,24 @@ def test_draw_boxes() -> None:
     assert np.allclose(im[centroid_2[1] - 5: centroid_2[1] + 5, centroid_2[0] - 5: centroid_2[0] + 5], 1)
 
 
+def test_draw_boxes_channels() -> None:
+    agents = np.zeros(3, dtype=AGENT_DTYPE)
+    agents["extent"] = (20, 20, 20)
+    agents["centroid"] = [(90, 100), (150, 160), (90, 100)]
+    channels = np.asarray([0, 0, 2])
+
+    to_image_space = np.eye(3)
+    im = draw_boxes_channels((200, 200), to_image_space, agents, channels, 3)
+    assert im.shape == (3, 200, 200)
+    # same as drawing the agents of each channel on their own
+    assert np.array_equal(im[0], draw_boxes((200, 200), to_image_space, agents[:2], color=255))
+    assert im[1].sum() == 0
+    assert np.array_equal(im[2], draw_boxes((200, 200), to_image_space, agents[2:], color=255))
+
+    im = draw_boxes_channels((200, 200), to_image_space, agents[:0], channels[:0], 3)
+    assert im.shape == (3, 200, 200) and im.sum() == 0
+
+
 @pytest.fixture(scope="module")
 def hist_data(zarr_dataset: ChunkedDataset) -> tuple:
     hist_frames = zarr_dataset.frames[100:111][::-1]  # reverse to get them as history
@@ -140,3 +158,26 @@ def test_box_world_coords() -> None:
     for out_box in out[2:4]:
         for exp_point in expected_points:
             assert np.any(np.linalg.norm(out_box - exp_point, axis=-1) < 1e5)
+
+
+def test_output_uint8(hist_data: tuple, dmg: LocalDataManager, cfg: dict) -> None:
+    hist_length = 5
+    cfg["raster_params"]["map_type"] = "box_debug"
+    cfg["model_params"]["history_num_frames"] = hist_length
+    frames, agents = hist_data[0][: hist_length + 1], hist_data[1][: hist_length + 1]
+    out = build_rasterizer(cfg, dmg).rasterize(frames, agents, [])
+
+    cfg["raster_params"]["output_uint8"] = True
+    out_uint8 = build_rasterizer(cfg, dmg).rasterize(frames, agents, [])
+    assert out_uint8.dtype == np.uint8
+    assert np.array_equal(out_uint8.astype(np.float32) / 255, out)
+
+
+def test_too_many_frames(hist_data: tuple, dmg: LocalDataManager, cfg: dict) -> None:
+    hist_length = 5
+    cfg["raster_params"]["map_type"] = "box_debug"
+    cfg["model_params"]["history_num_frames"] = hist_length
+    rasterizer = build_rasterizer(cfg, dmg)
+
+    with pytest.raises(ValueError):
+        rasterizer.rasterize(hist_data[0][: hist_length + 2], hist_data[1][: hist_length + 2], [])
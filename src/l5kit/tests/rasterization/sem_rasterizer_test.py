@@ -1,6 +1,9 @@
+from typing import Dict, Set
+
 import numpy as np
 
-from l5kit.rasterization.semantic_rasterizer import indices_in_bounds
+from l5kit.data.map_api import InterpolationMethod, MapAPI
+from l5kit.rasterization.semantic_rasterizer import indices_in_bounds, RasterEls, TessellatedMap
 
 
 def test_elements_within_bounds() -> None:
@@ -46,3 +49,67 @@ def test_elements_within_bounds() -> None:
     # empty case
     bounds = np.empty((0, 2, 2), dtype=np.float32)
     assert len(indices_in_bounds(center, bounds, half_side)) == 0
+
+
+class _ToyMapAPI:
+    """Minimal MapAPI stand-in: parallel straight lanes along x and square crosswalks"""
+
+    def __init__(self) -> None:
+        self.lanes: Dict[str, np.ndarray] = {}
+        self.tl_ids: Dict[str, Set[str]] = {"lane_0": set(), "lane_1": {"face_red"}, "lane_2": {"face_red", "tl"}}
+        lanes_bounds = []
+        for idx in range(3):
+            x = np.linspace(0, 10, 3)
+            left = np.stack([x, np.full_like(x, 4 * idx + 2), np.zeros_like(x)], -1)
+            right = np.stack([x, np.full_like(x, 4 * idx - 2), np.zeros_like(x)], -1)
+            self.lanes[f"lane_{idx}"] = np.stack([left, right])
+            lanes_bounds.append([[0, 4 * idx - 2], [10, 4 * idx + 2]])
+        self.crosswalks = {f"cw_{idx}": np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]]) + idx
+                           for idx in range(2)}
+        self.bounds_info = {
+            "lanes": {"bounds": np.asarray(lanes_bounds, dtype=np.float64), "ids": list(self.lanes)},
+            "crosswalks": {"bounds": np.asarray([[[i, i], [i + 1, i + 1]] for i in range(2)], dtype=np.float64),
+                           "ids": list(self.crosswalks)},
+        }
+
+    def get_lane_as_interpolation(self, element_id: str, step: float, method: InterpolationMethod) -> dict:
+        left, right = self.lanes[element_id]
+        return {
+            "xyz_left": MapAPI.interpolate(left, step, method),
+            "xyz_right": MapAPI.interpolate(right, step, method),
+        }
+
+    def get_lane_traffic_control_ids(self, element_id: str) -> set:
+        return self.tl_ids[element_id]
+
+    def get_crosswalk_coords(self, element_id: str) -> dict:
+        return {"xyz": self.crosswalks[element_id]}
+
+    def get_color_for_face(self, face_id: str) -> str:
+        assert face_id == "face_red"
+        return "RED"
+
+
+def test_tessellated_map() -> None:
+    map_api = _ToyMapAPI()
+    tess = TessellatedMap(map_api, interpolation_points=5)  # type: ignore
+
+    # left boundary then reversed right boundary of each lane
+    lanes_area = tess.get_lanes_area(np.array([2]))
+    assert lanes_area.shape == (2, 5, 2)
+    assert np.allclose(lanes_area[0, :, 0], np.linspace(0, 10, 5))
+    assert np.allclose(lanes_area[1, :, 0], np.linspace(10, 0, 5))
+    assert np.allclose(lanes_area[0, :, 1], 10) and np.allclose(lanes_area[1, :, 1], 6)
+
+    crosswalks_xy, splits = tess.get_crosswalks_xy(np.array([1, 0]))
+    assert np.allclose(np.split(crosswalks_xy, splits)[0], map_api.crosswalks["cw_1"][:, :2])
+    assert np.allclose(np.split(crosswalks_xy, splits)[1], map_api.crosswalks["cw_0"][:, :2])
+    crosswalks_xy, splits = tess.get_crosswalks_xy(np.array([], dtype=np.int64))
+    assert len(crosswalks_xy) == 0
+
+    lane_indices = np.array([0, 1, 2])
+    no_tl = tess.LANE_TYPES.index(RasterEls.LANE_NOTL.name)
+    red = tess.LANE_TYPES.index("RED")
+    assert tess.get_lane_types(lane_indices, set()).tolist() == [no_tl] * 3
+    assert tess.get_lane_types(lane_indices, {"face_red", "unrelated"}).tolist() == [no_tl, red, red]
+    assert tess.get_lane_types(np.array([2, 0]), {"face_red"}).tolist() == [red, no_tl]
@@ -179,6 +179,40 @@ def test_unroll_subset(zarr_cat_dataset: ChunkedDataset, dmg: LocalDataManager,
         assert np.allclose(ego_dist, 1.0)
 
 
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_unroll_parallel(zarr_cat_dataset: ChunkedDataset, dmg: LocalDataManager, cfg: dict,
+                         num_workers: int) -> None:
+    rasterizer = build_rasterizer(cfg, dmg)
+
+    scene_indices = list(range(len(zarr_cat_dataset.scenes)))
+    ego_dataset = EgoDataset(cfg, zarr_cat_dataset, rasterizer)
+
+    sim_cfg = SimulationConfig(use_ego_gt=False, use_agents_gt=False, disable_new_agents=True,
+                               distance_th_close=30, distance_th_far=50, num_simulation_steps=10)
+
+    # scenes are simulated independently, so sharding them across workers should not change the result
+    sim_outputs = ClosedLoopSimulator(sim_cfg, ego_dataset, torch.device("cpu"), MockModel(1.0),
+                                      MockModel(0.5)).unroll(scene_indices)
+    sim_outputs_parallel = ClosedLoopSimulator(sim_cfg, ego_dataset, torch.device("cpu"), MockModel(1.0),
+                                               MockModel(0.5), num_workers=num_workers).unroll(scene_indices)
+
+    assert len(sim_outputs) == len(sim_outputs_parallel)
+    for sim_out, sim_out_parallel in zip(sim_outputs, sim_outputs_parallel):
+        assert sim_out.scene_id == sim_out_parallel.scene_id
+        assert np.array_equal(sim_out.simulated_ego, sim_out_parallel.simulated_ego)
+        assert np.array_equal(sim_out.simulated_agents, sim_out_parallel.simulated_agents)
+        assert np.array_equal(sim_out.recorded_agents, sim_out_parallel.recorded_agents)
+
+        assert len(sim_out.ego_ins_outs) == len(sim_out_parallel.ego_ins_outs)
+        for ego_in_out, ego_in_out_parallel in zip(sim_out.ego_ins_outs, sim_out_parallel.ego_ins_outs):
+            for key, value in ego_in_out.inputs.items():
+                assert np.array_equal(value, ego_in_out_parallel.inputs[key])
+
+        assert len(sim_out.agents_ins_outs) == len(sim_out_parallel.agents_ins_outs)
+        for agents_in_out, agents_in_out_parallel in zip(sim_out.agents_ins_outs, sim_out_parallel.agents_ins_outs):
+            assert [el.track_id for el in agents_in_out] == [el.track_id for el in agents_in_out_parallel]
+
+
 def test_get_in_out_mock() -> None:
     with pytest.raises(ValueError):
         # repeated scene not allowed
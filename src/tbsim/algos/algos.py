@@ -31,7 +31,7 @@ from tbsim.policies.common import Plan, Action
 import tbsim.algos.algo_utils as AlgoUtils
 from tbsim.utils.geometry_utils import transform_points_tensor
 from tbsim.models.diffuser import DiffuserModel
-from tbsim.models.diffuser_helpers import EMA
+from tbsim.models.diffuser_helpers import EMA, get_norm_info
 from tbsim.models.strive import STRIVEVaeModel
 from tbsim.models.scenediffuser import SceneDiffuserModel
 from tbsim.utils.guidance_loss import choose_action_from_guidance, choose_action_from_gt
@@ -1693,6 +1693,10 @@ class DiffuserTrafficModel(pl.LightningModule):
             neighbor_hist_norm_info = algo_config.nuplan_norm_info['neighbor_hist']
         else:
             raise
+        # a dataset statistics file overrides the hard-coded norm info
+        diffuser_norm_info = get_norm_info(algo_config, "diffuser", diffuser_norm_info)
+        agent_hist_norm_info = get_norm_info(algo_config, "agent_hist", agent_hist_norm_info)
+        neighbor_hist_norm_info = get_norm_info(algo_config, "neighbor_hist", neighbor_hist_norm_info)
 
 
         self.cond_drop_map_p = algo_config.conditioning_drop_map_p
@@ -2378,6 +2382,11 @@ class SceneDiffuserTrafficModel(pl.LightningModule):
                 neighbor_fut_norm_info = algo_config.nuplan_norm_info['neighbor_fut']
         else:
             raise
+        # a dataset statistics file overrides the hard-coded norm info
+        diffuser_norm_info = get_norm_info(algo_config, "diffuser", diffuser_norm_info)
+        agent_hist_norm_info = get_norm_info(algo_config, "agent_hist", agent_hist_norm_info)
+        neighbor_hist_norm_info = get_norm_info(algo_config, "neighbor_hist", neighbor_hist_norm_info)
+        neighbor_fut_norm_info = get_norm_info(algo_config, "neighbor_fut", neighbor_fut_norm_info)
 
 
         self.cond_drop_map_p = algo_config.conditioning_drop_map_p
@@ -86,6 +86,8 @@ class EvaluationConfig(Dict):
 
         self.metrics.compute_analytical_metrics = True
         self.metrics.compute_learned_metrics = False
+        # compute off-road/collision/failure metrics in one batched pass on the policy device
+        self.metrics.fused_step_metrics = False
 
         self.perturb.enabled = False
         self.perturb.OU.theta = 0.8
@@ -39,6 +39,9 @@ class TrajdataTrainConfig(TrainConfig):
             'dist_weight': 1.0,
             'heading_weight': 0.1,
         }
+        # precompute the candidate lanes of every sample once (stored next to the trajdata cache)
+        #   instead of querying the vector map in the data loader
+        self.trajdata_closest_lane_cache = False
 
 
 class TrajdataEnvConfig(EnvConfig):
@@ -64,6 +67,10 @@ class TrajdataEnvConfig(EnvConfig):
         # standardize position and heading for the predicted agent
         self.data_generation_params.trajdata_standardize_data = True
 
+        # advance the observation used for metrics and logging between the sub-steps of a
+        #   multi-step action instead of re-collating the scenes at every sub-step
+        self.incremental_obs = True
+
         #
         # map params -- default for nuscenes
         # NOTE: rasterization info must still be provided even if incl_map=False
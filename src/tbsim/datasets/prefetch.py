@@ -0,0 +1,147 @@
+import time
+import torch
+import pytorch_lightning as pl
+from torch.utils.data import DataLoader
+
+import tbsim.utils.tensor_utils as TensorUtils
+from tbsim.utils.batch_utils import batch_utils
+
+
+class ParseCollate(object):
+    """
+    Collate function that also parses the batch, so that batch_utils().parse_batch runs in the
+    data loader workers instead of the training loop. Parsing an already parsed batch is a no-op.
+    The batch utils are resolved here, in the main process: the global batch type is not set in
+    workers started with spawn / forkserver.
+    """
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+        self.batch_utils = batch_utils()
+
+    def __call__(self, elements):
+        return self.batch_utils.parse_batch(self.collate_fn(elements))
+
+
+class PrefetchStats(object):
+    """
+    How long the training loop waited on the data loader workers for each batch (stall time), and how many
+    finished batches were waiting in the worker queue when it asked for one (queue depth).
+    A queue that is often empty together with long stalls means the workers do not keep up.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.num_batches = 0
+        self.stall_time = 0.0
+        self.queue_depth = 0
+        self.last_stall_time = 0.0
+        self.last_queue_depth = 0
+
+    def record(self, stall_time, queue_depth):
+        self.num_batches += 1
+        self.stall_time += stall_time
+        self.queue_depth += queue_depth
+        self.last_stall_time = stall_time
+        self.last_queue_depth = queue_depth
+
+    def summary(self):
+        """Mean stall time (ms) and queue depth since the last reset."""
+        n = max(self.num_batches, 1)
+        return {
+            "stall_ms": 1000.0 * self.stall_time / n,
+            "queue_depth": self.queue_depth / n,
+        }
+
+
+def _queue_depth(it):
+    data_queue = getattr(it, "_data_queue", None)
+    if data_queue is None:
+        return 0
+    try:
+        return data_queue.qsize()
+    except NotImplementedError:  # not available on macOS
+        return 0
+
+
+class _TimedIter(object):
+    def __init__(self, it, stats):
+        self.it = it
+        self.stats = stats
+
+    def __iter__(self):
+        return self
+
+    def _fetch(self):
+        depth = _queue_depth(self.it)
+        t0 = time.perf_counter()
+        batch = next(self.it)
+        self.stats.record(time.perf_counter() - t0, depth)
+        return batch
+
+    def __next__(self):
+        return self._fetch()
+
+
+class _CudaPrefetchIter(_TimedIter):
+    """
+    Keeps the next batch one step ahead on the device: its host-to-device copy is issued on a side
+    stream while the current step runs, and the compute stream only waits for it when the batch is used.
+    """
+    def __init__(self, it, stats, device):
+        super(_CudaPrefetchIter, self).__init__(it, stats)
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self._preload()
+
+    def _preload(self):
+        try:
+            batch = self._fetch()
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = TensorUtils.map_tensor(batch, lambda x: x.to(self.device, non_blocking=True))
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        batch = self.next_batch
+        # the tensors were allocated on the side stream, keep their memory alive for the compute stream
+        TensorUtils.map_tensor(batch, lambda x: x.record_stream(torch.cuda.current_stream(self.device)))
+        self._preload()
+        return batch
+
+
+class PrefetchDataLoader(DataLoader):
+    """
+    DataLoader that prefetches the next batch to the current cuda device on a side stream and records
+    the data stall statistics in @prefetch_stats. Without cuda it only records the statistics.
+    Use with pin_memory=True so that the copies are asynchronous.
+    """
+    def __init__(self, *args, prefetch_stats=None, **kwargs):
+        super(PrefetchDataLoader, self).__init__(*args, **kwargs)
+        self.prefetch_stats = PrefetchStats() if prefetch_stats is None else prefetch_stats
+
+    def __iter__(self):
+        it = super(PrefetchDataLoader, self).__iter__()
+        if torch.cuda.is_available():
+            device = torch.device("cuda", torch.cuda.current_device())
+            return _CudaPrefetchIter(it, self.prefetch_stats, device)
+        return _TimedIter(it, self.prefetch_stats)
+
+
+class PrefetchStatsCallback(pl.Callback):
+    """Logs the data stall statistics of a PrefetchDataLoader every @log_every_n_steps training steps."""
+    def __init__(self, prefetch_stats, log_every_n_steps=50):
+        super(PrefetchStatsCallback, self).__init__()
+        self.prefetch_stats = prefetch_stats
+        self.log_every_n_steps = log_every_n_steps
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        if trainer.global_step % self.log_every_n_steps != 0 or self.prefetch_stats.num_batches == 0:
+            return
+        for k, v in self.prefetch_stats.summary().items():
+            pl_module.log("data/" + k, v, on_step=True, on_epoch=False)
+        self.prefetch_stats.reset()
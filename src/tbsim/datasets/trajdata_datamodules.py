@@ -5,7 +5,8 @@ from torch.utils.data import Dataset
 import pytorch_lightning as pl
 from torch.utils.data import DataLoader
 from tbsim.configs.base import TrainConfig
-from tbsim.utils.trajdata_utils import TRAJDATA_AGENT_TYPE_MAP, get_closest_lane_point_wrapper, get_full_fut_traj, get_full_fut_valid
+from tbsim.utils.trajdata_utils import TRAJDATA_AGENT_TYPE_MAP, get_closest_lane_point_wrapper, get_full_fut_traj, get_full_fut_valid, ClosestLaneCache
+from tbsim.datasets.prefetch import ParseCollate, PrefetchDataLoader, PrefetchStats
 
 from trajdata import AgentBatch, AgentType, UnifiedDataset
 import gc
@@ -114,6 +115,8 @@ class PassUnifiedDataModule(pl.LightningDataModule):
         self.train_dataset = None
         self.valid_dataset = None
         self.num_sem_layers = None
+        self.train_prefetch_stats = PrefetchStats()
+        self.valid_prefetch_stats = PrefetchStats()
 
     @property
     def modality_shapes(self):
@@ -186,32 +189,62 @@ class PassUnifiedDataModule(pl.LightningDataModule):
         kwargs["desired_data"] = data_cfg.trajdata_source_valid
         self.valid_dataset = UnifiedDataset(**kwargs)
 
+        if self._train_config.get("trajdata_closest_lane_cache", False):
+            self._use_closest_lane_cache(self.train_dataset, data_cfg.trajdata_source_train)
+            self._use_closest_lane_cache(self.valid_dataset, data_cfg.trajdata_source_valid)
+
         # set modality shape based on input
         self.num_sem_layers = 0 if not data_cfg.trajdata_incl_map else data_cfg.num_sem_layers
 
         gc.collect()
 
+    def _use_closest_lane_cache(self, dataset, desired_data):
+        """Serve the closest_lane_point extra of @dataset from a precomputed lane cache, building it if missing."""
+        vec_map_params = self._train_config.training_vec_map_params
+        cache_dir = ClosestLaneCache.get_cache_dir(self._data_config.trajdata_cache_location, desired_data,
+                                                   self._data_config.step_time, vec_map_params)
+        lane_cache = ClosestLaneCache(cache_dir, vec_map_params)
+        if not lane_cache.exists():
+            lane_cache.build(dataset, num_workers=self._train_config.training.num_data_workers)
+        dataset.extras["closest_lane_point"] = get_closest_lane_point_wrapper(vec_map_params, lane_cache=lane_cache)
+
+
+    def _make_dataloader(self, dataset, prefetch_stats, **kwargs):
+        """
+        With train.prefetch_to_device the workers also parse the batches and the next batch is copied
+        to the device from pinned memory while the current step runs (see tbsim.datasets.prefetch).
+        """
+        collate_fn = dataset.get_collate_fn(return_dict=True)
+        if not self._train_config.get("prefetch_to_device", False):
+            return DataLoader(dataset=dataset, collate_fn=collate_fn, **kwargs)
+        return PrefetchDataLoader(
+            dataset=dataset,
+            collate_fn=ParseCollate(collate_fn),
+            pin_memory=True,
+            prefetch_stats=prefetch_stats,
+            **kwargs
+        )
 
     def train_dataloader(self):
-        return DataLoader(
-            dataset=self.train_dataset,
+        return self._make_dataloader(
+            self.train_dataset,
+            self.train_prefetch_stats,
             shuffle=True,
             batch_size=self._train_config.training.batch_size,
             num_workers=self._train_config.training.num_data_workers,
             drop_last=True,
-            collate_fn=self.train_dataset.get_collate_fn(return_dict=True),
             persistent_workers=True,
 
         )
 
     def val_dataloader(self):
-        return DataLoader(
-            dataset=self.valid_dataset,
+        return self._make_dataloader(
+            self.valid_dataset,
+            self.valid_prefetch_stats,
             shuffle=False, # since pytorch lightning only evals a subset of val on each epoch, shuffle
             batch_size=self._train_config.validation.batch_size,
             num_workers=self._train_config.validation.num_data_workers,
             drop_last=True,
-            collate_fn=self.valid_dataset.get_collate_fn(return_dict=True),
             persistent_workers=True,
 
         )
@@ -8,7 +8,7 @@ from l5kit.geometry import transform_points, angular_distance
 
 import tbsim.utils.tensor_utils as TensorUtils
 from tbsim.utils.batch_utils import batch_utils
-from tbsim.utils.geometry_utils import transform_points_tensor, transform_yaw, detect_collision, CollisionType
+from tbsim.utils.geometry_utils import transform_points_tensor, transform_yaw, detect_collision, detect_collision_batch, CollisionType
 from tbsim.utils.trajdata_utils import get_raster_pix2m
 import tbsim.utils.metrics as Metrics
 from collections import defaultdict
@@ -49,6 +49,14 @@ class EnvMetrics(abc.ABC):
     def __len__(self):
         return max(self._scene_ts.values()) if len(self._scene_ts)>0 else 0
 
+    def _step_ts(self, agent_scene_index):
+        """Current step of each agent's scene [num_agents]; advances the step counter of every scene."""
+        scenes, inv = np.unique(agent_scene_index, return_inverse=True)
+        ts = np.array([self._scene_ts[sid] for sid in scenes], dtype=np.int64)[inv.reshape(-1)]
+        for sid in scenes:
+            self._scene_ts[sid] += 1
+        return ts
+
     def update_global_t(self, global_t=None):
         '''
         Update any persistant state needed by guidance loss functions.
@@ -144,10 +152,120 @@ def masked_max_per_episode(met, met_mask):
     return (met * met_mask).max(axis=1)
 
 
+def group_reduce(keys, values, reduce="mean"):
+    """
+    Vectorized NaN-skipping groupby reduction (same semantics as pandas groupby(...).max/sum/mean/any).
+
+    Args:
+        keys (list): key columns, each [N]; groups are sorted lexicographically by the keys
+        values (np.ndarray): values to reduce [N]
+        reduce (str): one of "max", "sum", "mean", "any"
+
+    Returns:
+        group_keys (list): unique key columns, each [num_group]
+        out (np.ndarray): reduced values [num_group]
+    """
+    codes, uniques = [], []
+    for k in keys:
+        u, c = np.unique(k, return_inverse=True)
+        uniques.append(u)
+        codes.append(c.reshape(-1))
+    dims = [len(u) for u in uniques]
+    flat = np.ravel_multi_index(codes, dims) if len(values) > 0 else np.zeros(0, dtype=np.int64)
+    group_flat, group = np.unique(flat, return_inverse=True)
+    group = group.reshape(-1)
+    group_keys = [u[c] for u, c in zip(uniques, np.unravel_index(group_flat, dims))]
+
+    num_group = len(group_flat)
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    count = np.bincount(group[valid], minlength=num_group)
+    if reduce == "max":
+        out = np.full(num_group, -np.inf)
+        np.fmax.at(out, group[valid], values[valid])
+        out[count == 0] = np.nan
+    elif reduce == "sum":
+        out = np.bincount(group[valid], weights=values[valid], minlength=num_group)
+    elif reduce == "mean":
+        total = np.bincount(group[valid], weights=values[valid], minlength=num_group)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out = total / count
+    elif reduce == "any":
+        out = np.bincount(group[valid], weights=values[valid] != 0, minlength=num_group) > 0
+    else:
+        raise ValueError("unknown reduction {}".format(reduce))
+    return group_keys, out
+
+
+class MetricAccumulator(object):
+    """
+    Append-only columnar store of per-agent, per-step metric records.
+    Each column is a preallocated numpy array that doubles when full, so appending a step
+    is amortized O(num_agents) instead of re-concatenating the whole episode.
+    """
+    def __init__(self, columns, capacity=1024):
+        self.columns = list(columns)
+        self._capacity = capacity
+        self._data = dict()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def reset(self):
+        self._data = dict()
+        self._size = 0
+
+    def append(self, **values):
+        """Append rows; scalar values are broadcast to the length of the array-valued columns."""
+        assert set(values.keys()) == set(self.columns)
+        n = max(np.size(v) for v in values.values())
+        if n == 0:
+            return
+        if self._size + n > self._capacity or len(self._data) == 0:
+            self._grow(self._size + n, values)
+        for k, v in values.items():
+            self._data[k][self._size:self._size + n] = v
+        self._size += n
+
+    def _grow(self, size, values):
+        while self._capacity < size:
+            self._capacity *= 2
+        for k, v in values.items():
+            if k in self._data:
+                old = self._data[k]
+                self._data[k] = np.empty(self._capacity, dtype=old.dtype)
+                self._data[k][:self._size] = old[:self._size]
+            else:
+                self._data[k] = np.empty(self._capacity, dtype=np.asarray(v).dtype)
+
+    def __getitem__(self, key):
+        if key not in self._data:
+            return np.zeros(0)
+        return self._data[key][:self._size]
+
+    def reduce(self, by, value, reduce="mean", where=None):
+        """Group records by the columns in @by and reduce column @value, optionally over rows in @where."""
+        keys = [self[k] for k in by]
+        values = self[value]
+        if where is not None:
+            keys = [k[where] for k in keys]
+            values = values[where]
+        return group_reduce(keys, values, reduce)
+
+    def reduce_per_scene(self, value, agent_reduce="max", where=None):
+        """
+        Reduce @value over the horizon for each (scene_index, track_id) with @agent_reduce,
+        then average over the agents of each scene. Returns [num_scene] sorted by scene_index.
+        """
+        (scene_index, _), met_by_agt = self.reduce(["scene_index", "track_id"], value, agent_reduce, where=where)
+        return group_reduce([scene_index], met_by_agt, "mean")[1]
+
+
 class OffRoadRate(EnvMetrics):
     """Compute the fraction of the time that the agent is in undrivable regions"""
     def reset(self):
-        self._df = pd.DataFrame(columns = ['scene_index', 'track_id', 'ts', "met"])
+        self._df = MetricAccumulator(['scene_index', 'track_id', 'ts', "met"])
         self._scene_ts = defaultdict(lambda:0)
 
     @staticmethod
@@ -216,23 +334,15 @@ class OffRoadRate(EnvMetrics):
 
     def add_step(self, state_info: dict, all_scene_index: np.ndarray):
         met = self.compute_per_step(state_info, all_scene_index)
-        
-        ts = np.array([self._scene_ts[sid] for sid in state_info["scene_index"]])
-        step_df = dict(scene_index=state_info["scene_index"],
-                       track_id=state_info["track_id"],
-                       ts=ts,
-                       met=met)
-        step_df = pd.DataFrame(step_df)
-        self._df = pd.concat((self._df,step_df))
-        for sid in np.unique(state_info["scene_index"]):
-            self._scene_ts[sid]+=1
+        self._df.append(scene_index=state_info["scene_index"],
+                        track_id=state_info["track_id"],
+                        ts=self._step_ts(state_info["scene_index"]),
+                        met=met)
 
     def get_episode_metrics(self):
-        # df sums and means automatically ignore nan
-        self._df.set_index(["scene_index","track_id","ts"])
-        metric_by_agt = self._df.groupby(["scene_index","track_id"])["met"].sum()
-        metric_nframe = metric_by_agt.groupby(["scene_index"]).mean().to_numpy()
-        metric_rate = self._df.groupby(["scene_index"])["met"].mean().to_numpy()
+        # sums and means ignore nan
+        metric_nframe = self._df.reduce_per_scene("met", agent_reduce="sum")
+        metric_rate = self._df.reduce(["scene_index"], "met", "mean")[1]
         return {
             "rate" : metric_rate,
             "nframe" : metric_nframe
@@ -241,7 +351,7 @@ class OffRoadRate(EnvMetrics):
 class DiskOffRoadRate(EnvMetrics):
     """Compute the fraction of the time that the agent is in undrivable regions"""
     def reset(self):
-        self._df = pd.DataFrame(columns = ['scene_index', 'track_id', 'ts', "met"])
+        self._df = MetricAccumulator(['scene_index', 'track_id', 'ts', "met"])
         self._scene_ts = defaultdict(lambda:0)
 
     @staticmethod
@@ -288,23 +398,15 @@ class DiskOffRoadRate(EnvMetrics):
 
     def add_step(self, state_info: dict, all_scene_index: np.ndarray):
         met = self.compute_per_step(state_info, all_scene_index)
-        
-        ts = np.array([self._scene_ts[sid] for sid in state_info["scene_index"]])
-        step_df = dict(scene_index=state_info["scene_index"],
-                       track_id=state_info["track_id"],
-                       ts=ts,
-                       met=met)
-        step_df = pd.DataFrame(step_df)
-        self._df = pd.concat((self._df,step_df))
-        for sid in np.unique(state_info["scene_index"]):
-            self._scene_ts[sid]+=1
+        self._df.append(scene_index=state_info["scene_index"],
+                        track_id=state_info["track_id"],
+                        ts=self._step_ts(state_info["scene_index"]),
+                        met=met)
 
     def get_episode_metrics(self):
-        # df sums and means automatically ignore nan
-        self._df.set_index(["scene_index","track_id","ts"])
-        metric_by_agt = self._df.groupby(["scene_index","track_id"])["met"].sum()
-        metric_nframe = metric_by_agt.groupby(["scene_index"]).mean().to_numpy()
-        metric_rate = self._df.groupby(["scene_index"])["met"].mean().to_numpy()
+        # sums and means ignore nan
+        metric_nframe = self._df.reduce_per_scene("met", agent_reduce="sum")
+        metric_rate = self._df.reduce(["scene_index"], "met", "mean")[1]
         return {
             "rate" : metric_rate,
             "nframe" : metric_nframe
@@ -392,53 +494,29 @@ class CollisionRate(EnvMetrics):
     """Compute collision rate across all agents in a batch of data."""
     def __init__(self):
         super(CollisionRate, self).__init__()
-        self._df = pd.DataFrame(columns = ['scene_index', 'track_id', 'ts', 'type', "met"])
-        self._scene_ts = defaultdict(lambda:0)
 
     def reset(self):
-        self._df = pd.DataFrame(columns = ['scene_index', 'track_id', 'ts', 'type', "met"])
+        self._df = MetricAccumulator(['scene_index', 'track_id', 'ts', 'type', "met"])
         self._scene_ts = defaultdict(lambda:0)
 
     @staticmethod
     def compute_per_step(state_info: dict, all_scene_index: np.ndarray):
         """Compute per-agent and per-scene collision rate and type"""
         agent_scene_index = state_info["scene_index"]
-        pos_per_scene = split_agents_by_scene(state_info["centroid"], agent_scene_index, all_scene_index)
-        yaw_per_scene = split_agents_by_scene(state_info["yaw"], agent_scene_index, all_scene_index)
-        extent_per_scene = split_agents_by_scene(state_info["extent"][..., :2], agent_scene_index, all_scene_index)
-        agent_index_per_scene = agent_index_by_scene(agent_scene_index, all_scene_index)
 
-        num_scenes = len(all_scene_index)
-        num_agents = len(agent_scene_index)
+        # all-pairs oriented box test within each scene
+        coll_type, _ = detect_collision_batch(
+            pos=state_info["centroid"],
+            yaw=state_info["yaw"],
+            extent=state_info["extent"][..., :2],
+            group=agent_scene_index,
+        )
+        coll_type[~np.isin(agent_scene_index, all_scene_index)] = -1
 
         coll_rates = dict()
         for k in CollisionType:
-            coll_rates[k] = np.zeros(num_agents)
-        coll_rates["coll_any"] = np.zeros(num_agents)
-
-        # for each scene, compute collision rate
-        for i in range(num_scenes):
-            num_agents_in_scene = pos_per_scene[i].shape[0]
-            for j in range(num_agents_in_scene):
-                other_agent_mask = np.arange(num_agents_in_scene) != j
-                valid_mask = np.logical_not(np.sum(np.isnan(pos_per_scene[i]), axis=-1) > 0)
-                if not valid_mask[j]:
-                    continue
-                other_agent_mask = np.logical_and(other_agent_mask, valid_mask)
-                if np.sum(other_agent_mask) == 0:
-                    continue
-                coll = detect_collision(
-                    ego_pos=pos_per_scene[i][j],
-                    ego_yaw=yaw_per_scene[i][j],
-                    ego_extent=extent_per_scene[i][j],
-                    other_pos=pos_per_scene[i][other_agent_mask],
-                    other_yaw=yaw_per_scene[i][other_agent_mask],
-                    other_extent=extent_per_scene[i][other_agent_mask]
-                )
-                
-                if coll is not None:
-                    coll_rates[coll[0]][agent_index_per_scene[i][j]] = 1.
-                    coll_rates["coll_any"][agent_index_per_scene[i][j]] = 1.
+            coll_rates[k] = (coll_type == k.value).astype(np.float64)
+        coll_rates["coll_any"] = (coll_type >= 0).astype(np.float64)
 
         # compute per-scene collision counts (for visualization purposes)
         coll_counts = dict()
@@ -455,46 +533,31 @@ class CollisionRate(EnvMetrics):
     def add_step(self, state_info: dict, all_scene_index: np.ndarray):
         
         met_all, _ = self.compute_per_step(state_info, all_scene_index)
-        ts = np.array([self._scene_ts[sid] for sid in state_info["scene_index"]])
-        step_df = []
+        ts = self._step_ts(state_info["scene_index"])
         for k in met_all:
-            if k=="coll_any":
-                type=-1
-            else:
-                type=k
-            step_df_k = dict(scene_index=state_info["scene_index"],
-                        track_id=state_info["track_id"],
-                        ts=ts,
-                        type=type,
-                        met=met_all[k])
-            step_df.append(pd.DataFrame(step_df_k))
-        step_df = pd.concat(step_df)
-        self._df = pd.concat((self._df,step_df))
-        for sid in np.unique(state_info["scene_index"]):
-            self._scene_ts[sid]+=1
+            # coll_any is stored with type -1
+            self._df.append(scene_index=state_info["scene_index"],
+                            track_id=state_info["track_id"],
+                            ts=ts,
+                            type=-1 if k == "coll_any" else int(k),
+                            met=met_all[k])
 
     def get_episode_metrics(self):
-
-        self._df.set_index(["scene_index","track_id","type","ts"])
-        coll_whole_horizon = self._df.groupby(["scene_index","track_id","type"])["met"].max()
+        # max over the horizon for each agent, then mean over the agents of each scene
+        coll_type = self._df["type"]
         met_all = dict()
-        
         for k in CollisionType:
-            coll_data = coll_whole_horizon[coll_whole_horizon.index.isin([k],level=2)]
-            met_all[str(k)] = coll_data.groupby(["scene_index"]).mean().to_numpy()
-        coll_data = coll_whole_horizon[coll_whole_horizon.index.isin([-1],level=2)]
-        met_all["coll_any"] = coll_data.groupby(["scene_index"]).mean().to_numpy()
+            met_all[str(k)] = self._df.reduce_per_scene("met", agent_reduce="max", where=coll_type == int(k))
+        met_all["coll_any"] = self._df.reduce_per_scene("met", agent_reduce="max", where=coll_type == -1)
         return met_all
 
 class DiskCollisionRate(EnvMetrics):
     """Compute collision rate across all agents in a batch of data."""
     def __init__(self):
         super(DiskCollisionRate, self).__init__()
-        self._df = pd.DataFrame(columns = ['scene_index', 'track_id', 'ts', 'type', "met"])
-        self._scene_ts = defaultdict(lambda:0)
 
     def reset(self):
-        self._df = pd.DataFrame(columns = ['scene_index', 'track_id', 'ts', 'type', "met"])
+        self._df = MetricAccumulator(['scene_index', 'track_id', 'ts', 'type', "met"])
         self._scene_ts = defaultdict(lambda:0)
 
     @staticmethod
@@ -548,46 +611,31 @@ class DiskCollisionRate(EnvMetrics):
     def add_step(self, state_info: dict, all_scene_index: np.ndarray):
         
         met_all, _ = self.compute_per_step(state_info, all_scene_index)
-        ts = np.array([self._scene_ts[sid] for sid in state_info["scene_index"]])
-        step_df = []
+        ts = self._step_ts(state_info["scene_index"])
         for k in met_all:
-            if k=="coll_any":
-                type=-1
-            else:
-                type=k
-            step_df_k = dict(scene_index=state_info["scene_index"],
-                        track_id=state_info["track_id"],
-                        ts=ts,
-                        type=type,
-                        met=met_all[k])
-            step_df.append(pd.DataFrame(step_df_k))
-        step_df = pd.concat(step_df)
-        self._df = pd.concat((self._df,step_df))
-        for sid in np.unique(state_info["scene_index"]):
-            self._scene_ts[sid]+=1
+            # coll_any is stored with type -1
+            self._df.append(scene_index=state_info["scene_index"],
+                            track_id=state_info["track_id"],
+                            ts=ts,
+                            type=-1 if k == "coll_any" else int(k),
+                            met=met_all[k])
 
     def get_episode_metrics(self):
-
-        self._df.set_index(["scene_index","track_id","type","ts"])
-        coll_whole_horizon = self._df.groupby(["scene_index","track_id","type"])["met"].max()
+        # max over the horizon for each agent, then mean over the agents of each scene
+        coll_type = self._df["type"]
         met_all = dict()
-        
         for k in CollisionType:
-            coll_data = coll_whole_horizon[coll_whole_horizon.index.isin([k],level=2)]
-            met_all[str(k)] = coll_data.groupby(["scene_index"]).mean().to_numpy()
-        coll_data = coll_whole_horizon[coll_whole_horizon.index.isin([-1],level=2)]
-        met_all["coll_any"] = coll_data.groupby(["scene_index"]).mean().to_numpy()
+            met_all[str(k)] = self._df.reduce_per_scene("met", agent_reduce="max", where=coll_type == int(k))
+        met_all["coll_any"] = self._df.reduce_per_scene("met", agent_reduce="max", where=coll_type == -1)
         return met_all
 
 class CriticalFailure(EnvMetrics):
     """Metrics that report failures caused by either collision or offroad"""
     def __init__(self, num_collision_frames=1, num_offroad_frames=3):
         super(CriticalFailure, self).__init__()
-        self._df = pd.DataFrame(columns=["scene_index","track_id","ts","offroad","collision"])
-        self._scene_ts = defaultdict(lambda:0)
 
     def reset(self):
-        self._df = pd.DataFrame(columns=["scene_index","track_id","ts","offroad","collision"])
+        self._df = MetricAccumulator(["scene_index","track_id","ts","offroad","collision"])
         self._scene_ts = defaultdict(lambda:0)
 
 
@@ -596,20 +644,26 @@ class CriticalFailure(EnvMetrics):
             offroad=OffRoadRate.compute_per_step(state_info, all_scene_index),
             collision=CollisionRate.compute_per_step(state_info, all_scene_index)[0]["coll_any"]
         )
-        ts = np.array([self._scene_ts[sid] for sid in state_info["scene_index"]])
-        step_df = dict(scene_index=state_info["scene_index"],
-                       track_id=state_info["track_id"],
-                       ts=ts,
-                       offroad=met_all["offroad"],
-                       collision = met_all["collision"])
-        step_df = pd.DataFrame(step_df)
-        self._df = pd.concat((self._df,step_df))
-        for sid in np.unique(state_info["scene_index"]):
-            self._scene_ts[sid]+=1
+        self._df.append(scene_index=state_info["scene_index"],
+                        track_id=state_info["track_id"],
+                        ts=self._step_ts(state_info["scene_index"]),
+                        offroad=met_all["offroad"],
+                        collision=met_all["collision"])
     
+    def get_failed_agents(self):
+        """(scene_index, track_id) of the agents that collided or went off-road at any step"""
+        (scene_index, track_id), coll_fail_cases = self._df.reduce(["scene_index","track_id"], "collision", "any")
+        _, offroad_fail_cases = self._df.reduce(["scene_index","track_id"], "offroad", "any")
+        failed = coll_fail_cases | offroad_fail_cases
+        return scene_index[failed], track_id[failed]
+
     def get_per_agent_metrics(self):
-        coll_fail_cases = self._df.groupby(["scene_index","track_id"])["collision"].any()
-        offroad_fail_cases = self._df.groupby(["scene_index","track_id"])["offroad"].any()
+        """Whether each agent failed at any step, indexed by (scene_index, track_id)"""
+        agent_index, coll_fail_cases = self._df.reduce(["scene_index","track_id"], "collision", "any")
+        _, offroad_fail_cases = self._df.reduce(["scene_index","track_id"], "offroad", "any")
+        index = pd.MultiIndex.from_arrays(agent_index, names=["scene_index","track_id"])
+        coll_fail_cases = pd.Series(coll_fail_cases, index=index)
+        offroad_fail_cases = pd.Series(offroad_fail_cases, index=index)
         any_fail_cases = coll_fail_cases|offroad_fail_cases
         return dict(offroad=offroad_fail_cases,collision=coll_fail_cases,any=any_fail_cases)
 
@@ -618,15 +672,12 @@ class CriticalFailure(EnvMetrics):
         num_steps = len(self)
         grid_points = np.arange(5,num_steps,5)
 
-        coll_fail_cases = self._df.groupby(["scene_index","track_id"])["collision"].any()
-        coll_by_scene = coll_fail_cases.groupby(["scene_index"])
-        coll_fail_rate = (coll_by_scene.sum()/coll_by_scene.count()).to_numpy()
-        offroad_fail_cases = self._df.groupby(["scene_index","track_id"])["offroad"].any()
-        offroad_by_scene = offroad_fail_cases.groupby(["scene_index"])
-        offroad_fail_rate = (offroad_by_scene.sum()/offroad_by_scene.count()).to_numpy()
+        (scene_index, _), coll_fail_cases = self._df.reduce(["scene_index","track_id"], "collision", "any")
+        _, offroad_fail_cases = self._df.reduce(["scene_index","track_id"], "offroad", "any")
         any_fail_cases = coll_fail_cases | offroad_fail_cases
-        any_fail_by_scene = any_fail_cases.groupby(["scene_index"])
-        any_fail_rate = (any_fail_by_scene.sum()/any_fail_by_scene.count()).to_numpy()
+        coll_fail_rate = group_reduce([scene_index], coll_fail_cases, "mean")[1]
+        offroad_fail_rate = group_reduce([scene_index], offroad_fail_cases, "mean")[1]
+        any_fail_rate = group_reduce([scene_index], any_fail_cases, "mean")[1]
 
         met = dict(failure_offroad=offroad_fail_rate,failure_collision=coll_fail_rate,failure_any=any_fail_rate)
         # for t in grid_points:
@@ -646,6 +697,130 @@ class CriticalFailure(EnvMetrics):
         return met
 
 
+class FusedStepMetrics(EnvMetrics):
+    """
+    Off-road, disk off-road, collision, disk collision, critical failure and (optionally) semantic layer
+    metrics evaluated together in one batched pass per step.
+
+    The raster stack and its drivable map are moved to @device once per observation (sub-steps that share
+    the observation the policy was queried with reuse them), map-based results stay on the device, and
+    they are copied to host once when the episode metrics are computed. The output keys are the ones the
+    separate metrics would produce, prefixed with their usual names (e.g. "off_road_rate_rate").
+    """
+    NUM_DEVICE_COLS = 3  # offroad, disk offroad, disk collision
+
+    def __init__(self, device="cpu", sem_layers=False):
+        self.device = torch.device(device)
+        self.sem_layers = sem_layers
+        self._map_src = None
+        self._map = None
+        super(FusedStepMetrics, self).__init__()
+
+    def reset(self):
+        self._df = MetricAccumulator(["scene_index", "track_id", "ts", "coll_type"])
+        self._scene_ts = defaultdict(lambda:0)
+        self._device_records = []
+
+    def _get_map(self, image):
+        """semantic layers and drivable region of @image on device, cached while the observation is unchanged"""
+        if image is not self._map_src:
+            sem_map = torch.as_tensor(image, device=self.device)
+            drivable_region = batch_utils().get_drivable_region_map(sem_map)
+            self._map_src = image
+            self._map = (sem_map, drivable_region)
+        return self._map
+
+    def compute_device_step(self, state_info: dict, all_scene_index: np.ndarray):
+        """Map-based and disk collision metrics of one step, [num_agents, 3 (+ num_layers + 1)] on device"""
+        sem_map, drivable_region = self._get_map(state_info["image"])
+        to_device = lambda x: torch.as_tensor(x, device=self.device)
+        centroid = to_device(state_info["centroid"]).float()
+        extent = to_device(state_info["extent"][..., :2]).float()
+        raster_from_world = to_device(state_info["raster_from_world"]).float()
+        agent_scene_index = to_device(state_info["scene_index"])
+        in_scene = to_device(np.isin(state_info["scene_index"], all_scene_index))
+        nan = torch.full_like(centroid[:, 0], np.nan)
+
+        # invalid agents are evaluated at a dummy location and masked out afterwards,
+        #   so no data-dependent indexing (and device sync) is needed
+        centroid_raster = transform_points_tensor(centroid[:, None], raster_from_world)[:, 0]
+        valid = ~torch.isnan(centroid_raster).any(dim=-1)
+        centroid_raster = torch.where(valid[:, None], centroid_raster, torch.zeros_like(centroid_raster))
+        extent_raster = torch.nan_to_num(get_raster_pix2m() * extent)
+
+        off_road = Metrics.batch_detect_off_road(centroid_raster.clone(), drivable_region)
+        disk_off_road = Metrics.batch_detect_off_road_disk(centroid_raster, extent_raster, drivable_region)
+
+        # disk collision between valid agents of the same scene
+        pos_valid = ~torch.isnan(centroid).any(dim=-1)
+        rad = torch.fmin(extent[:, 0], extent[:, 1]) / 2.0
+        dist = torch.cdist(torch.nan_to_num(centroid)[None], torch.nan_to_num(centroid)[None])[0]
+        candidate = (agent_scene_index[:, None] == agent_scene_index[None]) & pos_valid[:, None] & pos_valid[None]
+        candidate.fill_diagonal_(False)
+        disk_coll = ((dist < rad[:, None] + rad[None]) & candidate).any(dim=-1) & in_scene
+
+        cols = [torch.where(valid, off_road, nan), torch.where(valid, disk_off_road, nan), disk_coll.float()]
+        if self.sem_layers:
+            # value of every layer at the centroid pixel, plus whether it is on no layer at all
+            _, _, h, w = sem_map.shape
+            px = centroid_raster[:, 0].round().clamp(0, w - 1).long()
+            py = centroid_raster[:, 1].round().clamp(0, h - 1).long()
+            on_layers = sem_map[torch.arange(sem_map.shape[0], device=self.device), :, py, px].bool()
+            on_layers = torch.cat((on_layers, ~on_layers.any(dim=-1, keepdim=True)), dim=-1).float()
+            cols.append(torch.where(valid[:, None], on_layers, nan[:, None]))
+        return torch.cat([c.reshape(c.shape[0], -1) for c in cols], dim=-1)
+
+    def add_step(self, state_info: dict, all_scene_index: np.ndarray):
+        # oriented box collision only needs the agent states, which are already on host
+        coll_type, _ = detect_collision_batch(
+            pos=state_info["centroid"],
+            yaw=state_info["yaw"],
+            extent=state_info["extent"][..., :2],
+            group=state_info["scene_index"],
+        )
+        coll_type[~np.isin(state_info["scene_index"], all_scene_index)] = -1
+        self._df.append(scene_index=state_info["scene_index"],
+                        track_id=state_info["track_id"],
+                        ts=self._step_ts(state_info["scene_index"]),
+                        coll_type=coll_type)
+        self._device_records.append(self.compute_device_step(state_info, all_scene_index))
+
+    def get_episode_metrics(self):
+        device_met = TensorUtils.to_numpy(torch.cat(self._device_records, dim=0)).astype(np.float64)
+        keys = [self._df["scene_index"], self._df["track_id"]]
+
+        def reduce_per_scene(value, agent_reduce):
+            (scene_index, _), met_by_agt = group_reduce(keys, value, agent_reduce)
+            return group_reduce([scene_index], met_by_agt, "mean")[1]
+
+        met = dict()
+        for name, value in (("off_road_rate", device_met[:, 0]), ("disk_off_road_rate", device_met[:, 1])):
+            met[name + "_rate"] = group_reduce(keys[:1], value, "mean")[1]
+            met[name + "_nframe"] = reduce_per_scene(value, "sum")
+
+        coll_type = self._df["coll_type"]
+        coll_any = (coll_type >= 0).astype(np.float64)
+        for k in CollisionType:
+            met["collision_rate_" + str(k)] = reduce_per_scene((coll_type == int(k)).astype(np.float64), "max")
+            met["disk_collision_rate_" + str(k)] = reduce_per_scene(np.zeros(len(coll_type)), "max")
+        met["collision_rate_coll_any"] = reduce_per_scene(coll_any, "max")
+        met["disk_collision_rate_coll_any"] = reduce_per_scene(device_met[:, 2], "max")
+
+        (scene_index, _), coll_fail_cases = group_reduce(keys, coll_any, "any")
+        _, offroad_fail_cases = group_reduce(keys, device_met[:, 0], "any")
+        any_fail_cases = coll_fail_cases | offroad_fail_cases
+        met["failure_failure_offroad"] = group_reduce([scene_index], offroad_fail_cases, "mean")[1]
+        met["failure_failure_collision"] = group_reduce([scene_index], coll_fail_cases, "mean")[1]
+        met["failure_failure_any"] = group_reduce([scene_index], any_fail_cases, "mean")[1]
+
+        if self.sem_layers:
+            num_layers = device_met.shape[1] - self.NUM_DEVICE_COLS - 1
+            for li in range(num_layers + 1):
+                layer_str = "no_layer" if li == num_layers else "layer%02d" % (li)
+                met["sem_layer_rate_" + layer_str] = reduce_per_scene(device_met[:, self.NUM_DEVICE_COLS + li], "mean")
+        return met
+
+
 class LearnedMetric(EnvMetrics):
     def __init__(self, metric_algo, perturbations=None):
         super(LearnedMetric, self).__init__()
@@ -974,19 +1149,33 @@ def obtain_active_agent_index(state_buffer):
     return appearance_idx.astype(np.int32)
 
 
+def pack_grid_index(XYi):
+    """Pack integer grid coordinates [..., 2] into int64 keys [...]."""
+    XYi = XYi.astype(np.int64)
+    return (XYi[..., 0] << 32) | (XYi[..., 1] & 0xffffffff)
+
+
+def unpack_grid_index(keys):
+    """Inverse of pack_grid_index."""
+    xi = keys >> 32
+    yi = ((keys & 0xffffffff) ^ 0x80000000) - 0x80000000
+    return np.stack((xi, yi), -1)
+
+
 class OccupancyGrid():
     def __init__(self,gridinfo,sigma=1.0):
         """Estimate occupancy with kernel density estimation under a Gaussian RBF kernel
 
+        Cells are kept as a sorted array of packed (xi, yi) keys with aligned occupancy and lane flag arrays,
+        and the (episode, agent) ids that visited each cell as deduplicated (key, episode, agent) rows.
+
         Args:
             gridinfo (dict): grid offset, grid step size
             sigma (float): std for the RBF kernel
         """
         self.gridinfo = gridinfo
         self.sigma = sigma
-        self.occupancy_grid = defaultdict(lambda: 0)
-        self.lane_flag = defaultdict(lambda: 0)
-        self.agent_ids = defaultdict(lambda: set())
+        self.reset()
 
     def get_neighboring_grid_points(self,coords,radius):
         
@@ -1009,10 +1198,27 @@ class OccupancyGrid():
         return grid_points.reshape(bs,-1,2),XYi.reshape(bs,-1,2),kernel_value.reshape(bs,-1)
 
     def reset(self):
-        self.occupancy_grid.clear()
-        self.lane_flag.clear()
-        self.agent_ids.clear()
-    
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.occupancy = np.zeros(0)
+        self.lanes = np.zeros(0)
+        self._visits = np.zeros((0, 3), dtype=np.int64)
+        self._num_compact_visits = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def grid_index(self):
+        """integer (xi, yi) coordinates of the occupied cells [num_cells, 2]"""
+        return unpack_grid_index(self.keys)
+
+    def lookup(self, keys, values, fill_value=0):
+        """Values of this grid's cells at packed @keys, @fill_value for cells not in the grid."""
+        if len(self.keys) == 0:
+            return np.full(len(keys), fill_value, dtype=values.dtype)
+        idx = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+        return np.where(self.keys[idx] == keys, values[idx], fill_value)
+
     def obtain_lane_flag(self,grid_points,raster_from_world,lane_map):
         raster_points = GeoUtils.batch_nd_transform_points_np(grid_points,raster_from_world)
         # hacky conversion of nan to 0
@@ -1020,40 +1226,234 @@ class OccupancyGrid():
         raster_points = raster_points.astype(np.int32)
         raster_points[...,0] = raster_points[...,0].clip(0,lane_map.shape[-2]-1)
         raster_points[...,1] = raster_points[...,1].clip(0,lane_map.shape[-1]-1)
-        lane_flag = list()
-        
-        for k in range(raster_points.shape[0]):
-            lane_flag.append(np.array([lane_map[k,y,x] for x,y in zip(raster_points[k,:,0],raster_points[k,:,1])]))
-        lane_flag = np.stack(lane_flag,0)
+        batch_index = np.arange(raster_points.shape[0])[:, None]
+        lane_flag = lane_map[batch_index, raster_points[..., 1], raster_points[..., 0]]
         # clear_flag = (raster_points[:,0]>=0) & (raster_points[:,0]<drivable_area_map.shape[0])& (raster_points[:,1]>=0) & (raster_points[:,1]<drivable_area_map.shape[1])
         return lane_flag
 
     def update(self, coords, raster_from_world, lane_map, agent_ids, episode_index, threshold=0.1,weight=1):
         assert threshold<1.0
+        if coords.shape[0] == 0:
+            return
         radius = np.sqrt(-2*self.sigma*np.log(threshold))
         grid_points,XYi,kernel_value = self.get_neighboring_grid_points(coords,radius)
         lane_flag = self.obtain_lane_flag(grid_points,raster_from_world,lane_map)
         agent_ids = np.repeat(agent_ids[:, None], axis=1, repeats=grid_points.shape[1])
 
-        XYi_flatten = XYi.reshape(-1,2)
-        lane_flag_flatten = lane_flag.flatten()
-        kernel_value_flatten = kernel_value.flatten()
-        agent_ids = agent_ids.flatten()
-        for i in range(XYi_flatten.shape[0]):
-            self.occupancy_grid[(XYi_flatten[i,0],XYi_flatten[i,1])] += weight*kernel_value_flatten[i]
-            self.lane_flag[(XYi_flatten[i,0],XYi_flatten[i,1])] = lane_flag_flatten[i]
-            self.agent_ids[(XYi_flatten[i,0],XYi_flatten[i,1])].add((episode_index, agent_ids[i]))
-    
+        step_keys = pack_grid_index(XYi).reshape(-1)
+        lane_flag_flatten = lane_flag.reshape(-1)
+        kernel_value_flatten = kernel_value.reshape(-1)
+        agent_ids = agent_ids.reshape(-1)
+
+        # merge new cells into the sorted key array
+        self.keys, inv = np.unique(np.concatenate((self.keys, step_keys)), return_inverse=True)
+        inv = inv.reshape(-1)
+        old_idx, step_idx = inv[:len(self.occupancy)], inv[len(self.occupancy):]
+        occupancy = np.zeros(len(self.keys))
+        occupancy[old_idx] = self.occupancy
+        lanes = np.zeros(len(self.keys))
+        lanes[old_idx] = self.lanes
+
+        occupancy += np.bincount(step_idx, weights=weight*kernel_value_flatten, minlength=len(self.keys))
+        # the last sample that falls in a cell sets its lane flag
+        rev_idx, last = np.unique(step_idx[::-1], return_index=True)
+        lanes[rev_idx] = lane_flag_flatten[::-1][last]
+        self.occupancy, self.lanes = occupancy, lanes
+
+        visits = np.stack((step_keys, np.full_like(step_keys, episode_index), agent_ids.astype(np.int64)), -1)
+        self._visits = np.concatenate((self._visits, visits))
+        if len(self._visits) > 2 * self._num_compact_visits + 4096:
+            self._compact_visits()
+
+    def _compact_visits(self):
+        self._visits = np.unique(self._visits, axis=0)
+        self._num_compact_visits = len(self._visits)
+
+    def agent_ids_csr(self):
+        """
+        (episode, agent) ids that visited each cell, as a CSR index aligned with self.keys.
+
+        Returns:
+            indptr (np.ndarray): [num_cells + 1], ids of cell i are in [indptr[i], indptr[i+1])
+            episode_index (np.ndarray): [num_visits]
+            agent_ids (np.ndarray): [num_visits]
+        """
+        self._compact_visits()
+        # visits are sorted by key, and every visited key is in self.keys
+        counts = np.bincount(np.searchsorted(self.keys, self._visits[:, 0]), minlength=len(self.keys))
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        return indptr, self._visits[:, 1], self._visits[:, 2]
+
     def visualize(self):
         fig, ax = plt.subplots(figsize=(20, 20))
-        for k in self.occupancy_grid.keys():
-            color = "gx" if self.lane_flag[k] else "ro"
-            xyi = np.array(k)
-            xy = xyi*self.gridinfo["step"]+self.gridinfo["offset"]
-            ax.plot(xy[1],xy[0],color)
+        xy = self.grid_index*self.gridinfo["step"]+self.gridinfo["offset"]
+        ax.plot(xy[self.lanes > 0, 1], xy[self.lanes > 0, 0], "gx")
+        ax.plot(xy[self.lanes == 0, 1], xy[self.lanes == 0, 0], "ro")
         plt.show()
 
 
+def _row_codes(*cols):
+    """Dense codes of the unique rows of the integer columns @cols, and the unique rows themselves."""
+    rows = np.stack([np.asarray(c, dtype=np.int64) for c in cols], -1)
+    uniques, codes = np.unique(rows.reshape(-1, len(cols)), axis=0, return_inverse=True)
+    return codes.reshape(-1), uniques
+
+
+class OccupancyReducer(object):
+    """
+    Batched reduction of occupancy coverage, failures and diversity.
+
+    Everything is kept in flat per-row arrays:
+        cells: (scene, episode, cell key) -> occupancy weight, lane flag
+        visits: (scene, episode, cell key, track id) of every agent that visited a cell
+        failures: (scene, episode, track id) of every failed agent
+    so coverage and failure filtering are computed for all scenes in one vectorized pass, and partial
+    reducers (e.g. built by separate worker processes) can be merged with merge() or from_state_dict().
+    """
+    CELL_COLS = ("scene", "episode", "key", "occupancy", "lane")
+    VISIT_COLS = ("scene", "episode", "key", "track")
+    FAILURE_COLS = ("scene", "episode", "track")
+
+    def __init__(self, gridinfo, threshold=1e-2):
+        self.gridinfo = gridinfo
+        self.threshold = threshold
+        self.num_episodes = 0
+        self.cells = {k: np.zeros(0, dtype=np.float64 if k in ("occupancy", "lane") else np.int64) for k in self.CELL_COLS}
+        self.visits = {k: np.zeros(0, dtype=np.int64) for k in self.VISIT_COLS}
+        self.failures = {k: np.zeros(0, dtype=np.int64) for k in self.FAILURE_COLS}
+
+    @staticmethod
+    def _extend(table, **values):
+        n = max(np.size(v) for v in values.values())
+        for k, v in values.items():
+            table[k] = np.concatenate((table[k], np.broadcast_to(v, (n,)).astype(table[k].dtype)))
+
+    def add_grid(self, scene_index, episode_index, grid):
+        """Add the cells and visits of OccupancyGrid @grid; visits keep the episode indices recorded by the grid."""
+        self._extend(self.cells, scene=scene_index, episode=episode_index, key=grid.keys,
+                     occupancy=grid.occupancy, lane=grid.lanes)
+        grid._compact_visits()
+        self._extend(self.visits, scene=scene_index, episode=grid._visits[:, 1], key=grid._visits[:, 0],
+                     track=grid._visits[:, 2])
+        self.num_episodes = max(self.num_episodes, episode_index + 1, int(grid._visits[:, 1].max(initial=-1)) + 1)
+
+    def add_failures(self, episode_index, scene_index, track_id):
+        """Add the failed agents (scene_index[i], track_id[i]) of episode @episode_index"""
+        self._extend(self.failures, scene=scene_index, episode=episode_index, track=track_id)
+        self.num_episodes = max(self.num_episodes, episode_index + 1)
+
+    def merge(self, other):
+        """Append the rows of reducer @other, with its episodes numbered after the episodes of this one."""
+        offset = self.num_episodes
+        for mine, theirs in ((self.cells, other.cells), (self.visits, other.visits), (self.failures, other.failures)):
+            theirs = dict(theirs, episode=theirs["episode"] + offset)
+            self._extend(mine, **theirs)
+        self.num_episodes += other.num_episodes
+        return self
+
+    def state_dict(self):
+        state = dict(threshold=self.threshold, num_episodes=self.num_episodes,
+                     grid_offset=self.gridinfo["offset"], grid_step=self.gridinfo["step"])
+        for name in ("cells", "visits", "failures"):
+            state.update({name + "/" + k: v for k, v in getattr(self, name).items()})
+        return state
+
+    @classmethod
+    def from_state_dict(cls, *states):
+        """Reducer with the merged rows of one or more state dicts (e.g. loaded with np.load)."""
+        gridinfo = {"offset": np.asarray(states[0]["grid_offset"]), "step": np.asarray(states[0]["grid_step"])}
+        reducer = cls(gridinfo, threshold=float(states[0]["threshold"]))
+        for state in states:
+            part = cls(gridinfo, threshold=reducer.threshold)
+            part.num_episodes = int(state["num_episodes"])
+            for name in ("cells", "visits", "failures"):
+                table = getattr(part, name)
+                for k in table:
+                    table[k] = np.asarray(state[name + "/" + k], dtype=table[k].dtype)
+            reducer.merge(part)
+        return reducer
+
+    def visit_success(self):
+        """Whether each visit row was made by an agent that did not fail in its episode [num_visits]"""
+        v, f = self.visits, self.failures
+        codes, _ = _row_codes(np.concatenate((v["scene"], f["scene"])),
+                              np.concatenate((v["episode"], f["episode"])),
+                              np.concatenate((v["track"], f["track"])))
+        num_visits = len(v["track"])
+        return ~np.isin(codes[:num_visits], codes[num_visits:])
+
+    def coverage(self):
+        """
+        Number of cells covered (occupancy > threshold) in each scene, accumulated over all episodes.
+
+        Returns:
+            scene_index (np.ndarray): [num_scene], sorted
+            coverage_num (OrderedDict): total / onroad / success coverage counts, each [num_scene]
+        """
+        c, v = self.cells, self.visits
+        num_cells = len(c["key"])
+        codes, uniques = _row_codes(np.concatenate((c["scene"], v["scene"])), np.concatenate((c["key"], v["key"])))
+        cell_code, visit_code = codes[:num_cells], codes[num_cells:]
+        num_group = len(uniques)
+
+        occupancy = np.bincount(cell_code, weights=c["occupancy"], minlength=num_group)
+        # the lane flag of the latest episode that touched a cell wins
+        order = np.lexsort((c["episode"], cell_code))
+        last = np.ones(num_cells, dtype=bool)
+        last[:-1] = cell_code[order][1:] != cell_code[order][:-1]
+        lane = np.zeros(num_group)
+        lane[cell_code[order][last]] = c["lane"][order][last]
+        # if any of the successful agent in any episode covers a grid, count it as a successful coverage
+        # conversely, if all the agents that cover the grid ended up failing, do not count the coverage.
+        success = np.bincount(visit_code, weights=self.visit_success(), minlength=num_group) > 0
+
+        scene_index, group_scene = np.unique(uniques[:, 0], return_inverse=True)
+        group_scene = group_scene.reshape(-1)
+        count = lambda mask: np.bincount(group_scene, weights=mask, minlength=len(scene_index)).astype(np.int64)
+        coverage_num = OrderedDict(
+            total=count(occupancy > self.threshold),
+            onroad=count(occupancy * lane > self.threshold),
+            success=count(occupancy * lane * success > self.threshold),
+        )
+        return scene_index, coverage_num
+
+    def diversity(self, filter_failures=True):
+        """
+        Mean pairwise Wasserstein distance between the on-road occupancy distributions of the episodes of each scene.
+        With @filter_failures, cells only visited by failed agents of an episode are dropped from that episode's distribution.
+
+        Returns:
+            scene_index (np.ndarray): [num_scene], sorted
+            diversity (np.ndarray): [num_scene]
+        """
+        c, v = self.cells, self.visits
+        scene_index = np.unique(c["scene"])
+        success = self.visit_success() if filter_failures else None
+        result = np.zeros(len(scene_index))
+        for si, scene in enumerate(scene_index):
+            cell_sel = c["scene"] == scene
+            keys, key_code = np.unique(c["key"][cell_sel], return_inverse=True)
+            episodes, epi_code = np.unique(c["episode"][cell_sel], return_inverse=True)
+            key_code, epi_code = key_code.reshape(-1), epi_code.reshape(-1)
+            flat = epi_code * len(keys) + key_code
+            distr = np.bincount(flat, weights=c["occupancy"][cell_sel] * c["lane"][cell_sel],
+                                minlength=len(episodes) * len(keys)).reshape(len(episodes), len(keys))
+            if filter_failures:
+                visit_sel = (v["scene"] == scene) & np.isin(v["key"], keys) & np.isin(v["episode"], episodes)
+                visit_flat = np.searchsorted(episodes, v["episode"][visit_sel]) * len(keys) + \
+                    np.searchsorted(keys, v["key"][visit_sel])
+                ok = np.bincount(visit_flat, weights=success[visit_sel], minlength=distr.size) > 0
+                distr = distr * ok.reshape(distr.shape)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                distr = distr / distr.sum(axis=1, keepdims=True)
+
+            coords = unpack_grid_index(keys)*self.gridinfo["step"]+self.gridinfo["offset"]
+            distance_matrix = np.linalg.norm(coords[:, None] - coords[None], axis=-1)
+            wasser_dis = [emd(distr[i], distr[j], distance_matrix) for i in range(len(episodes)) for j in range(i)]
+            result[si] = np.mean(wasser_dis) if len(wasser_dis) > 0 else np.nan
+        return scene_index, result
+
+
 class Occupancymet(EnvMetrics):
     def __init__(self, gridinfo, sigma=1.0):
         self.og = dict()
@@ -1116,34 +1516,21 @@ class OccupancyCoverage(Occupancymet):
         self._episode_started = True
         self.failure_metric[-1].add_step(state_info, all_scene_index)
 
-    def summarize_grid(self):
-        failed_agent_ids = []
-        failed_scene_index = []
+    def get_reducer(self):
+        """OccupancyReducer with the grids and failed agents of all episodes so far"""
         assert self.episode_index + 1 == len(self.failure_metric)
-        for fm in self.failure_metric:
-            per_agent_failure = fm.get_per_agent_metrics()["any"]
-            fail_index = per_agent_failure[per_agent_failure==True].index
-            failed_scene_index.append(fail_index.get_level_values("scene_index").to_numpy())
-            failed_agent_ids.append(fail_index.get_level_values("track_id").to_numpy())
-
-        coverage_num = OrderedDict(total=[], onroad=[], success=[])
+        reducer = OccupancyReducer(self.gridinfo, threshold=self.threshold)
         for scene_idx, og in self.og.items():
-            data = np.array(list(og.occupancy_grid.values()))
-            lane = np.array(list(og.lane_flag.values())).astype(np.float32)
-            success_mask = np.zeros_like(lane).astype(bool)
-            for i, ep_aid in enumerate(og.agent_ids.values()):
-                # if any of the successful agent in any episode covers a grid, count it as a successful coverage
-                # conversely, if all the agents that cover the grid ended up failing, do not count the coverage.
-                for (epi, aid) in ep_aid:
-                    failed_agent_ids_in_scene = failed_agent_ids[epi][failed_scene_index[epi] == scene_idx]
-                    success_mask[i] = success_mask[i] or (aid not in failed_agent_ids_in_scene)
-            data_onroad = data * lane
-            data_success = data * lane * success_mask.astype(np.float32)
-            coverage_num["onroad"].append((data_onroad > self.threshold).sum())
-            coverage_num["success"].append((data_success > self.threshold).sum())
-            coverage_num["total"].append((data > self.threshold).sum())
-
-        return {k: np.array(v) for k, v in coverage_num.items()}
+            reducer.add_grid(scene_idx, self.episode_index, og)
+        for epi, fm in enumerate(self.failure_metric):
+            reducer.add_failures(epi, *fm.get_failed_agents())
+        return reducer
+
+    def summarize_grid(self):
+        scene_index, coverage_num = self.get_reducer().coverage()
+        # report in the order the scenes were first seen
+        order = np.searchsorted(scene_index, np.array(list(self.og.keys()), dtype=scene_index.dtype))
+        return {k: v[order] for k, v in coverage_num.items()}
 
     def get_multi_episode_metrics(self):
         return self.summarize_grid()
@@ -1183,35 +1570,20 @@ class OccupancyDiversity(Occupancymet):
                 coords=coords[indices],
                 raster_from_world=state_info["raster_from_world"][indices],
                 lane_map=drivable_area[indices],
-                agent_ids=state_info["track_id"],
+                agent_ids=state_info["track_id"][indices],
                 episode_index=self.episode_index,
                 threshold=0.1,
                 weight=1
             )
 
     def get_multi_episode_metrics(self):
-        result = []
-        for scene_index in self.og:
-            keys_union = set()
-            distr = list()
-            for og in self.og[scene_index]:
-                keys_union = keys_union.union(set(og.occupancy_grid.keys()))
-                
-            coords = np.array(list(keys_union))*self.gridinfo["step"]+self.gridinfo["offset"]
-            coords = np.tile(coords,(coords.shape[0],1,1))
-            distance_matrix = np.linalg.norm(coords-coords.transpose(1,0,2),axis=2)
-            wasser_dis = np.array([])
-            for og in self.og[scene_index]:
-                distr_i = np.array([og.occupancy_grid[k] for k in keys_union])
-                lane_flag = np.array([og.lane_flag[k] for k in keys_union])
-                distr_i = distr_i*lane_flag
-                distr_i = distr_i/distr_i.sum()
-                for distr_j in distr:
-                    wasser_dis = np.append(wasser_dis,emd(distr_i, distr_j, distance_matrix))
-                distr.append(distr_i)
-            result.append(wasser_dis.mean())
-            print("Wasserstein metric:",wasser_dis)
-        return np.array(result)
+        reducer = OccupancyReducer(self.gridinfo)
+        for scene_idx, ogs in self.og.items():
+            for epi, og in enumerate(ogs):
+                reducer.add_grid(scene_idx, epi, og)
+        scene_index, result = reducer.diversity(filter_failures=False)
+        order = np.searchsorted(scene_index, np.array(list(self.og.keys()), dtype=scene_index.dtype))
+        return result[order]
 
     def get_episode_metrics(self):
         self.episode_index+=1
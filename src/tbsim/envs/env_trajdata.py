@@ -20,11 +20,67 @@ from tbsim.utils.geometry_utils import transform_points_tensor
 from tbsim.utils.timer import Timers
 from tbsim.utils.trajdata_utils import parse_trajdata_batch, get_drivable_region_map, verify_map
 from tbsim.utils.rollout_logger import RolloutLogger
+from l5kit.geometry import transform_points
 from torch.nn.utils.rnn import pad_sequence
 from trajdata.data_structures.state import StateArray
 
 agent_types=[AgentType.UNKNOWN,AgentType.VEHICLE,AgentType.PEDESTRIAN,AgentType.BICYCLE,AgentType.MOTORCYCLE]
 
+
+def agent_action_to_world(positions, yaws, curr_pos, curr_yaw):
+    """
+    Transform the next-step actions of all agents from their agent frames to the world frame.
+
+    Args:
+        positions (np.ndarray): agent-frame next positions [N, 2]
+        yaws (np.ndarray): agent-frame next yaws [N]
+        curr_pos (np.ndarray): current world positions [N, 2]
+        curr_yaw (np.ndarray): current world yaws [N]
+
+    Returns:
+        next_pos (np.ndarray): world-frame next positions [N, 2]
+        next_yaw (np.ndarray): world-frame next yaws [N]
+    """
+    cos, sin = np.cos(curr_yaw), np.sin(curr_yaw)
+    next_pos = np.stack([
+        positions[:, 0] * cos - positions[:, 1] * sin,
+        positions[:, 0] * sin + positions[:, 1] * cos,
+    ], axis=-1) + curr_pos
+    next_yaw = curr_yaw + yaws
+    return next_pos, next_yaw
+
+
+def pose_to_world_from_agent(pos, yaw):
+    """
+    Build world_from_agent [N, 3, 3] and agent_from_world [N, 3, 3] from world poses @pos [N, 2] and @yaw [N].
+    """
+    cos, sin = np.cos(yaw), np.sin(yaw)
+    zeros, ones = np.zeros_like(yaw), np.ones_like(yaw)
+    world_from_agent = np.stack([
+        np.stack([cos, -sin, pos[:, 0]], axis=-1),
+        np.stack([sin, cos, pos[:, 1]], axis=-1),
+        np.stack([zeros, zeros, ones], axis=-1),
+    ], axis=1)
+    agent_from_world = np.stack([
+        np.stack([cos, sin, -(cos * pos[:, 0] + sin * pos[:, 1])], axis=-1),
+        np.stack([-sin, cos, sin * pos[:, 0] - cos * pos[:, 1]], axis=-1),
+        np.stack([zeros, zeros, ones], axis=-1),
+    ], axis=1)
+    return world_from_agent, agent_from_world
+
+
+def step_scenes(scenes, next_states, state_format):
+    """
+    Step every simulation scene with its slice of @next_states [num_agents, D], where agents
+    are ordered scene by scene as in the observation.
+    """
+    idx = 0
+    for scene in scenes:
+        num_agents = len(scene.agents)
+        scene_states = StateArray.from_array(next_states[idx:idx + num_agents], state_format)
+        scene.step(dict(zip([agent.name for agent in scene.agents], scene_states)), return_obs=False)
+        idx += num_agents
+
 class EnvUnifiedSimulation(BaseEnv, BatchedEnv):
     def __init__(
             self,
@@ -74,6 +130,9 @@ class EnvUnifiedSimulation(BaseEnv, BatchedEnv):
         self.logger = None
 
         self.save_action_samples = save_action_samples
+        # advance the observation used for metrics and logging in place between the sub-steps of
+        #   a multi-step action instead of re-collating every scene
+        self._incremental_obs = env_config.get("incremental_obs", True)
 
     def update_random_seed(self, seed):
         self._npr = np.random.RandomState(seed=seed)
@@ -151,13 +210,15 @@ class EnvUnifiedSimulation(BaseEnv, BatchedEnv):
             if len(agent_data)>0:
                 sim_scene.add_new_agents(agent_data)
 
-    def reset(self, scene_indices: List = None, start_frame_index = None):
+    def reset(self, scene_indices: List = None, start_frame_index = None, sim_ids: List = None):
         """
         Reset the previous simulation episode. Randomly sample a batch of new scenes unless specified in @scene_indices
 
         Args:
             scene_indices (List): Optional, a list of scene indices to initialize the simulation episode
             start_frame_index (int or list of ints) : either a single frame number or a list of starting frames corresponding to the given scene_indices
+            sim_ids (List): Optional, unique ids of the simulated instances used in place of @scene_indices
+                for metrics and logging. Required when the same scene appears several times in one batch.
         """
         if scene_indices is None:
             # randomly sample a batch of scenes for close-loop rollouts
@@ -169,7 +230,11 @@ class EnvUnifiedSimulation(BaseEnv, BatchedEnv):
         scene_info = [self.dataset.get_scene(i) for i in scene_indices]
 
         self._num_scenes = len(scene_info)
-        self._current_scene_indices = scene_indices
+        if sim_ids is not None:
+            assert len(sim_ids) == len(scene_indices) and len(set(sim_ids)) == len(sim_ids)
+            self._current_scene_indices = list(sim_ids)
+        else:
+            self._current_scene_indices = scene_indices
         assert (
                 np.max(scene_indices) < self._num_total_scenes
                 and np.min(scene_indices) >= 0
@@ -382,6 +447,55 @@ class EnvUnifiedSimulation(BaseEnv, BatchedEnv):
         self.timers.toc("obs_skimp")
         return dict(agents=agent_obs)
 
+    def _advance_observation(self, agent_obs, next_pos, next_yaw):
+        """
+        Advance an agent-centric observation by one frame given the new world poses of its agents,
+        without re-collating the scenes: history windows are shifted by one frame and the new state is appended.
+        Keys that cannot be derived from the new poses (futures, neighbors) are dropped. image, raster_from_world
+        and map_names are kept from the current frame, and raster_from_agent / agent_from_raster are recomputed
+        from raster_from_world and the new poses so that they stay consistent with the kept image.
+
+        Args:
+            agent_obs (dict): agent-centric observation of the current frame
+            next_pos (np.ndarray): world positions of the agents at the next frame [N, 2]
+            next_yaw (np.ndarray): world yaws of the agents at the next frame [N]
+
+        Returns:
+            agent_obs (dict): observation of the next frame
+        """
+        kept_keys = ["extent", "type", "scene_index", "track_id", "env_name", "map_names", "image", "raster_from_world"]
+        next_obs = {k: agent_obs[k] for k in kept_keys if k in agent_obs}
+
+        dtype = agent_obs["centroid"].dtype
+        world_from_agent, agent_from_world = pose_to_world_from_agent(next_pos.astype(np.float64),
+                                                                      next_yaw.astype(np.float64))
+        next_from_curr = agent_from_world @ agent_obs["world_from_agent"]
+        valid = ~(np.isnan(next_pos).any(axis=-1) | np.isnan(next_yaw))
+
+        def shift(hist, last):
+            return np.concatenate([hist[:, 1:], last[:, None].astype(hist.dtype)], axis=1)
+
+        hist_pos = transform_points(agent_obs["history_positions"], next_from_curr)
+        curr_pos = np.where(valid[:, None], np.zeros_like(next_pos), np.nan)
+        next_obs["history_positions"] = shift(hist_pos.astype(dtype), curr_pos)
+        hist_yaw = agent_obs["history_yaws"] + (agent_obs["yaw"] - next_yaw)[:, None, None]
+        next_obs["history_yaws"] = shift(hist_yaw, curr_pos[:, :1])
+        next_obs["history_availabilities"] = shift(agent_obs["history_availabilities"], valid)
+        curr_speed = np.linalg.norm(next_pos - agent_obs["centroid"], axis=-1) / self.dataset.desired_dt
+        next_obs["history_speeds"] = shift(agent_obs["history_speeds"], curr_speed)
+        next_obs["curr_speed"] = curr_speed.astype(dtype)
+
+        next_obs["centroid"] = next_pos.astype(dtype)
+        next_obs["yaw"] = next_yaw.astype(dtype)
+        next_obs["world_from_agent"] = world_from_agent.astype(agent_obs["world_from_agent"].dtype)
+        next_obs["agent_from_world"] = agent_from_world.astype(agent_obs["agent_from_world"].dtype)
+        if "raster_from_world" in agent_obs:
+            raster_dtype = agent_obs["raster_from_world"].dtype
+            raster_from_agent = agent_obs["raster_from_world"].astype(np.float64) @ world_from_agent
+            next_obs["raster_from_agent"] = raster_from_agent.astype(raster_dtype)
+            next_obs["agent_from_raster"] = np.linalg.inv(raster_from_agent).astype(raster_dtype)
+        return next_obs
+
     def _add_per_step_metrics(self, obs, frame_index=None):
         for k, v in self._metrics.items():
             v.update_global_t(global_t=frame_index)
@@ -406,6 +520,10 @@ class EnvUnifiedSimulation(BaseEnv, BatchedEnv):
         # self._add_per_step_metrics(obs)
 
         action = step_actions.agents.to_dict()
+        # the observation of the first sub-step is the one the policy was queried with;
+        #   later sub-steps advance it incrementally as long as the set of agents does not change
+        incremental = self._incremental_obs and "num_agents" not in obs
+        agent_obs = dict(obs) if incremental else None
         # action_samples = None if "action_samples" not in step_actions.agents_info else step_actions.agents_info["action_samples"]
         # action_info = {k : v for k, v in step_actions.agents_info.items() if k != "action_samples"}
         for action_index in range(num_steps_to_take):
@@ -417,10 +535,15 @@ class EnvUnifiedSimulation(BaseEnv, BatchedEnv):
                 self._cached_observation = None
                 return
             # # log state and action
-            obs_skimp = self.get_observation_skimp()
-            obs_skimp["agents"]["image"] = obs["image"]
-            obs_skimp["agents"]["raster_from_world"] = obs["raster_from_world"]
-            obs_skimp["agents"]["map_names"] = obs["map_names"]
+            if agent_obs is not None:
+                obs_skimp = dict(agents=agent_obs)
+            else:
+                obs_skimp = self.get_observation_skimp()
+                obs_skimp["agents"]["image"] = obs["image"]
+                obs_skimp["agents"]["raster_from_world"] = obs["raster_from_world"]
+                obs_skimp["agents"]["map_names"] = obs["map_names"]
+                if incremental:
+                    agent_obs = obs_skimp["agents"]
             self._add_per_step_metrics(obs_skimp["agents"], self._frame_index+action_index)
             if self._log_data:
                 # log_agents_info = action_info.copy()
@@ -442,33 +565,32 @@ class EnvUnifiedSimulation(BaseEnv, BatchedEnv):
                 )
                 self.logger.log_step(obs_skimp, action_to_log)
 
-            idx = 0
-            for scene in self._current_scenes:
-                scene_action = dict()
-                for agent in scene.agents:
-                    curr_yaw = obs["yaw"][idx]
-                    curr_pos = obs["centroid"][idx]
-                    h1, h2 = obs["yaw"][idx], obs["curr_agent_state"][idx, -1]
-                    p1, p2 = obs["centroid"][idx], obs["curr_agent_state"][idx, :2]
-                    assert np.all(h1[~np.isnan(h1)] == h2[~np.isnan(h2)])
-                    assert np.all(p1[~np.isnan(p1)] == p2[~np.isnan(p2)])
-
-                    world_from_agent = np.array(
-                        [
-                            [np.cos(curr_yaw), np.sin(curr_yaw)],
-                            [-np.sin(curr_yaw), np.cos(curr_yaw)],
-                        ]
-                    )
-                    next_state = np.zeros(3, dtype=obs["agent_fut"].dtype)
-                    if not np.any(np.isnan(action["positions"][idx, action_index])) and not np.any(np.isnan(action["yaws"][idx, action_index, 0])):  # ground truth action may be NaN
-                        next_state[:2] = action["positions"][idx, action_index] @ world_from_agent + curr_pos
-                        next_state[2] = curr_yaw + action["yaws"][idx, action_index, 0]
-                    else:
-                        next_state = np.ones(3, dtype=obs["agent_fut"].dtype)*np.nan
-                        print("invalid action!", idx, action_index, action["positions"][idx, action_index], action["yaws"][idx, action_index, 0])
-                    scene_action[agent.name] = StateArray.from_array(next_state, "x,y,h")
-                    idx += 1
-                scene.step(scene_action, return_obs=False)
+            h1, h2 = obs["yaw"], obs["curr_agent_state"][:, -1]
+            p1, p2 = obs["centroid"], obs["curr_agent_state"][:, :2]
+            h_valid = ~np.isnan(h1) & ~np.isnan(h2)
+            p_valid = ~np.isnan(p1) & ~np.isnan(p2)
+            assert np.all(h1[h_valid] == h2[h_valid])
+            assert np.all(p1[p_valid] == p2[p_valid])
+
+            step_pos = action["positions"][:, action_index]
+            step_yaw = action["yaws"][:, action_index, 0]
+            next_pos, next_yaw = agent_action_to_world(step_pos, step_yaw, obs["centroid"], obs["yaw"])
+            next_states = np.concatenate([next_pos, next_yaw[:, None]], axis=-1).astype(obs["agent_fut"].dtype)
+            # ground truth action may be NaN
+            invalid = np.isnan(step_pos).any(axis=-1) | np.isnan(step_yaw)
+            next_states[invalid] = np.nan
+            for idx in np.nonzero(invalid)[0]:
+                print("invalid action!", idx, action_index, step_pos[idx], step_yaw[idx])
+            agents_before = [[a.name for a in scene.agents] for scene in self._current_scenes]
+            step_scenes(self._current_scenes, next_states, "x,y,h")
+
+            if agent_obs is not None and action_index + 1 < num_steps_to_take:
+                agents_after = [[a.name for a in scene.agents] for scene in self._current_scenes]
+                if agents_after == agents_before:
+                    agent_obs = self._advance_observation(agent_obs, next_states[:, :2], next_states[:, 2])
+                else:
+                    # agents entered or left a scene, re-collate
+                    agent_obs = None
 
         self._cached_observation = None
 
@@ -810,27 +932,18 @@ class EnvSplitUnifiedSimulation(EnvUnifiedSimulation):
 
                 self.logger.log_step(obs_skimp, action_to_log)
 
-            idx = 0
-            for scene in self._current_scenes:
-                scene_action = dict()
-                for agent in scene.agents:
-                    curr_yaw = obs["curr_agent_state"][idx, -1]
-                    curr_pos = obs["curr_agent_state"][idx, :2]
-                    world_from_agent = np.array(
-                        [
-                            [np.cos(curr_yaw), np.sin(curr_yaw)],
-                            [-np.sin(curr_yaw), np.cos(curr_yaw)],
-                        ]
-                    )
-                    next_state = np.ones(4, dtype=obs["agent_fut"].dtype) * np.nan
-                    if not np.any(np.isnan(action["positions"][idx, action_index])):  # ground truth action may be NaN
-                        next_state[:2] = action["positions"][idx, action_index] @ world_from_agent + curr_pos
-                        next_state[-1] = curr_yaw + action["yaws"][idx, action_index, 0]
-                    else:
-                        pass
-                    scene_action[agent.name] = StateArray.from_array(next_state, "x,y,z,h")
-                    idx += 1
-                scene.step(scene_action, return_obs=False)
+            step_pos = action["positions"][:, action_index]
+            curr_yaw = obs["curr_agent_state"][:, -1]
+            next_pos, next_yaw = agent_action_to_world(step_pos,
+                                                       action["yaws"][:, action_index, 0],
+                                                       obs["curr_agent_state"][:, :2],
+                                                       curr_yaw)
+            next_states = np.full((step_pos.shape[0], 4), np.nan, dtype=obs["agent_fut"].dtype)
+            next_states[:, :2] = next_pos
+            next_states[:, -1] = next_yaw
+            # ground truth action may be NaN
+            next_states[np.isnan(step_pos).any(axis=-1)] = np.nan
+            step_scenes(self._current_scenes, next_states, "x,y,z,h")
 
         self._cached_observation = None
         self._cached_raw_observation = None
@@ -49,6 +49,12 @@ class EnvironmentBuilder(object):
             all_failure=EnvMetrics.CriticalFailure(num_offroad_frames=2),
             all_comfort=EnvMetrics.Comfort(sim_dt=self.exp_cfg.algo.step_time, stat_dt=0.5),
         )
+        if self.eval_cfg.metrics.get("fused_step_metrics", False):
+            # evaluate the per-step map and collision metrics in one batched pass on the policy device
+            for k in ["all_off_road_rate", "all_disk_off_road_rate", "all_collision_rate",
+                      "all_disk_collision_rate", "all_failure"]:
+                metrics.pop(k)
+            metrics["all"] = EnvMetrics.FusedStepMetrics(device=self.device)
         return metrics
 
     def _get_learned_metrics(self):
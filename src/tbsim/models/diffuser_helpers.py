@@ -1,5 +1,7 @@
 from typing import Dict, Union, List
 
+import json
+import os
 import math
 import numpy as np
 import torch
@@ -103,6 +105,65 @@ def prepare_hist_in(pos, yaw, speed, extent, avail, norm_info):
 
     return hist_in
 
+NORM_STATS_VERSION = 1
+
+def load_norm_stats(stats_path):
+    """
+    Load the normalization coefficients of all groups (e.g. "diffuser", "agent_hist") from a dataset statistics file.
+    The file is json with {"version": NORM_STATS_VERSION, "norm_info": {group: [add_coeffs, div_coeffs], ...}, ...}.
+    """
+    with open(stats_path, "r") as f:
+        stats = json.load(f)
+    assert stats.get("version") == NORM_STATS_VERSION, \
+        "unsupported stats file version {} in {}".format(stats.get("version"), stats_path)
+    return {group: (info[0], info[1]) for group, info in stats["norm_info"].items()}
+
+_NORM_STATS_CACHE = dict()
+
+def get_norm_info(algo_config, group, default):
+    """norm info of @group from the stats file at algo_config.norm_stats_path if it has one, otherwise @default"""
+    stats_path = algo_config.get("norm_stats_path", None)
+    if stats_path is None:
+        return default
+    # the file is read once for all groups, and again if it is rebuilt
+    key = (os.path.abspath(stats_path), os.path.getmtime(stats_path))
+    if key not in _NORM_STATS_CACHE:
+        _NORM_STATS_CACHE[key] = load_norm_stats(stats_path)
+    return _NORM_STATS_CACHE[key].get(group, default)
+
+class TrajNormalizer(nn.Module):
+    '''
+    Holds (add_coeffs, div_coeffs) as device buffers and caches the coefficients of each
+    subset of indices, so scaling a trajectory does not copy anything from the host.
+    scale: (x + add) / div, descale: x * div - add
+    '''
+    def __init__(self, add_coeffs, div_coeffs):
+        super().__init__()
+        assert len(add_coeffs) == len(div_coeffs)
+        # non-persistent so that existing checkpoints still load
+        self.register_buffer("add_coeffs", torch.tensor(np.array(add_coeffs), dtype=torch.float32), persistent=False)
+        self.register_buffer("div_coeffs", torch.tensor(np.array(div_coeffs), dtype=torch.float32), persistent=False)
+        self._cache = dict()
+
+    def coeffs(self, chosen_inds, device=None):
+        '''
+        (add_coeffs, div_coeffs) at @chosen_inds, each (D,), on @device (defaults to the buffers' device)
+        '''
+        device = self.add_coeffs.device if device is None else torch.device(device)
+        key = (tuple(int(i) for i in chosen_inds), device)
+        if key not in self._cache:
+            inds = torch.tensor(key[0], dtype=torch.long, device=self.add_coeffs.device)
+            self._cache[key] = (self.add_coeffs[inds].to(device), self.div_coeffs[inds].to(device))
+        return self._cache[key]
+
+    def scale(self, x, chosen_inds):
+        add_coeffs, div_coeffs = self.coeffs(chosen_inds, x.device)
+        return (x + add_coeffs) / div_coeffs
+
+    def descale(self, x, chosen_inds):
+        add_coeffs, div_coeffs = self.coeffs(chosen_inds, x.device)
+        return x * div_coeffs - add_coeffs
+
 class AgentHistoryEncoder(nn.Module):
     '''
     MLP encodes past state history.
@@ -116,8 +177,9 @@ class AgentHistoryEncoder(nn.Module):
                        ):
         super().__init__()
         assert len(norm_info) == 2, norm_info
-        self.add_coeffs = torch.tensor(norm_info[0])
-        self.div_coeffs = torch.tensor(norm_info[1])
+        # non-persistent buffers follow the module across devices without changing the checkpoint format
+        self.register_buffer("add_coeffs", torch.tensor(norm_info[0]), persistent=False)
+        self.register_buffer("div_coeffs", torch.tensor(norm_info[1]), persistent=False)
         self.state_dim = 8 # (x,y,hx,hy,s,l,w,avail)
         input_dim = num_steps * self.state_dim
         layer_dims = (input_dim, input_dim, out_dim, out_dim)
@@ -514,12 +576,8 @@ def get_scene_obs(pos_pred, yaw_pred, data_batch):
 # vbound = [-10, 30]
 
 @torch.no_grad()
-def ubound(dyn_model, v):
-    yawbound = torch.minimum(
-        dyn_model.max_steer * torch.abs(v),
-        dyn_model.max_yawvel / torch.clip(torch.abs(v), min=0.1),
-    )
-    yawbound = torch.clip(yawbound, min=0.1)
+def acce_ubound(dyn_model, v):
+    """the acceleration part of ubound, without concatenating the yaw bounds"""
     acce_lb = torch.clip(
         torch.clip(dyn_model.vbound[0] - v, max=dyn_model.acce_bound[1]),
         min=dyn_model.acce_bound[0],
@@ -528,6 +586,21 @@ def ubound(dyn_model, v):
         torch.clip(dyn_model.vbound[1] - v, min=dyn_model.acce_bound[0]),
         max=dyn_model.acce_bound[1],
     )
+    return acce_lb, acce_ub
+
+@torch.no_grad()
+def yawvel_ubound(dyn_model, v):
+    """the yaw velocity part of ubound (the lower bound is its negative)"""
+    yawbound = torch.minimum(
+        dyn_model.max_steer * torch.abs(v),
+        dyn_model.max_yawvel / torch.clip(torch.abs(v), min=0.1),
+    )
+    return torch.clip(yawbound, min=0.1)
+
+@torch.no_grad()
+def ubound(dyn_model, v):
+    acce_lb, acce_ub = acce_ubound(dyn_model, v)
+    yawbound = yawvel_ubound(dyn_model, v)
     lb = torch.cat((acce_lb, -yawbound), dim=-1)
     ub = torch.cat((acce_ub, yawbound), dim=-1)
     return lb, ub
@@ -554,9 +627,11 @@ def unicyle_forward_dynamics(
         initial_states (Torch.tensor): state tensor of size [B, (A), 4]
         actions (Torch.tensor): action tensor of size [B, (A), T, 2]
         step_time (float): delta time between steps
-        mode (str): 'parallel' or 'partial_parallel' or 'chain'. 'parallel' is the fastet
+        mode (str): 'parallel' or 'exact_parallel' or 'partial_parallel' or 'chain'. 'parallel' is the fastet
         but it generates different results from 'partial_parallel' and 'chain' when the
-        velocity is out of bounds.
+        velocity is out of bounds. 'exact_parallel' matches 'chain' (including its bounds) and
+        integrates with cumulative sums, only re-clipping the steps where the velocity leaves
+        the range in which the acceleration bounds are constant.
         
         When running one (three) inner loop gradient update, the network related time for each are:
         parallel: 1.2s (2.5s)
@@ -570,7 +645,70 @@ def unicyle_forward_dynamics(
     
 
     # ------------------------------------------------------------ #
-    if mode in ['parallel', 'partial_parallel']:
+    if mode == 'exact_parallel':
+        v0 = initial_states[..., 2:3]
+        acc = actions[..., 0:1]
+        yawvel = actions[..., 1:2]
+        amin, amax = dyn_model.acce_bound
+        vmin, vmax = dyn_model.vbound
+        # for v in [vmin - amin, vmax - amax] the chain bounds on the acceleration are exactly
+        #   [amin, amax], so the velocity is a plain cumulative sum of the clipped accelerations
+        free_lo, free_hi = vmin - amin, vmax - amax
+        num_steps = actions.shape[-2]
+        max_refine_steps = 4
+        dv = torch.clip(acc, amin, amax) * step_time
+        v_full = torch.cat((v0.unsqueeze(-2), v0.unsqueeze(-2) + torch.cumsum(dv, dim=-2)), dim=-2)
+        fixed = torch.zeros_like(acc, dtype=torch.bool)
+        for _ in range(max_refine_steps):
+            with torch.no_grad():
+                v_earlier = v_full[..., :-1, :]
+                # the first step of each trajectory whose bounds still depend on its velocity
+                pending = ((v_earlier < free_lo) | (v_earlier > free_hi)) & ~fixed
+                if not pending.any():
+                    break
+                first = pending & (torch.cumsum(pending.int(), dim=-2) == 1)
+                lb, ub = acce_ubound(dyn_model, v_earlier)
+            # the velocity before the first pending step is exact, so the chain update can be applied there
+            dv = torch.where(first, torch.clip(acc, lb, ub) * step_time, dv)
+            fixed = fixed | first
+            v_full = torch.cat((v0.unsqueeze(-2), v0.unsqueeze(-2) + torch.cumsum(dv, dim=-2)), dim=-2)
+        else:
+            # trajectories that stay out of that range (e.g. reversing): finish their velocity
+            #   with the chain recursion from their earliest step that is still pending
+            with torch.no_grad():
+                v_earlier = v_full[..., :-1, :]
+                pending = ((v_earlier < free_lo) | (v_earlier > free_hi)) & ~fixed
+                pending = pending.reshape(-1, num_steps)
+                rows = torch.nonzero(pending.any(dim=-1))[:, 0]
+            if len(rows) > 0:
+                t0 = int(torch.nonzero(pending[rows].any(dim=0))[0])
+                flat_dv = dv.reshape(-1, num_steps, 1)
+                flat_acc = acc.reshape(-1, num_steps, 1)[rows]
+                vt = v_full.reshape(-1, num_steps + 1, 1)[rows, t0]
+                dv_tail = []
+                for t in range(t0, num_steps):
+                    lb, ub = acce_ubound(dyn_model, vt)
+                    dv_t = torch.clip(flat_acc[:, t], lb, ub) * step_time
+                    vt = vt + dv_t
+                    dv_tail.append(dv_t)
+                dv_rows = torch.cat((flat_dv[rows, :t0], torch.stack(dv_tail, dim=-2)), dim=-2)
+                dv = flat_dv.index_put((rows,), dv_rows).reshape(dv.shape)
+                v_full = torch.cat((v0.unsqueeze(-2), v0.unsqueeze(-2) + torch.cumsum(dv, dim=-2)), dim=-2)
+
+        v_earlier = v_full[..., :-1, :]
+        yawbound = yawvel_ubound(dyn_model, v_earlier)
+        yawvel_clipped = torch.clip(yawvel, -yawbound, yawbound)
+        yaw0 = initial_states[..., 3:4].unsqueeze(-2)
+        yaw_full = torch.cat((yaw0, yaw0 + torch.cumsum(yawvel_clipped * step_time, dim=-2)), dim=-2)
+        yaw_earlier = yaw_full[..., :-1, :]
+
+        v_avg = v_earlier + dv * 0.5
+        dxy = torch.cat((torch.cos(yaw_earlier) * v_avg, torch.sin(yaw_earlier) * v_avg), dim=-1) * step_time
+        x_and_y = initial_states[..., :2].unsqueeze(-2) + torch.cumsum(dxy, dim=-2)
+
+        x_all = torch.cat((x_and_y, v_full[..., 1:, :], yaw_full[..., 1:, :]), dim=-1)
+    # ------------------------------------------------------------ #
+    elif mode in ['parallel', 'partial_parallel']:
         with torch.no_grad():
             num_steps = actions.shape[-2]
             bm = actions.shape[:-2]
@@ -24,6 +24,7 @@ from .diffuser_helpers import (
     unicyle_forward_dynamics,
     AgentHistoryEncoder,
     NeighborHistoryEncoder,
+    TrajNormalizer,
     SimpleNeighborHistoryEncoder,
     MapEncoder,
     angle_wrap_torch,
@@ -266,6 +267,7 @@ class SceneDiffuserModel(nn.Module):
         assert len(norm_div_coeffs) == 6
         self.add_coeffs = np.array(norm_add_coeffs).astype('float32')
         self.div_coeffs = np.array(norm_div_coeffs).astype('float32')       
+        self.traj_norm = TrajNormalizer(self.add_coeffs, self.div_coeffs)
 
         print('self.add_coeffs', self.add_coeffs)
         print('self.div_coeffs', self.div_coeffs)
@@ -1074,14 +1076,7 @@ class SceneDiffuserModel(nn.Module):
         '''
         if len(chosen_inds) == 0:
             chosen_inds = self.default_chosen_inds
-        add_coeffs = self.add_coeffs[chosen_inds][None,None] # 1 x 1 x D
-        div_coeffs = self.div_coeffs[chosen_inds][None,None] # 1 x 1 x D
-
-        # TODO make these a buffer so they're put on the device automatically
-        device = target_traj_orig.get_device()
-        dx_add = torch.tensor(add_coeffs, device=device)
-        dx_div = torch.tensor(div_coeffs, device=device)
-        target_traj = (target_traj_orig + dx_add) / dx_div
+        target_traj = self.traj_norm.scale(target_traj_orig, chosen_inds)
 
         return target_traj
 
@@ -1097,14 +1092,7 @@ class SceneDiffuserModel(nn.Module):
         '''
         if len(chosen_inds) == 0:
             chosen_inds = self.default_chosen_inds
-        add_coeffs = self.add_coeffs[chosen_inds][None,None] # 1 x 1 x D
-        div_coeffs = self.div_coeffs[chosen_inds][None,None] # 1 x 1 x D
-
-        device = target_traj_orig.get_device()
-        dx_add = torch.tensor(add_coeffs, device=device)
-        dx_div = torch.tensor(div_coeffs, device=device) 
-
-        target_traj = target_traj_orig * dx_div - dx_add
+        target_traj = self.traj_norm.descale(target_traj_orig, chosen_inds)
 
         return target_traj
 
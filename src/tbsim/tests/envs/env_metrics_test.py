@@ -0,0 +1,43 @@
+import numpy as np
+
+from tbsim.envs.env_metrics import OccupancyDiversity
+from tbsim.utils.batch_utils import set_global_batch_type
+
+
+def _state_info(rng, scene_index, track_id):
+    num_agents = len(scene_index)
+    return {
+        "scene_index": scene_index,
+        "track_id": track_id,
+        "centroid": rng.uniform(0, 10, size=(num_agents, 2)),
+        "raster_from_world": np.tile(np.eye(3), (num_agents, 1, 1)),
+        # l5kit drivable area: third to last channel < 1
+        "image": np.zeros((num_agents, 5, 32, 32)),
+    }
+
+
+def test_occupancy_diversity_multi_scene():
+    set_global_batch_type("l5kit")
+    rng = np.random.default_rng(0)
+    scene_index = np.array([3, 3, 3, 7, 7])
+    track_id = np.array([0, 1, 2, 10, 11])
+
+    metric = OccupancyDiversity(gridinfo={"offset": np.zeros(2), "step": np.ones(2)})
+    for episode in range(2):
+        metric.reset()
+        for _ in range(3):
+            metric.add_step(_state_info(rng, scene_index, track_id), np.array([3, 7]))
+        metric.get_episode_metrics()
+
+    assert list(metric.og.keys()) == [3, 7]
+    for scene_idx, ogs in metric.og.items():
+        assert len(ogs) == 2
+        for episode, og in enumerate(ogs):
+            _, episode_index, agent_ids = og.agent_ids_csr()
+            assert np.all(episode_index == episode)
+            # each scene grid is only visited by the agents of that scene
+            assert set(agent_ids) == set(track_id[scene_index == scene_idx])
+
+    diversity = metric.get_multi_episode_metrics()
+    assert diversity.shape == (2,)
+    assert np.all(np.isfinite(diversity))
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from tbsim.utils.geometry_utils import detect_collision, detect_collision_batch
+
+
+def _detect_collision_pairwise(pos, yaw, extent, group):
+    """Per-agent detect_collision against the other agents of its group, in index order"""
+    coll_type = np.full(len(pos), -1)
+    coll_with = np.full(len(pos), -1)
+    for j in range(len(pos)):
+        others = np.nonzero((group == group[j]) & (np.arange(len(pos)) != j))[0]
+        coll = detect_collision(pos[j], yaw[j], extent[j], pos[others], yaw[others], extent[others])
+        if coll is not None:
+            coll_type[j], coll_with[j] = coll[0].value, others[coll[1]]
+    return coll_type, coll_with
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_detect_collision_batch_random(seed):
+    rng = np.random.default_rng(seed)
+    num_agents = 40
+    pos = rng.uniform(-15, 15, size=(num_agents, 2))
+    yaw = rng.uniform(-np.pi, np.pi, size=num_agents)
+    extent = np.concatenate([rng.uniform(2, 6, size=(num_agents, 1)),
+                             rng.uniform(1, 2.5, size=(num_agents, 1)),
+                             np.ones((num_agents, 1))], axis=-1)
+    group = rng.integers(0, 2, size=num_agents)
+
+    coll_type, coll_with = detect_collision_batch(pos, yaw, extent, group=group)
+    expected_type, expected_with = _detect_collision_pairwise(pos, yaw, extent, group)
+    assert np.any(expected_with >= 0) and np.any(expected_with < 0)
+    assert np.array_equal(coll_with, expected_with)
+    assert np.array_equal(coll_type, expected_type)
+
+
+def test_detect_collision_batch_special_cases():
+    pos = np.array([
+        [0.0, 0.0], [4.0, 0.0],  # touching front to rear
+        [20.0, 0.0], [20.5, 0.2],  # the second box is contained in the first one
+        [40.0, 0.0], [50.0, 0.0],  # far apart
+        [60.0, 0.0], [60.0, 2.5],  # just not overlapping side by side
+    ])
+    yaw = np.array([0.0, 0.0, 0.3, 0.3, 0.0, 1.0, 0.0, 0.0])
+    extent = np.array([
+        [4.0, 2.0, 1.0], [4.0, 2.0, 1.0],
+        [6.0, 3.0, 1.0], [1.0, 0.5, 1.0],
+        [4.0, 2.0, 1.0], [4.0, 2.0, 1.0],
+        [4.0, 2.0, 1.0], [4.0, 2.0, 1.0],
+    ])
+    group = np.zeros(len(pos), dtype=int)
+
+    coll_type, coll_with = detect_collision_batch(pos, yaw, extent, group=group)
+    expected_type, expected_with = _detect_collision_pairwise(pos, yaw, extent, group)
+    assert np.array_equal(coll_with, expected_with)
+    assert np.array_equal(coll_type, expected_type)
+    assert np.array_equal(coll_with, [1, 0, 3, 2, -1, -1, -1, -1])
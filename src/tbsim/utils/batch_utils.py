@@ -152,6 +152,9 @@ class trajdataBatchUtils(BatchUtils):
     """Batch utils for trajdata"""
     @staticmethod
     def parse_batch(data_batch):
+        if "history_positions" in data_batch:
+            # already parsed, e.g. by the data loader workers (tbsim.datasets.prefetch.ParseCollate)
+            return data_batch
         return av_utils.parse_trajdata_batch(data_batch)
 
     @staticmethod
@@ -365,42 +365,154 @@ def detect_collision(
              collision type and the agent track_id
     """
     from l5kit.planning import utils
+    import warnings
     ego_bbox = utils._get_bounding_box(centroid=ego_pos, yaw=ego_yaw, extent=ego_extent)
     
     # within_range_mask = utils.within_range(ego_pos, ego_extent, other_pos, other_extent)
-    # TBD: hack to ignore shapely warning when no intersection is found.
-    import warnings
-    warnings.filterwarnings('ignore')
-    for i in range(other_pos.shape[0]):
-        agent_bbox = utils._get_bounding_box(other_pos[i], other_yaw[i], other_extent[i])
-        if ego_bbox.intersects(agent_bbox):
-            front_side, rear_side, left_side, right_side = utils._get_sides(ego_bbox)
-            front_int = agent_bbox.intersection(front_side)
-            rear_int = agent_bbox.intersection(rear_side)
-            left_int = agent_bbox.intersection(left_side)
-            right_int = agent_bbox.intersection(right_side)
-
-            intersection_length_per_side = np.asarray(
-                [
-                    front_int.length,
-                    rear_int.length,
-                    left_int.length,
-                    right_int.length,
-                ]
-            )
-            argmax_side = np.argmax(intersection_length_per_side)
-
-            # Remap here is needed because there are two sides that are
-            # mapped to the same collision type CollisionType.SIDE
-            max_collision_types = max(CollisionType).value
-            remap_argmax = min(argmax_side, max_collision_types)
-            collision_type = CollisionType(remap_argmax)
-            return collision_type, i
-    # TBD: restore warning filter
-    warnings.filterwarnings('default')
+    # ignore shapely warning when no intersection is found, without touching the global filters
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for i in range(other_pos.shape[0]):
+            agent_bbox = utils._get_bounding_box(other_pos[i], other_yaw[i], other_extent[i])
+            if ego_bbox.intersects(agent_bbox):
+                front_side, rear_side, left_side, right_side = utils._get_sides(ego_bbox)
+                front_int = agent_bbox.intersection(front_side)
+                rear_int = agent_bbox.intersection(rear_side)
+                left_int = agent_bbox.intersection(left_side)
+                right_int = agent_bbox.intersection(right_side)
+
+                intersection_length_per_side = np.asarray(
+                    [
+                        front_int.length,
+                        rear_int.length,
+                        left_int.length,
+                        right_int.length,
+                    ]
+                )
+                argmax_side = np.argmax(intersection_length_per_side)
+
+                # Remap here is needed because there are two sides that are
+                # mapped to the same collision type CollisionType.SIDE
+                max_collision_types = max(CollisionType).value
+                remap_argmax = min(argmax_side, max_collision_types)
+                collision_type = CollisionType(remap_argmax)
+                return collision_type, i
     return None
 
 
+def _clip_segment_to_box(p0, p1, half_extent):
+    """
+    Length of the part of segments p0->p1 that lies inside axis-aligned boxes
+    [-half_extent, half_extent] (Liang-Barsky clipping).
+
+    Args:
+        p0, p1 (np.ndarray): [..., 2] segment end points in the box frame
+        half_extent (np.ndarray): [..., 2] half sizes of the boxes
+
+    Returns:
+        length (np.ndarray): [...]
+    """
+    d = p1 - p0
+    t0 = np.zeros(d.shape[:-1])
+    t1 = np.ones(d.shape[:-1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for dim in range(2):
+            for sign in (-1.0, 1.0):
+                # sign * (p0 + t * d) <= half_extent  <=>  p * t <= q
+                p = sign * d[..., dim]
+                q = half_extent[..., dim] - sign * p0[..., dim]
+                r = q / p
+                t0 = np.where(p < 0, np.maximum(t0, r), t0)
+                t1 = np.where(p > 0, np.minimum(t1, r), t1)
+                t1 = np.where((p == 0) & (q < 0), -1.0, t1)
+    return np.clip(t1 - t0, 0.0, None) * np.linalg.norm(d, axis=-1)
+
+
+def detect_collision_batch(
+        pos: np.ndarray,
+        yaw: np.ndarray,
+        extent: np.ndarray,
+        group: np.ndarray = None,
+        valid: np.ndarray = None,
+):
+    """
+    Vectorized all-pairs version of detect_collision.
+    For every agent j, the colliding agent is the first other agent (in index order, same group)
+    whose oriented box intersects j's box, and the collision type is given by the side of j's box
+    with the longest intersection, exactly as in detect_collision.
+    Pairs whose bounding circles do not overlap are pruned before the separating axis test.
+
+    Args:
+        pos (np.ndarray): [N, 2] centroids
+        yaw (np.ndarray): [N] or [N, 1] headings
+        extent (np.ndarray): [N, >=2] extents, only the first two are used
+        group (np.ndarray): Optional [N] group (scene) index, only agents of the same group can collide
+        valid (np.ndarray): Optional [N] validity mask, defaults to agents without NaN positions
+
+    Returns:
+        coll_type (np.ndarray): [N] int CollisionType value of each agent's collision, -1 if none
+        coll_with (np.ndarray): [N] int index of the colliding agent, -1 if none
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    yaw = np.asarray(yaw, dtype=np.float64).reshape(-1)
+    half = np.asarray(extent, dtype=np.float64)[:, :2] / 2  # half length along heading, half width
+    N = pos.shape[0]
+    coll_type = np.full(N, -1, dtype=np.int64)
+    coll_with = np.full(N, -1, dtype=np.int64)
+    if N < 2:
+        return coll_type, coll_with
+    if valid is None:
+        valid = np.logical_not(np.any(np.isnan(pos), axis=-1))
+
+    # broad phase: bounding circles
+    radius = np.linalg.norm(half, axis=-1)
+    dist = np.linalg.norm(pos[None, :] - pos[:, None], axis=-1)
+    cand = dist <= radius[:, None] + radius[None, :]
+    cand &= valid[:, None] & valid[None, :]
+    np.fill_diagonal(cand, False)
+    if group is not None:
+        group = np.asarray(group)
+        cand &= group[:, None] == group[None, :]
+    ji, ki = np.nonzero(cand)  # row-major, so ki is ascending for each ji
+    if len(ji) == 0:
+        return coll_type, coll_with
+
+    # narrow phase: separating axis test on the two axes of each box
+    cos, sin = np.cos(yaw), np.sin(yaw)
+    axes = np.stack([np.stack([cos, sin], axis=-1), np.stack([-sin, cos], axis=-1)], axis=1)  # [N, 2, 2]
+    d = pos[ki] - pos[ji]
+    hit = np.ones(len(ji), dtype=bool)
+    for box, other in ((ji, ki), (ki, ji)):
+        for ax in range(2):
+            u = axes[box, ax]
+            r_other = half[other, 0] * np.abs(np.sum(axes[other, 0] * u, axis=-1)) + \
+                      half[other, 1] * np.abs(np.sum(axes[other, 1] * u, axis=-1))
+            hit &= np.abs(np.sum(d * u, axis=-1)) <= half[box, ax] + r_other
+    ji, ki = ji[hit], ki[hit]
+    if len(ji) == 0:
+        return coll_type, coll_with
+    ji, first = np.unique(ji, return_index=True)
+    ki = ki[first]
+
+    # corners of j's box in the local frame of k: (+a,+b), (+a,-b), (-a,-b), (-a,+b)
+    signs = np.array([[1, 1], [1, -1], [-1, -1], [-1, 1]], dtype=np.float64)
+    corners = pos[ji, None] + \
+        (signs[None, :, 0:1] * half[ji, None, 0:1]) * axes[ji, None, 0] + \
+        (signs[None, :, 1:2] * half[ji, None, 1:2]) * axes[ji, None, 1]  # [P, 4, 2]
+    rel = corners - pos[ki, None]
+    local = np.stack([np.sum(rel * axes[ki, None, 0], axis=-1),
+                      np.sum(rel * axes[ki, None, 1], axis=-1)], axis=-1)
+    # front, rear, left, right sides as in l5kit.planning.utils._get_sides
+    side_start = local[:, [0, 2, 0, 1]]
+    side_end = local[:, [1, 3, 3, 2]]
+    side_len = _clip_segment_to_box(side_start, side_end, half[ki, None])  # [P, 4]
+
+    max_collision_types = max(CollisionType).value
+    coll_type[ji] = np.minimum(np.argmax(side_len, axis=-1), max_collision_types)
+    coll_with[ji] = ki
+    return coll_type, coll_with
+
+
 def calc_distance_map(road_flag,max_dis = 10,mode="L1"):
     """mark the image with manhattan distance to the drivable area
 
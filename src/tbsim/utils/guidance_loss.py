@@ -444,23 +444,30 @@ class AgentCollisionLoss(GuidanceLoss):
     Agents should not collide with each other.
     NOTE: this assumes full control over the scene. 
     '''
-    def __init__(self, num_disks=5, buffer_dist=0.2, decay_rate=0.9, guide_moving_speed_th=5e-1, excluded_agents=None):
+    def __init__(self, num_disks=5, buffer_dist=0.2, decay_rate=0.9, guide_moving_speed_th=5e-1, excluded_agents=None,
+                 scene_blocked=True, broad_phase=False):
         '''
         - num_disks : the number of disks to use to approximate the agent for collision detection.
                         more disks improves accuracy
         - buffer_dist : additional space to leave between agents
         - decay_rate : how much to decay the loss as time goes on
         - excluded_agents : the collisions among these agents will not be penalized
+        - scene_blocked : only compare each pair of agents in the same scene once instead of all BxB pairs
+        - broad_phase : (scene_blocked only) skip pairs whose bounding circles never overlap
         '''
         super().__init__()
         self.num_disks = num_disks
         self.buffer_dist = buffer_dist
         self.decay_rate = decay_rate
         self.guide_moving_speed_th = guide_moving_speed_th
+        self.scene_blocked = scene_blocked
+        self.broad_phase = broad_phase
 
         self.centroids = None
+        self.agt_rad = None
         self.penalty_dists = None
         self.scene_mask = None
+        self.pair_index = None
         self.excluded_agents = excluded_agents
 
     def init_for_batch(self, example_batch):
@@ -471,12 +478,16 @@ class AgentCollisionLoss(GuidanceLoss):
         # pre-compute disks to approximate each agent
         data_extent = example_batch["extent"]
         self.centroids, agt_rad = self.init_disks(self.num_disks, data_extent) # B x num_disks x 2
+        self.agt_rad = agt_rad
         B = self.centroids.size(0)
         # minimum distance that two vehicle circle centers can be apart without collision (+ buffer)
         self.penalty_dists = agt_rad.view(B, 1).expand(B, B) + agt_rad.view(1, B).expand(B, B) + self.buffer_dist
         
         # pre-compute masking for vectorized pairwise distance computation
-        self.scene_mask = self.init_mask(example_batch['scene_index'], self.centroids.device)
+        if self.scene_blocked:
+            self.pair_index = self.init_pairs(example_batch['scene_index'], self.centroids.device)
+        else:
+            self.scene_mask = self.init_mask(example_batch['scene_index'], self.centroids.device)
 
     def init_disks(self, num_disks, extents):
         NA = extents.size(0)
@@ -502,6 +513,24 @@ class AgentCollisionLoss(GuidanceLoss):
         scene_mask = torch.block_diag(*scene_block_list).to(device)
         return scene_mask
 
+    def init_pairs(self, batch_scene_index, device):
+        '''
+        Indices (2, P) of all pairs of distinct agents in the same scene, each pair listed once (i < j).
+        Each scene is padded to the max number of agents per scene to enumerate its upper triangle.
+        '''
+        _, data_scene_index, scene_size = torch.unique_consecutive(batch_scene_index, return_inverse=True, return_counts=True)
+        data_scene_index = data_scene_index.to(device)
+        scene_size = scene_size.to(device)
+        scene_start = torch.cumsum(scene_size, 0) - scene_size
+        max_agents = int(scene_size.max())
+        # [num_scene, max_agents] agent index of each slot, -1 for padding
+        slot = torch.arange(max_agents, device=device)
+        scene_agents = torch.where(slot[None] < scene_size[:, None], scene_start[:, None] + slot[None], -torch.ones_like(slot[None]))
+        i, j = torch.triu_indices(max_agents, max_agents, offset=1, device=device)
+        pair_i, pair_j = scene_agents[:, i].reshape(-1), scene_agents[:, j].reshape(-1)
+        valid = (pair_i >= 0) & (pair_j >= 0)
+        return torch.stack([pair_i[valid], pair_j[valid]], dim=0)
+
     def forward(self, x, data_batch, agt_mask=None):
         data_extent = data_batch["extent"]
         data_world_from_agent = data_batch["world_from_agent"]
@@ -537,7 +566,7 @@ class AgentCollisionLoss(GuidanceLoss):
             # minimum distance that two vehicle circle centers can be apart without collision (+ buffer)
             penalty_dists = agt_rad.view(B, 1).expand(B, B) + agt_rad.view(1, B).expand(B, B) + self.buffer_dist
         else:
-            centroids, penalty_dists = self.centroids, self.penalty_dists
+            centroids, agt_rad, penalty_dists = self.centroids, self.agt_rad, self.penalty_dists
         centroids = centroids[:,None,None].expand(B, N, T, self.num_disks, 2)
         # to world
         s = torch.sin(yaw_pred_global).unsqueeze(-1)
@@ -558,18 +587,39 @@ class AgentCollisionLoss(GuidanceLoss):
         # plt.show()
         # plt.close(fig)
 
+        # penalize early steps more than later steps
+        exp_weights = torch.tensor([self.decay_rate ** t for t in range(T)], device=centroids.device)
+        exp_weights /= exp_weights.sum()
+
+        if self.scene_blocked:
+            cur_penalties = self.blocked_penalties(centroids, agt_rad, data_extent, scene_index, exp_weights)
+        else:
+            cur_penalties = self.dense_penalties(centroids, penalty_dists, scene_index, exp_weights)
+
+        # consider loss only for those agents that are moving (note: since the loss involves interaction those stationary vehicles will still be indirectly penalized from the loss of other moving vehicles)
+        cur_penalties = torch.where(moving.unsqueeze(-1).expand(B, N), cur_penalties, torch.zeros_like(cur_penalties))
+
+        # print(cur_penalties)
+        if agt_mask is not None:
+            return cur_penalties[agt_mask]
+        else:
+            return cur_penalties
+
+    def dense_penalties(self, centroids, penalty_dists, scene_index, exp_weights):
+        '''
+        Collision penalty of each agent against all others by comparing all BxB pairs of the batch
+        and masking out those from different scenes.
+        - centroids : (B, N, T, D, 2) disk centroids in world frame
+        - penalty_dists : (B, B) minimum allowed distance between disk centers
+        returns (B, N)
+        '''
+        B, N, T = centroids.shape[:3]
         # NOTE: assume each sample is a different scene for the sake of computing collisions
         if self.scene_mask is None:
             scene_mask = self.init_mask(scene_index, centroids.device)
         else:
             scene_mask = self.scene_mask
 
-        # TODO technically we do not need all BxB comparisons
-        #       only need the lower triangle of this matrix (no self collisions and only one way distance)
-        #       but this may be slower to assemble than masking
-
-        # TODO B could contain multiple scenes, could just pad each scene to the max_agents and compare MaxA x MaxA to avoid unneeded comparisons across scenes
-
         centroids = centroids.transpose(0,2) # T x NS x B x D x 2
         centroids = centroids.reshape((T*N, B, self.num_disks, 2))
         # distances between all pairs of circles between all pairs of agents
@@ -591,14 +641,6 @@ class AgentCollisionLoss(GuidanceLoss):
             excluded_agents_mask[0, i_indices, j_indices] = 0    
 
             is_colliding_mask = torch.logical_and(is_colliding_mask, excluded_agents_mask)
-        
-        # # consider collision only for those involving at least one vehicle moving
-        # moving = torch.abs(data_batch['curr_speed']) > self.guide_moving_speed_th
-        # moving1 = moving.view(1, B, 1).expand(1, B, B)
-        # moving2 = moving.view(1, 1, B).expand(1, B, B)
-        # moving_mask = torch.logical_or(moving1, moving2) 
-        # is_colliding_mask = torch.logical_and(is_colliding_mask,
-        #                                       moving_mask)
 
         # penalty is inverse normalized distance apart for those already colliding
         cur_penalties = 1.0 - (pair_dists / penalty_dists)
@@ -609,22 +651,61 @@ class AgentCollisionLoss(GuidanceLoss):
                                         
         # summing over timesteps and all other agents to get B x N
         cur_penalties = cur_penalties.reshape((T, N, B, B))
-        # cur_penalties = cur_penalties.sum(0).sum(-1).transpose(0, 1)
-        # penalize early steps more than later steps
-        exp_weights = torch.tensor([self.decay_rate ** t for t in range(T)], device=cur_penalties.device)
-        exp_weights /= exp_weights.sum()
         cur_penalties = cur_penalties * exp_weights[:, None, None, None]
-        cur_penalties = cur_penalties.sum(0).mean(-1).transpose(0, 1)
+        return cur_penalties.sum(0).mean(-1).transpose(0, 1)
 
-        # consider loss only for those agents that are moving (note: since the loss involves interaction those stationary vehicles will still be indirectly penalized from the loss of other moving vehicles)
-        cur_penalties = torch.where(moving.unsqueeze(-1).expand(B, N), cur_penalties, torch.zeros_like(cur_penalties))
-
-        # print(cur_penalties)
-        if agt_mask is not None:
-            return cur_penalties[agt_mask]
+    def blocked_penalties(self, centroids, agt_rad, extents, scene_index, exp_weights):
+        '''
+        Same as dense_penalties, but only the pairs of agents within the same scene are compared, each once.
+        - agt_rad : (B,) disk radius of each agent
+        returns (B, N)
+        '''
+        B, N, T = centroids.shape[:3]
+        if self.pair_index is None:
+            pair_index = self.init_pairs(scene_index, centroids.device)
         else:
-            return cur_penalties
+            pair_index = self.pair_index
+
+        if self.excluded_agents is not None:
+            excluded = torch.zeros(B, dtype=torch.bool, device=centroids.device)
+            excluded[torch.tensor(self.excluded_agents, device=centroids.device)] = True
+            pair_index = pair_index[:, ~(excluded[pair_index[0]] & excluded[pair_index[1]])]
 
+        # minimum distance that two vehicle circle centers can be apart without collision (+ buffer)
+        pair_penalty_dists = agt_rad[pair_index[0]] + agt_rad[pair_index[1]] + self.buffer_dist
+
+        if self.broad_phase and pair_index.size(1) > 0:
+            # disks are at most |length/2 - radius| away from the agent center, so agents whose centers
+            #       stay farther apart than the penalty distance plus both offsets can never collide
+            with torch.no_grad():
+                center = centroids.mean(-2) # B x N x T x 2
+                disk_offset = torch.abs(extents[:, 0] / 2. - agt_rad) # B
+                reach = pair_penalty_dists + disk_offset[pair_index[0]] + disk_offset[pair_index[1]]
+                center_dists = torch.norm(center[pair_index[0]] - center[pair_index[1]], dim=-1) # P x N x T
+                near = (center_dists <= reach[:, None, None]).flatten(1).any(-1)
+            pair_index = pair_index[:, near]
+            pair_penalty_dists = pair_penalty_dists[near]
+
+        P = pair_index.size(1)
+        cur_cent1 = centroids[pair_index[0]].reshape(P*N*T, self.num_disks, 2)
+        cur_cent2 = centroids[pair_index[1]].reshape(P*N*T, self.num_disks, 2)
+        # get minimum distance over all circle pairs between each pair of agents
+        pair_dists = torch.cdist(cur_cent1, cur_cent2).view(P*N*T, self.num_disks*self.num_disks)
+        pair_dists = torch.min(pair_dists, 1)[0].view(P, N, T)
+
+        pair_penalty_dists = pair_penalty_dists.view(P, 1, 1)
+        # penalty is inverse normalized distance apart for those already colliding
+        cur_penalties = torch.where(pair_dists <= pair_penalty_dists,
+                                    1.0 - (pair_dists / pair_penalty_dists),
+                                    torch.zeros_like(pair_dists))
+        cur_penalties = (cur_penalties * exp_weights).sum(-1) # P x N
+
+        # penalties are symmetric, so each pair counts for both agents.
+        #       normalized by B to match the dense version
+        agent_penalties = torch.zeros((B, N), dtype=cur_penalties.dtype, device=cur_penalties.device)
+        agent_penalties = agent_penalties.index_add(0, pair_index[0], cur_penalties)
+        agent_penalties = agent_penalties.index_add(0, pair_index[1], cur_penalties)
+        return agent_penalties / B
 
 # TODO target waypoint guidance
 #       - Really the target positions should be global not local, will have to do some extra work to transform into
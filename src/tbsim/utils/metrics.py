@@ -520,12 +520,13 @@ def batch_detect_off_road_disk(positions, extents, drivable_region_map):
     # sample along radii to extent for each agent
     ntheta_samp = 13 # sample at 13 angles
     nrad_samp = 4 # sample at 4 radii
-    disk_samp = torch.linspace(0, 2*np.pi, ntheta_samp)
+    disk_samp = torch.linspace(0, 2*np.pi, ntheta_samp, device=positions.device)
     disk_samp = torch.stack([torch.cos(disk_samp), torch.sin(disk_samp)], dim=1) # 13 x 2
     disk_samp = disk_samp[None,None].expand((1, nrad_samp, ntheta_samp, 2))
     
     agt_rad = torch.amin(extents, dim=-1) / 2.0
-    rad_len = torch.stack([torch.linspace(0, agt_rad[ai], nrad_samp+1)[1:] for ai in range(agt_rad.size(0))], dim=0)[:,:,None,None]
+    rad_frac = torch.arange(1, nrad_samp+1, dtype=agt_rad.dtype, device=agt_rad.device) / nrad_samp
+    rad_len = (agt_rad[:,None] * rad_frac[None])[:,:,None,None]
     
     disk_samp = disk_samp * rad_len
     disk_samp = disk_samp.reshape((rad_len.size(0), -1, 2)) # B x 52 x 2
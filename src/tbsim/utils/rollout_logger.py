@@ -5,7 +5,54 @@ from copy import deepcopy
 import tbsim.utils.tensor_utils as TensorUtils
 from tbsim.policies.common import RolloutAction
 
-from torch.nn.utils.rnn import pad_sequence
+
+class ColumnBuffer(object):
+    """
+    Growable [num_agent, T, ...] array holding one logged key of one scene.
+    Integer and boolean keys are stored as float64 so that missing entries can be NaN,
+    and are cast back to their dtype on read when nothing is missing.
+    """
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        if np.issubdtype(self.dtype, np.number) or np.issubdtype(self.dtype, np.bool_):
+            self.storage_dtype = self.dtype if np.issubdtype(self.dtype, np.floating) else np.dtype(np.float64)
+            self.fill_value = np.nan
+        else:
+            self.storage_dtype = self.dtype
+            self.fill_value = np.zeros((), dtype=self.dtype).item()
+        self._data = None
+        self._num_agents = 0
+        self._num_steps = 0
+
+    def _reserve(self, num_agents, num_steps, item_shape):
+        if self._data is None:
+            self._data = np.full((num_agents, max(num_steps, 16)) + item_shape, self.fill_value, dtype=self.storage_dtype)
+            return
+        cap = self._data.shape
+        if num_agents <= cap[0] and num_steps <= cap[1] and all(a <= b for a, b in zip(item_shape, cap[2:])):
+            return
+        # grow geometrically along agents and time so that appends stay amortized O(1)
+        new_cap = (
+            max(cap[0], num_agents if num_agents <= cap[0] else max(num_agents, 2 * cap[0])),
+            max(cap[1], num_steps if num_steps <= cap[1] else max(num_steps, 2 * cap[1])),
+        ) + tuple(max(a, b) for a, b in zip(item_shape, cap[2:]))
+        data = np.full(new_cap, self.fill_value, dtype=self.storage_dtype)
+        data[tuple(slice(0, c) for c in cap)] = self._data
+        self._data = data
+
+    def write(self, rows, ts, values):
+        self._reserve(int(rows.max()) + 1, ts + 1, values.shape[1:])
+        self._data[(rows, ts) + tuple(slice(0, d) for d in values.shape[1:])] = values
+        self._num_agents = max(self._num_agents, int(rows.max()) + 1)
+        self._num_steps = max(self._num_steps, ts + 1)
+
+    def get(self, t_start, t_end, cast=True):
+        block = self._data[:self._num_agents, t_start:t_end]
+        if cast and self.storage_dtype != self.dtype and not np.isnan(block).any():
+            return block.astype(self.dtype)
+        return block
+
+
 class RolloutLogger(object):
     """Log trajectories and other essential info during rollout for visualization and evaluation"""
     def __init__(self, obs_keys=[], info_keys=[], save_action_samples=False):
@@ -14,7 +61,10 @@ class RolloutLogger(object):
         self._scene_indices = None
         self._agent_id_per_scene = dict()
         self._agent_data_by_scene = dict()
+        self._agent_row_by_scene = dict()
+        self._list_data_by_scene = dict()
         self._scene_ts = defaultdict(lambda:0)
+        self._flushed_ts = defaultdict(lambda:0)
 
         self.save_action_samples = save_action_samples
 
@@ -99,23 +149,24 @@ class RolloutLogger(object):
         if self._scene_indices is None:
             self._scene_indices = np.unique(obs["scene_index"])
             self._scene_ts = defaultdict(lambda:0)
+            self._flushed_ts = defaultdict(lambda:0)
             for si in self._scene_indices:
                 self._agent_id_per_scene[si] = obs["track_id"][obs["scene_index"] == si]
             for si in self._scene_indices:
-                self._agent_data_by_scene[si] = defaultdict(lambda:defaultdict(lambda:dict()))
+                self._agent_data_by_scene[si] = dict()
+                self._agent_row_by_scene[si] = dict()
+                self._list_data_by_scene[si] = defaultdict(lambda:defaultdict(lambda:dict()))
 
     def _append_buffer(self, obs, action):
         """
         scene_index:
             dict(
-                action_positions=[[num_agent, ...], [num_agent, ...], ],
-                action_yaws=[[num_agent, ...], [num_agent, ...], ],
-                centroid=[[num_agent, ...], [num_agent, ...], ],
+                action_positions=ColumnBuffer[num_agent, T, ...],
+                action_yaws=ColumnBuffer[num_agent, T, ...],
+                centroid=ColumnBuffer[num_agent, T, ...],
                 ...
             )
         """
-        self._serialized_scene_buffer = None  # need to re-serialize
-
         # TODO: move this to __init__ as arg
         state = {k: obs[k] for k in self._obs_keys}
         state["action_positions"] = action["action"]["positions"][:, [0]]
@@ -138,13 +189,24 @@ class RolloutLogger(object):
         for si in self._scene_indices:
             self._agent_id_per_scene[si] = obs["track_id"][obs["scene_index"] == si]
             scene_mask = np.where(si == obs["scene_index"])[0]
-            scene_state = TensorUtils.map_ndarray(state, lambda x: x[scene_mask])
+            if len(scene_mask) == 0:
+                continue
             ts = self._scene_ts[si]
-            scene_track_id = scene_state["track_id"]
-            for i, ti in enumerate(scene_track_id):
-                for k in scene_state:
-                    self._agent_data_by_scene[si][k][ti][ts] = scene_state[k][i:i+1]
-            
+            # rows of the columnar buffers, in order of first appearance of each track id
+            agent_row = self._agent_row_by_scene[si]
+            for ti in obs["track_id"][scene_mask].tolist():
+                if ti not in agent_row:
+                    agent_row[ti] = len(agent_row)
+            rows = np.array([agent_row[ti] for ti in obs["track_id"][scene_mask].tolist()], dtype=np.int64)
+            for k, v in state.items():
+                if isinstance(v, np.ndarray):
+                    if k not in self._agent_data_by_scene[si]:
+                        self._agent_data_by_scene[si][k] = ColumnBuffer(v.dtype)
+                    self._agent_data_by_scene[si][k].write(rows, ts, v[scene_mask])
+                else:
+                    # non-array entries (e.g. map names) are few and kept as python lists
+                    for r, i in zip(rows.tolist(), scene_mask.tolist()):
+                        self._list_data_by_scene[si][k][r][ts] = v[i:i+1]
 
     def get_serialized_scene_buffer(self):
         """
@@ -155,75 +217,52 @@ class RolloutLogger(object):
                 centroid=[num_agent, T, ...],
                 ...
             )
+        Missing timesteps and entries shorter than the longest one are padded with NaN.
         """
-
-        if self._serialized_scene_buffer is not None:
-            return self._serialized_scene_buffer
-
         serialized = dict()
-        # for each scene
         for si in self._agent_data_by_scene:
             serialized[si] = dict()
-            # for each keyword
-            for k in self._agent_data_by_scene[si]:
-                serialized[si][k]=list()
-                # for each agent
-                for ti in self._agent_data_by_scene[si][k]:
-                    if len(self._agent_data_by_scene[si][k][ti])>0:
-                        default_val = list(self._agent_data_by_scene[si][k][ti].values())[0]
-                        ti_k = list()
-                        for ts in range(self._scene_ts[si]):
-                            ti_k.append(self._agent_data_by_scene[si][k][ti][ts] if ts in self._agent_data_by_scene[si][k][ti] else np.ones_like(default_val)*np.nan)
-                            default_val = ti_k[-1]
-                        if k in ['map_names']:
-                            serialized[si][k].append(ti_k)
-                        else:
-                            if not all(elem.shape==ti_k[0].shape for elem in ti_k):
-                                # requires padding
-                                if np.issubdtype(ti_k[0].dtype,np.floating):
-                                    padding_value = np.nan
-                                else:
-                                    padding_value = 0
-                                ti_k = [x[0] for x in ti_k]
-                                ti_k_torch = TensorUtils.to_tensor(ti_k)
-
-                                # print(k)
-                                # print(padding_value)
-                                # for x in ti_k_torch:
-                                #     print(x.size())
-
-                                ti_k_padded = pad_sequence(ti_k_torch,padding_value=padding_value,batch_first=True)
-                                serialized[si][k].append(TensorUtils.to_numpy(ti_k_padded)[np.newaxis,:])
-                            else:
-                                if ti_k[0].ndim==0:
-                                    serialized[si][k].append(np.array(ti_k)[np.newaxis,:])
-                                else:
-                                    serialized[si][k].append(np.concatenate(ti_k,axis=0)[np.newaxis,:])
-                    else:
-                        serialized[si][k].append(np.zeros_like(serialized[si][k][-1]))
-                if k in ['map_names']:
-                    pass
-                else:
-                    if not all(elem.shape==serialized[si][k][0].shape for elem in serialized[si][k]):
-                        # requires padding
-                        if np.issubdtype(serialized[si][k][0][0].dtype,np.floating):
-                            padding_value = np.nan
-                        else:
-                            padding_value = 0
-                        axes=[1,0]+np.arange(2,serialized[si][k][0].ndim-1).tolist()
-                        mk_transpose = [np.transpose(x[0],axes) for x in serialized[si][k]]
-                        mk_torch = TensorUtils.to_tensor(mk_transpose)
-                        mk_padded = pad_sequence(mk_torch,padding_value=padding_value)
-                        mk = TensorUtils.to_numpy(mk_padded)
-                        axes=[1,2,0]+np.arange(3,mk.ndim).tolist()
-                        serialized[si][k]=np.transpose(mk,axes)
-                    else:
-                        serialized[si][k] = np.concatenate(serialized[si][k],axis=0)
+            for k, col in self._agent_data_by_scene[si].items():
+                serialized[si][k] = col.get(0, self._scene_ts[si]).copy()
+            num_agents = len(self._agent_row_by_scene[si])
+            for k, data_by_agent in self._list_data_by_scene[si].items():
+                serialized[si][k] = [
+                    [data_by_agent[r].get(ts, None) for ts in range(self._scene_ts[si])]
+                    for r in range(num_agents)
+                ]
+        return serialized
 
-                
-
-        self._serialized_scene_buffer = serialized
-        return deepcopy(self._serialized_scene_buffer)
+    def flush_hdf5(self, h5_path):
+        """
+        Append the timesteps logged since the last flush to an hdf5 file.
+        Each scene is written to group str(scene_index) with one resizable dataset
+        [num_agent, T, ...] per array key, so long rollouts can be streamed to disk in chunks.
+        """
+        import h5py
+        with h5py.File(h5_path, "a") as h5:
+            for si in self._agent_data_by_scene:
+                t0, t1 = self._flushed_ts[si], self._scene_ts[si]
+                if t1 <= t0:
+                    continue
+                grp = h5.require_group(str(si))
+                for k, col in self._agent_data_by_scene[si].items():
+                    arr = col.get(t0, t1, cast=False)
+                    if k not in grp:
+                        ds = grp.create_dataset(
+                            k,
+                            shape=(arr.shape[0], t1) + arr.shape[2:],
+                            maxshape=(None,) * arr.ndim,
+                            dtype=arr.dtype,
+                            chunks=True,
+                            fillvalue=col.fill_value,
+                        )
+                    else:
+                        ds = grp[k]
+                        new_shape = (max(ds.shape[0], arr.shape[0]), t1) + \
+                            tuple(max(a, b) for a, b in zip(ds.shape[2:], arr.shape[2:]))
+                        ds.resize(new_shape)
+                    ds[(slice(0, arr.shape[0]), slice(t0, t1)) + tuple(slice(0, d) for d in arr.shape[2:])] = arr
+                self._flushed_ts[si] = t1
 
     def get_trajectory(self):
         """Get per-scene rollout trajectory in the world coordinate system"""
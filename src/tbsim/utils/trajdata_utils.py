@@ -19,6 +19,11 @@ from trajdata.utils.arr_utils import transform_angles_np, transform_coords_np, t
 from trajdata.utils.state_utils import transform_state_np_2d
 from typing import Union
 from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader
+from trajdata.maps.vec_map_elements import MapElementType
+from tqdm import tqdm
+import hashlib
+import json
 
 from typing import Optional
 
@@ -879,84 +884,188 @@ def get_current_lane_by_point(point_xyh, vector_map, world_from_agent_tf=None, a
     lanes_points = torch.as_tensor(lanes_points, dtype=torch.float)
     return lanes_points
 
-def get_closest_lane_point_for_one_agent(agent_history, vector_map, world_from_agent_tf, agent_from_world_tf, params):
+def _agent_current_xyzh(agent_history, world_from_agent_tf):
+    """Current world-frame (x, y, z=0, heading) of an agent from its (T, 8) agent-frame history."""
+    agent_traj = StateArray.from_array(
+        agent_history[-1:],
+        "x,y,xd,yd,xdd,ydd,s,c",
+    )
+    point_xyh = transform_state_np_2d(
+        agent_traj, world_from_agent_tf
+    ).as_format("x,y,h")[-1]
+    # fill in 0.0 for "z" coordinate
+    return np.concatenate([point_xyh[:2], [0.0], angle_wrap(point_xyh[-1:])], axis=0)
+
+def get_current_lane_inds(point_xyzh, vector_map, params):
+    """
+    Indices into vector_map.lanes of the (at most S_seg) lanes the agent could be on,
+    same as the lanes returned by VectorMap.get_current_lane.
+    """
+    lane_kdtree = vector_map.search_kdtrees[MapElementType.ROAD_LANE]
+    inds = lane_kdtree.current_lane_inds(point_xyzh, params['map_max_dist'], params['max_heading_error'])
+    return np.asarray(inds, dtype=np.int64)[:params['S_seg']]
+
+def get_lane_points_in_agent_frame(lanes, point_xyzh, agent_from_world_tf, params):
+    """
+    Waypoints of each candidate lane sorted by distance to the agent, in agent/scene frame,
+    keeping the first S_point waypoints ahead of ahead_threshold. All lanes are processed at once.
+
+    Output:
+        lanes_points: (S_seg, S_point, 4) padded with nan
+    """
+    S_seg = params['S_seg']
+    S_point = params['S_point']
+    lanes_points = np.full((S_seg, S_point, 4), np.nan)
+    if len(lanes) == 0:
+        return lanes_points
+
+    # [num_lanes, P, 4] waypoints in world frame, padded with nan
+    num_points = [len(lane.center.points) for lane in lanes]
+    xyzh_world = np.full((len(lanes), max(num_points), 4), np.nan)
+    for i, lane in enumerate(lanes):
+        xyzh_world[i, :num_points[i]] = lane.center.points
+
+    dist = params['dist_weight'] * np.linalg.norm(xyzh_world[..., :2] - point_xyzh[:2], axis=-1) \
+        + params['heading_weight'] * np.abs(xyzh_world[..., -1] - point_xyzh[-1])
+
+    # transform to coordinate from world to agent/scene
+    xyzh_on_lane = xyzh_world.copy()
+    xyzh_on_lane[..., :2] = transform_coords_np(xyzh_world[..., :2], agent_from_world_tf)
+    xyzh_on_lane[..., -1] = transform_angles_np(xyzh_world[..., -1], agent_from_world_tf)
+
+    # sort waypoints, only keeping those ahead (padding and waypoints behind sort last)
+    keep = xyzh_on_lane[..., 0] > params['ahead_threshold']
+    dist = np.where(keep, dist, np.inf)
+    order = np.argsort(dist, axis=1, kind="stable")[:, :S_point]
+    kept = np.take_along_axis(keep, order, axis=1)
+    xyzh_on_lane = np.take_along_axis(xyzh_on_lane, order[..., None], axis=1)
+    xyzh_on_lane[~kept] = np.nan
+
+    lanes_points[:len(lanes), :xyzh_on_lane.shape[1]] = xyzh_on_lane
+    return lanes_points
+
+def get_closest_lane_point_for_one_agent(agent_history, vector_map, world_from_agent_tf, agent_from_world_tf, params, lane_inds=None):
         '''
+        Input:
+            lane_inds: precomputed indices of the candidate lanes in vector_map.lanes (see ClosestLaneCache),
+                queried from the lane kdtree if None
         Output:
             lanes_points: (S_seg, S_point, 4)
         '''
-        S_seg = params['S_seg']
-        S_point = params['S_point']
-        map_max_dist = params['map_max_dist']
-        max_heading_error = params['max_heading_error']
-        dist_weight = params['dist_weight']
-        heading_weight = params['heading_weight']
-        ahead_threshold = params['ahead_threshold']
-        
-        agent_traj = StateArray.from_array(
-            agent_history,
-            "x,y,xd,yd,xdd,ydd,s,c",
-        )
-        agent_traj_xyh_world = transform_state_np_2d(
-            agent_traj, world_from_agent_tf
-        ).as_format("x,y,h")
-
-        # Use cached kdtree to find closest lane point
-        
         # get the current position of the agent
-        point_xyh = agent_traj_xyh_world[-1]
-
-        # fill in 0.0 for "z" coordinate
-        point_xyzh = np.concatenate([point_xyh[:2], [0.0], angle_wrap(point_xyh[-1:])], axis=0)
-        # [4] -> List[RoadLane]
-        possible_lanes = vector_map.get_current_lane(point_xyzh, max_dist=map_max_dist, max_heading_error=max_heading_error)
-
-        num_lanes = np.amin([len(possible_lanes), S_seg])
-        possible_lanes_shortened = possible_lanes[:num_lanes]
-        
-        if len(possible_lanes_shortened) > 0:
-            lanes_points_list = []
-            for i, possible_lane in enumerate(possible_lanes_shortened):
-                xyzh_on_lane_original = possible_lane.center.points
-                
-                dist = dist_weight * np.linalg.norm(xyzh_on_lane_original[:, :2] - point_xyzh[:2], axis=-1) + heading_weight * np.abs(xyzh_on_lane_original[:, -1] - point_xyzh[-1])
-                inds = np.argsort(dist).tolist()
-
-                # transform to coordinate from world to agent/scene
-                xyzh_on_lane = xyzh_on_lane_original.copy()
-                xyzh_on_lane[:, :2] = transform_coords_np(
-                    xyzh_on_lane_original[:, :2], agent_from_world_tf
-                )
-                xyzh_on_lane[:, -1] = transform_angles_np(
-                    xyzh_on_lane_original[:, -1], agent_from_world_tf
-                )
-
-                # sort waypoints
-                xyzh_on_lane = xyzh_on_lane[inds]
-                # only keep waypoints ahead
-                waypoints_ahead_mask = xyzh_on_lane[:, 0] > ahead_threshold
-                xyzh_on_lane = xyzh_on_lane[waypoints_ahead_mask]
-                xyzh_on_lane = xyzh_on_lane[:np.amin([len(xyzh_on_lane), S_point])]
-
-                # fill to S_point with nan
-                if xyzh_on_lane.shape[0] < S_point:
-                    xyzh_on_lane = np.concatenate([xyzh_on_lane, np.full((S_point-xyzh_on_lane.shape[0], 4), np.nan)], axis=0)
-
-                lanes_points_list.append(xyzh_on_lane)
-
-            lanes_points = np.stack(lanes_points_list, axis=0)
-
-        else:
-            lanes_points = np.full((S_seg, S_point, 4), np.nan)
+        point_xyzh = _agent_current_xyzh(agent_history, world_from_agent_tf)
+        if lane_inds is None:
+            lane_inds = get_current_lane_inds(point_xyzh, vector_map, params)
+        lanes = [vector_map.lanes[i] for i in lane_inds]
 
-        # fill to S_point with nan
-        if lanes_points.shape[0] < S_seg:
-            lanes_points = np.concatenate([lanes_points, np.full((S_seg-lanes_points.shape[0], S_point, 4), np.nan)], axis=0)
+        lanes_points = get_lane_points_in_agent_frame(lanes, point_xyzh, agent_from_world_tf, params)
 
         # convert to tensor
         lanes_points = torch.as_tensor(lanes_points, dtype=torch.float)
         return lanes_points
 
-def get_closest_lane_point_wrapper(vec_map_params={}):
+
+class ClosestLaneCache(object):
+    """
+    Memory-mapped store of the candidate lanes of every (scene, agent, timestep) of a dataset,
+    i.e. the result of the lane kdtree query done by the closest_lane_point extra.
+    It is written once by build() next to the trajdata cache and read by the data loader workers;
+    samples that are not in the cache fall back to querying the map.
+    """
+    def __init__(self, cache_dir, vec_map_params):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.params = vec_map_params
+        self._keys = None
+        self._lane_inds = None
+
+    @staticmethod
+    def get_cache_dir(cache_location, desired_data, desired_dt, vec_map_params):
+        """Cache directory for a dataset, unique to its data sources, dt and lane query params."""
+        desc = json.dumps(dict(
+            desired_data=sorted(desired_data),
+            desired_dt=desired_dt,
+            params={k: vec_map_params[k] for k in ("S_seg", "map_max_dist", "max_heading_error")},
+        ), sort_keys=True)
+        name = hashlib.md5(desc.encode()).hexdigest()[:16]
+        return Path(cache_location).expanduser() / "closest_lane_point" / name
+
+    @staticmethod
+    def make_key(scene_id, agent_name, scene_ts):
+        return "{}/{}/{}".format(scene_id, agent_name, scene_ts)
+
+    def exists(self):
+        return (self.cache_dir / "meta.json").exists()
+
+    def _load(self):
+        self._keys = np.load(self.cache_dir / "keys.npy", mmap_mode="r")
+        self._lane_inds = np.load(self.cache_dir / "lane_inds.npy", mmap_mode="r")
+
+    def lookup(self, scene_id, agent_name, scene_ts):
+        """Candidate lane indices of an agent, or None if not cached."""
+        if self._keys is None:
+            if not self.exists():
+                return None
+            self._load()
+        key = self.make_key(scene_id, agent_name, scene_ts)
+        i = np.searchsorted(self._keys, key)
+        if i >= len(self._keys) or self._keys[i] != key:
+            return None
+        inds = self._lane_inds[i]
+        return inds[inds >= 0]
+
+    def build(self, dataset, batch_size=64, num_workers=0):
+        """Query the candidate lanes of every element of @dataset and write them to the cache."""
+        extras, incl_raster_map = dataset.extras, dataset.incl_raster_map
+        dataset.extras = {"closest_lane_inds": _closest_lane_inds_extra(self.params)}
+        dataset.incl_raster_map = False
+        try:
+            loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                                collate_fn=_collate_closest_lane_inds)
+            keys, lane_inds = [], []
+            for batch_keys, batch_inds in tqdm(loader, desc="caching closest lanes"):
+                keys.extend(batch_keys)
+                lane_inds.extend(batch_inds)
+        finally:
+            dataset.extras, dataset.incl_raster_map = extras, incl_raster_map
+
+        keys = np.array(keys)
+        order = np.argsort(keys)
+        padded = np.full((len(lane_inds), self.params["S_seg"]), -1, dtype=np.int32)
+        for i, inds in enumerate(lane_inds):
+            padded[i, :len(inds)] = inds
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        np.save(self.cache_dir / "keys.npy", keys[order])
+        np.save(self.cache_dir / "lane_inds.npy", padded[order])
+        with open(self.cache_dir / "meta.json", "w") as f:
+            json.dump(dict(num_entries=len(keys), params=self.params), f)
+
+
+def _closest_lane_inds_extra(params):
+    def closest_lane_inds(element: Union[AgentBatchElement, SceneBatchElement]):
+        vector_map: VectorMap = element.vec_map
+        if isinstance(element, AgentBatchElement):
+            world_from_agent_tf = np.linalg.inv(element.agent_from_world_tf)
+            agents = [(element.agent_name, element.agent_history_np)]
+        else:
+            world_from_agent_tf = element.centered_world_from_agent_tf
+            agents = zip(element.agent_names, element.agent_histories)
+        out = []
+        for agent_name, agent_history in agents:
+            point_xyzh = _agent_current_xyzh(agent_history, world_from_agent_tf)
+            key = ClosestLaneCache.make_key(element.scene_id, agent_name, element.scene_ts)
+            out.append((key, get_current_lane_inds(point_xyzh, vector_map, params)))
+        return out
+    return closest_lane_inds
+
+def _collate_closest_lane_inds(elements):
+    keys, lane_inds = [], []
+    for element in elements:
+        for key, inds in element.extras["closest_lane_inds"]:
+            keys.append(key)
+            lane_inds.append(inds)
+    return keys, lane_inds
+
+def get_closest_lane_point_wrapper(vec_map_params={}, lane_cache=None):
     # print('vec_map_params', vec_map_params)
     if vec_map_params == {}:
         # fill in default values
@@ -987,8 +1096,11 @@ def get_closest_lane_point_wrapper(vec_map_params={}):
             world_from_agent_tf = np.linalg.inv(agent_from_world_tf)
             # (T, 8)
             agent_history = element.agent_history_np
+            lane_inds = None
+            if lane_cache is not None:
+                lane_inds = lane_cache.lookup(element.scene_id, element.agent_name, element.scene_ts)
             
-            lane_points_cur_agent = get_closest_lane_point_for_one_agent(agent_history, vector_map, world_from_agent_tf, agent_from_world_tf, vec_map_params)
+            lane_points_cur_agent = get_closest_lane_point_for_one_agent(agent_history, vector_map, world_from_agent_tf, agent_from_world_tf, vec_map_params, lane_inds=lane_inds)
             # (x, y, z, heading) -> (x, y, heading)
             lane_points = lane_points_cur_agent[..., [0, 1, 3]]
             assert len(lane_points.shape) == 3, f"lane_points.shape: {lane_points.shape}"
@@ -1000,7 +1112,10 @@ def get_closest_lane_point_wrapper(vec_map_params={}):
 
             lane_points_list = []
             for i, agent_history in enumerate(agent_histories):
-                lane_points_cur_agent = get_closest_lane_point_for_one_agent(agent_history, vector_map, world_from_agent_tf, agent_from_world_tf, vec_map_params)
+                lane_inds = None
+                if lane_cache is not None:
+                    lane_inds = lane_cache.lookup(element.scene_id, element.agent_names[i], element.scene_ts)
+                lane_points_cur_agent = get_closest_lane_point_for_one_agent(agent_history, vector_map, world_from_agent_tf, agent_from_world_tf, vec_map_params, lane_inds=lane_inds)
                 lane_points_list.append(lane_points_cur_agent)
 
             # (M, S_seg, S_p, 4)
@@ -7,6 +7,8 @@ from tbsim.models.diffuser_helpers import EMA
 from models.vae.vae_model import VaeModel
 from models.dm.dm_model import DmModel
 import torch.nn.functional as F
+import tbsim.utils.tensor_utils as TensorUtils
+from tbsim.policies.common import Action
 
 class DMLightningModule(pl.LightningModule):
     def __init__(self, algo_config,train_config, modality_shapes,vae_model_path=None):
@@ -92,16 +94,39 @@ class DMLightningModule(pl.LightningModule):
                 }
             
   
+    def encode_batch(self, batch):
+        '''
+        Latent of the target trajectory and the condition of the frozen VAE.
+        Accepts raw trajdata batches and rows of a LatentCache (utils/latent_cache.py),
+        which already hold the VAE outputs so that only the posterior is sampled here.
+        Output:
+            z: (B, latent) sampled latent
+            aux_info: dict with context (B, cond) and curr_states (B, 4)
+            scaled_input: (B, T, 6) scaled target trajectory
+            avail: (B, T) target availabilities
+        '''
+        vae = self.ema_vae if self.use_ema else self.vae
+        if "mu" in batch:
+            aux_info = {
+                'context': batch['context'],
+                'curr_states': batch['curr_states']
+            }
+            z = vae.lstmvae.reparametize(batch['mu'], batch['logvar'])#[B,128]
+            return z, aux_info, batch['scaled_input'], batch['target_availabilities']
+
+        batch = batch_utils().parse_batch(batch)
+        aux_info,scaled_input = vae.pre_vae(batch)
+        z = vae.lstmvae.getZ(scaled_input,aux_info["context"])#[B,128]
+        return z, aux_info, scaled_input, batch['target_availabilities'][:, :scaled_input.shape[1]]
+
     def training_step(self, batch):
-        batch = batch_utils().parse_batch(batch)     
-        
-        aux_info,_,scaled_input = self.ema_vae.pre_vae(batch)
-        z = self.ema_vae.lstmvae.getZ(scaled_input,aux_info["context"])#[B,128]
+        z, aux_info, scaled_input, avail = self.encode_batch(batch)
+        vae = self.ema_vae if self.use_ema else self.vae
         z_0_recon = self.dm.compute_losses(z,aux_info)
-        traj_recon = self.ema_vae.z2traj(z_0_recon,aux_info)
+        traj_recon = vae.z2traj(z_0_recon,aux_info)
 
-        traj_recon = traj_recon*batch['target_availabilities'].unsqueeze(-1)
-        scaled_input = scaled_input*batch['target_availabilities'].unsqueeze(-1)
+        traj_recon = traj_recon*avail.unsqueeze(-1)
+        scaled_input = scaled_input*avail.unsqueeze(-1)
 
         loss = F.mse_loss(traj_recon,scaled_input)
         self.log('train/dm_loss',loss, on_step=True, on_epoch=False,batch_size=self.batch_size)
@@ -110,19 +135,48 @@ class DMLightningModule(pl.LightningModule):
      
   
     def validation_step(self, batch):
-        batch = batch_utils().parse_batch(batch)
-       
-        aux_info,_,scaled_input = self.ema_vae.pre_vae(batch)
-        z = self.ema_vae.lstmvae.getZ(scaled_input,aux_info["context"])#[B,128]
+        z, aux_info, scaled_input, avail = self.encode_batch(batch)
+        vae = self.ema_vae if self.use_ema else self.vae
         z_0_recon = self.dm.compute_losses(z,aux_info)
-        traj_recon = self.ema_vae.z2traj(z_0_recon,aux_info)
+        traj_recon = vae.z2traj(z_0_recon,aux_info)
 
-        traj_recon = traj_recon*batch['target_availabilities'].unsqueeze(-1)
-        scaled_input = scaled_input*batch['target_availabilities'].unsqueeze(-1)
+        traj_recon = traj_recon*avail.unsqueeze(-1)
+        scaled_input = scaled_input*avail.unsqueeze(-1)
 
         loss = F.mse_loss(traj_recon,scaled_input)
 
         self.log('val/loss',loss,on_step=False, on_epoch=True,batch_size=self.batch_size)
+
+    @torch.no_grad()
+    def get_action(self, obs_dict, **kwargs):
+        '''
+        Closed-loop inference: sample latents without keeping the per-step denoising records
+        and decode them into agent-frame trajectories.
+        Output:
+            action: Action with positions (B, T, 2) and yaws (B, T, 1) of the first sample
+            info: dict with action_samples (B, N, T, ...)
+        '''
+        vae = self.ema_vae if self.use_ema else self.vae
+        dm = self.ema_dm if self.use_ema else self.dm
+        num_samp = self.algo_config.num_samp
+
+        aux_info = vae.get_aux_info(obs_dict)
+        z, _ = dm(obs_dict, aux_info, self.algo_config, return_traj=False)#[B*N,D]
+        aux_info = TensorUtils.repeat_by_expand_at(aux_info, repeats=num_samp, dim=0)
+        traj = vae.descale_traj(vae.z2traj(z, aux_info))#[B*N,T,6]
+        traj = TensorUtils.reshape_dimensions(traj, begin_axis=0, end_axis=1, target_dims=(-1, num_samp))#[B,N,T,6]
+
+        action = Action(
+            positions=traj[:, 0, :, :2],
+            yaws=traj[:, 0, :, 3:4]
+        )
+        info = dict(
+            action_samples=Action(
+                positions=traj[..., :2],
+                yaws=traj[..., 3:4]
+            ).to_dict(),
+        )
+        return action, info
    
     
       
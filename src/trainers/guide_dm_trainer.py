@@ -5,7 +5,9 @@ from tbsim.utils.batch_utils import batch_utils
 import pytorch_lightning as pl
 from tbsim.models.diffuser_helpers import EMA
 from models.vae.vae_model import VaeModel
-from models.dm.dm_model import DmModel
+from models.dm.dm_model import DmModel,normal_log_prob
+from models.dm.traj_buffer import DenoiseTrajBuffer
+import tbsim.utils.tensor_utils as TensorUtils
 from tbsim.utils.trajdata_utils import get_stationary_mask
 from models.rl.criticmodel import compute_reward
 class GuideDMLightningModule(pl.LightningModule):
@@ -26,7 +28,18 @@ class GuideDMLightningModule(pl.LightningModule):
             algo_config.mlp_blocks,
             algo_config.num_infer,
             )
+        # the PPO ratio evaluates the new policy with the full-schedule posterior (x_tminus1_mean),
+        # so the recorded trajectory must come from the full-length ancestral sampler
+        num_sample_steps = algo_config.get("num_sample_steps", None) or self.dm.n_timesteps
+        assert algo_config.get("sampler", "ddpm") == "ddpm" and \
+            len(self.dm.get_sample_timesteps(num_sample_steps)) == self.dm.n_timesteps, \
+            "RL fine-tuning needs sampler='ddpm' with all n_timesteps sampling steps"
         self.rl = None
+        # stack all denoising steps into one [T*B, D] batch when computing the policy ratio
+        self.fused_log_ratio = algo_config.get("fused_log_ratio", True)
+        # optionally keep only the last traj_buffer_steps denoising steps in a reusable ring buffer
+        traj_buffer_steps = algo_config.get("traj_buffer_steps", None)
+        self.traj_buffer = DenoiseTrajBuffer(traj_buffer_steps) if traj_buffer_steps else None
         self.use_ema = algo_config.use_ema
         if self.use_ema:
             print('DIFFUSER: using EMA... val and get_action will use ema model')
@@ -138,18 +151,41 @@ class GuideDMLightningModule(pl.LightningModule):
                 }
             
   
-    def training_step(self, batch):
-        batch = batch_utils().parse_batch(batch) 
-
-        aux_info,*_ = self.ema_vae.pre_vae(batch)
-        with torch.no_grad():
-            x0_old, traj_data_old = self.old_dm(batch, aux_info, self.algo_config)
-        trajectory = self.ema_vae.z2traj(x0_old,aux_info)#翻译到物理空间
-        
-
+    def compute_ratio(self, traj_data, aux_info):
+        '''
+        Per-step likelihood ratio between the current dm and the old dm that sampled traj_data
+        Input:
+            traj_data: list of T step dicts (x_t, x_tminus1, mean_t, sigma_t, t) from DmModel.forward
+            aux_info: dict with conditioning of shape [B, ...], shared by the N samples of each agent
+        Output:
+            ratio: (T, B*N) exp(logp_new - logp_old)
+        '''
+        if self.fused_log_ratio:
+            return self._fused_ratio(traj_data, aux_info)
+        return self._stepwise_ratio(traj_data, aux_info)
+
+    def _fused_ratio(self, traj_data, aux_info):
+        T = len(traj_data)
+        x_t = torch.cat([step_info["x_t"] for step_info in traj_data], dim=0)#[T*B,D]
+        x_tminus1 = torch.cat([step_info["x_tminus1"] for step_info in traj_data], dim=0)
+        old_mean_t = torch.cat([step_info["mean_t"] for step_info in traj_data], dim=0)
+        old_sigma_t = torch.cat([step_info["sigma_t"] for step_info in traj_data], dim=0)
+        t = torch.cat([step_info["t"] for step_info in traj_data], dim=0)#[T*B]
+
+        # tile (not interleave) the conditioning so row k*B+b matches the samples of step k, agent b
+        aux_info = TensorUtils.unsqueeze_expand_at(aux_info, T, 0)
+        aux_info = TensorUtils.join_dimensions(aux_info, 0, 2)#[T*B,...]
+
+        new_model_mean, _, model_log_variance = self.dm.x_tminus1_mean(x_t, t, aux_info)
+        logp_new = normal_log_prob(x_tminus1, new_model_mean, 0.5 * model_log_variance).sum(dim=-1)
+        logp_old = normal_log_prob(x_tminus1, old_mean_t, old_sigma_t.log()).sum(dim=-1)
+
+        return torch.exp(logp_new - logp_old).reshape(T, -1)
+
+    def _stepwise_ratio(self, traj_data, aux_info):
         logp_new_list = []
         logp_old_list = []
-        for step_info in traj_data_old:
+        for step_info in traj_data:
             x_t = step_info["x_t"]
             x_tminus1 = step_info["x_tminus1"]
             old_mean_t = step_info["mean_t"]
@@ -171,7 +207,18 @@ class GuideDMLightningModule(pl.LightningModule):
         logp_new_stacked = torch.stack(logp_new_list, dim=0)
         logp_old_stacked = torch.stack(logp_old_list, dim=0)  
 
-        ratio_stacked = torch.exp(logp_new_stacked - logp_old_stacked)  # [T, B]
+        return torch.exp(logp_new_stacked - logp_old_stacked)  # [T, B]
+
+    def training_step(self, batch):
+        batch = batch_utils().parse_batch(batch) 
+
+        aux_info,*_ = self.ema_vae.pre_vae(batch)
+        with torch.no_grad():
+            x0_old, traj_data_old = self.old_dm(batch, aux_info, self.algo_config, traj_buffer=self.traj_buffer)
+        trajectory = self.ema_vae.z2traj(x0_old,aux_info)#翻译到物理空间
+        
+
+        ratio_stacked = self.compute_ratio(traj_data_old, aux_info)  # [T, B]
         ratio_sum = ratio_stacked.sum(dim=0)  # => [B]
         
         # self.stationary_mask = get_stationary_mask(batch, self.disable_control_on_stationary, self.moving_speed_th)
@@ -198,35 +245,11 @@ class GuideDMLightningModule(pl.LightningModule):
 
         aux_info,*_ = self.ema_vae.pre_vae(batch)
         with torch.no_grad():
-            x0_old, traj_data_old = self.old_dm(batch, aux_info, self.algo_config)
+            x0_old, traj_data_old = self.old_dm(batch, aux_info, self.algo_config, traj_buffer=self.traj_buffer)
         trajectory = self.ema_vae.z2traj(x0_old,aux_info)#翻译到物理空间
         
 
-        logp_new_list = []
-        logp_old_list = []
-        for step_info in traj_data_old:
-            x_t = step_info["x_t"]
-            x_tminus1 = step_info["x_tminus1"]
-            old_mean_t = step_info["mean_t"]
-            old_sigma_t = step_info["sigma_t"]
-            t = step_info["t"]
-
-            new_model_mean, _, model_log_variance = self.dm.x_tminus1_mean(x_t,t,aux_info)
-            new_sigma = (0.5 * model_log_variance).exp()
-            dist_new = torch.distributions.Normal(new_model_mean, new_sigma)
-            logp_new_t = dist_new.log_prob(x_tminus1).sum(dim=-1)  # [B]
-
-
-            dist_old = torch.distributions.Normal(old_mean_t, old_sigma_t)
-            logp_old_t = dist_old.log_prob(x_tminus1).sum(dim=-1)  # [B]
-
-            logp_new_list.append(logp_new_t)
-            logp_old_list.append(logp_old_t)
-
-        logp_new_stacked = torch.stack(logp_new_list, dim=0)
-        logp_old_stacked = torch.stack(logp_old_list, dim=0)  
-
-        ratio_stacked = torch.exp(logp_new_stacked - logp_old_stacked)  # [T, B]
+        ratio_stacked = self.compute_ratio(traj_data_old, aux_info)  # [T, B]
         ratio_sum = ratio_stacked.sum(dim=0)  # => [B]
         
         reward = self.rl(batch, trajectory, aux_info) 
@@ -5,7 +5,10 @@ from tbsim.utils.trajdata_utils import set_global_trajdata_batch_env, set_global
 from datetime import  datetime
 from configs.custom_config import dict_to_config,ConfigBase
 from tbsim.configs.base import ExperimentConfig
+from tbsim.utils.config_utils import translate_pass_trajdata_cfg
+from tbsim.datasets.trajdata_datamodules import PassUnifiedDataModule
 from utils.trainer_utils import prepare_trainer_and_data,prepare_for_guided_dm
+from utils.norm_stats import get_or_compute_norm_stats
 
 
 def train_vae(cfg,debug=False):
@@ -18,39 +21,15 @@ def train_dm(cfg,debug=False):
 
 def train_guide_dm(cfg,debug=False):
     trainer, datamodule,model, ckpt = prepare_for_guided_dm(cfg,debug=cfg.train.debug)
-    import torch
-    from tbsim.utils.batch_utils import batch_utils
-    from tbsim.models.diffuser_helpers import convert_state_to_state_and_action
-    dataloader = datamodule.train_dataloader()
+    trainer.fit(model=model,datamodule=datamodule,ckpt_path=ckpt)
 
-
-    total_sum = None
-    total_sum_sq = None
-    total_count = 0
-    with torch.no_grad():
-        for batch in dataloader:
-            batch = batch_utils().parse_batch(batch) 
-            traj_state = torch.cat(
-                (batch["target_positions"][:, :52, :], batch["target_yaws"][:, :52, :]), dim=2)
-            traj_state_and_action = convert_state_to_state_and_action(traj_state, batch["curr_speed"], 0.1)
-            B, T, D = traj_state_and_action.shape
-            data = traj_state_and_action.reshape(-1, D)
-
-            if total_sum is None:
-                total_sum = data.sum(dim=0)
-                total_sum_sq = (data ** 2).sum(dim=0)
-            else:
-                total_sum += data.sum(dim=0)
-                total_sum_sq += (data ** 2).sum(dim=0)
-            total_count += data.size(0)
-            if total_count%100==0:
-                print(total_count)
-    mean = total_sum / total_count
-    var = total_sum_sq / total_count - mean ** 2
-    std = torch.sqrt(var)
-    print(f"mean:{mean}, std:{std}")
-    #mean:tensor([ 3.9122e+00, -1.4352e-03,  1.5173e+00,  7.2863e-05,  8.3396e-03, 6.0973e-05]), std:tensor([9.5063, 1.5163, 3.1296, 0.1343, 2.0385, 0.0574])
-    # trainer.fit(model=model,datamodule=datamodule,ckpt_path=ckpt)
+def compute_stats(cfg):
+    """One pass over the training set to compute the normalization stats file of every group."""
+    datamodule = PassUnifiedDataModule(translate_pass_trajdata_cfg(cfg), cfg.train)
+    datamodule.setup()
+    stats_path = get_or_compute_norm_stats(datamodule, cfg.algo.horizon,
+                                           rebuild=cfg.train.get("rebuild_norm_stats", False))
+    print(f"norm stats: {stats_path}, set algo.norm_stats_path to use them")
 
 def create_wandb_dir(base_dir="logs"):
     """
@@ -75,6 +54,8 @@ def main(cfg):
         train_dm(cfg)
     elif cfg.train.mode == 'guide_dm':
         train_guide_dm(cfg)
+    elif cfg.train.mode == 'compute-stats':
+        compute_stats(cfg)
     else:
         raise ValueError(f"Unknown train mode: {cfg.train.mode}") 
 
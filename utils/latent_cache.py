@@ -0,0 +1,178 @@
+import os,json,hashlib
+from pathlib import Path
+import numpy as np
+import torch
+import pytorch_lightning as pl
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+from tbsim.utils.batch_utils import batch_utils
+import tbsim.utils.tensor_utils as TensorUtils
+from tbsim.models.diffuser_helpers import load_norm_stats
+from utils.norm_stats import get_samples_desc
+
+
+class LatentCache(object):
+    """
+    Memory-mapped store of what the frozen VAE computes for every sample of a dataset:
+    the condition (context, curr_states), the posterior (mu, logvar) of the latent and the
+    scaled target trajectory the DM loss is measured against.
+    DM training reads these rows instead of rasterizing and encoding each sample again.
+    """
+    FIELDS = ("context", "curr_states", "mu", "logvar", "scaled_input", "target_availabilities")
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self._arrays = None
+
+    @staticmethod
+    def get_cache_dir(data_config, desired_data, vae_model_path, algo_config):
+        """
+        Cache directory of a dataset, unique to its data sources, to the data config fields that change its samples
+        (as for the norm stats file), to the raster parameters, to the VAE checkpoint that encoded it and to the
+        values of the norm stats it was scaled with.
+        """
+        ckpt = Path(vae_model_path).expanduser()
+        norm_stats_path = algo_config.get("norm_stats_path", None)
+        norm_stats = None if norm_stats_path is None else load_norm_stats(norm_stats_path)
+        desc = get_samples_desc(data_config)
+        desc.update(
+            desired_data=sorted(desired_data),
+            incl_map=data_config.trajdata_incl_map,
+            pixel_size=data_config.pixel_size,
+            raster_size=data_config.raster_size,
+            raster_center=data_config.raster_center,
+            no_map_fill_value=data_config.no_map_fill_value,
+            num_sem_layers=data_config.num_sem_layers,
+            vae_model_path=str(ckpt.resolve()),
+            vae_mtime=os.path.getmtime(ckpt),
+            horizon=algo_config.horizon,
+            norm_stats=hashlib.md5(json.dumps(norm_stats, sort_keys=True).encode()).hexdigest(),
+        )
+        name = hashlib.md5(json.dumps(desc, sort_keys=True).encode()).hexdigest()[:16]
+        return Path(data_config.trajdata_cache_location).expanduser() / "dm_latents" / name
+
+    def exists(self):
+        return (self.cache_dir / "meta.json").exists()
+
+    def __len__(self):
+        with open(self.cache_dir / "meta.json", "r") as f:
+            return json.load(f)["num_entries"]
+
+    def load(self):
+        """Field name -> read-only memmap of shape [N, ...]."""
+        if self._arrays is None:
+            self._arrays = {k: np.load(self.cache_dir / (k + ".npy"), mmap_mode="r") for k in self.FIELDS}
+        return self._arrays
+
+    @torch.no_grad()
+    def build(self, vae, dataset, batch_size=64, num_workers=0, device="cpu"):
+        """Encode every element of @dataset with @vae (in eval mode) and write the rows in dataset order."""
+        extras = dataset.extras
+        dataset.extras = {}
+        training = vae.training
+        vae.eval()
+        arrays = None
+        num_entries = 0
+        try:
+            loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False,
+                                collate_fn=dataset.get_collate_fn(return_dict=True))
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            for batch in tqdm(loader, desc="encoding dm latents"):
+                batch = batch_utils().parse_batch(TensorUtils.to_device(batch, device))
+                rows = encode_batch(vae, batch)
+                if arrays is None:
+                    arrays = {
+                        k: np.lib.format.open_memmap(self.cache_dir / (k + ".npy"), mode="w+",
+                                                     dtype=v.dtype, shape=(len(dataset),) + v.shape[1:])
+                        for k, v in rows.items()
+                    }
+                n = len(rows["context"])
+                for k, v in rows.items():
+                    arrays[k][num_entries:num_entries + n] = v
+                num_entries += n
+        finally:
+            dataset.extras = extras
+            vae.train(training)
+
+        if arrays is None:
+            # no meta.json is written, so the directory is not taken for a valid cache
+            raise ValueError("no batch to encode in the latent cache " + str(self.cache_dir) + ", is the dataset empty?")
+        for v in arrays.values():
+            v.flush()
+        with open(self.cache_dir / "meta.json", "w") as f:
+            json.dump(dict(num_entries=num_entries, fields=list(self.FIELDS)), f)
+
+
+def encode_batch(vae, batch):
+    """Rows of the latent cache of a parsed batch, as numpy arrays."""
+    aux_info, scaled_input = vae.pre_vae(batch)
+    mu, logvar = vae.lstmvae.encode(scaled_input, aux_info["context"])
+    rows = dict(
+        context=aux_info["context"],
+        curr_states=aux_info["curr_states"],
+        mu=mu,
+        logvar=logvar,
+        scaled_input=scaled_input,
+    )
+    rows = {k: v.float().cpu().numpy() for k, v in rows.items()}
+    rows["target_availabilities"] = batch["target_availabilities"][:, :scaled_input.shape[1]].cpu().numpy()
+    return rows
+
+
+class LatentCacheDataset(Dataset):
+    """Rows of a LatentCache. The memmaps are opened lazily so that each data loader worker maps its own."""
+    def __init__(self, cache_dir):
+        self.cache = LatentCache(cache_dir)
+        self._len = len(self.cache)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, idx):
+        return {k: torch.from_numpy(np.array(v[idx])) for k, v in self.cache.load().items()}
+
+
+class LatentCacheDataModule(pl.LightningDataModule):
+    """Serves the latent caches of the train and valid sets of a PassUnifiedDataModule."""
+    def __init__(self, train_cache_dir, valid_cache_dir, train_config):
+        super().__init__()
+        self._train_config = train_config
+        self.train_dataset = LatentCacheDataset(train_cache_dir)
+        self.valid_dataset = LatentCacheDataset(valid_cache_dir)
+
+    def train_dataloader(self):
+        return DataLoader(
+            dataset=self.train_dataset,
+            shuffle=True,
+            batch_size=self._train_config.training.batch_size,
+            num_workers=self._train_config.training.num_data_workers,
+            drop_last=True,
+            pin_memory=True,
+            persistent_workers=self._train_config.training.num_data_workers > 0,
+        )
+
+    def val_dataloader(self):
+        return DataLoader(
+            dataset=self.valid_dataset,
+            shuffle=False,
+            batch_size=self._train_config.validation.batch_size,
+            num_workers=self._train_config.validation.num_data_workers,
+            drop_last=True,
+            pin_memory=True,
+            persistent_workers=self._train_config.validation.num_data_workers > 0,
+        )
+
+
+def prepare_latent_datamodule(datamodule, vae, algo_config, train_config, device="cpu"):
+    """Latent cache datamodule of @datamodule's datasets, encoding the ones that are not cached with the frozen @vae."""
+    data_cfg = datamodule._data_config
+    cache_dirs = []
+    for dataset, desired_data in ((datamodule.train_dataset, data_cfg.trajdata_source_train),
+                                  (datamodule.valid_dataset, data_cfg.trajdata_source_valid)):
+        cache_dir = LatentCache.get_cache_dir(data_cfg, desired_data, train_config.checkpoint_vae, algo_config)
+        cache = LatentCache(cache_dir)
+        if not cache.exists():
+            cache.build(vae, dataset, batch_size=train_config.training.batch_size,
+                        num_workers=train_config.training.num_data_workers, device=device)
+        cache_dirs.append(cache_dir)
+    return LatentCacheDataModule(cache_dirs[0], cache_dirs[1], train_config)
@@ -0,0 +1,183 @@
+import os,json,hashlib
+from pathlib import Path
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from tbsim.utils.batch_utils import batch_utils
+from tbsim.models.diffuser_helpers import convert_state_to_state_and_action, NORM_STATS_VERSION
+
+
+class RunningMoments(object):
+    '''
+    Per-dimension count / mean / sum of squared deviations, accumulated in float64.
+    Batches are folded in with Welford's update and partial results are combined with
+    Chan's parallel merge, so workers can each reduce their own batches.
+    '''
+    def __init__(self, dim):
+        self.count = np.zeros(dim, dtype=np.float64)
+        self.mean = np.zeros(dim, dtype=np.float64)
+        self.m2 = np.zeros(dim, dtype=np.float64)
+
+    def update(self, x, mask=None):
+        '''
+        - x : (N, D) samples
+        - mask : (N,) or (N, D) bool, samples to include
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        if mask is None:
+            mask = np.ones(x.shape, dtype=bool)
+        else:
+            mask = np.broadcast_to(np.asarray(mask, dtype=bool).reshape(x.shape[0], -1), x.shape)
+        mask = mask & np.isfinite(x)
+        count = mask.sum(axis=0).astype(np.float64)
+        safe = np.maximum(count, 1.0)
+        x = np.where(mask, x, 0.0)
+        mean = x.sum(axis=0) / safe
+        m2 = (np.where(mask, x - mean, 0.0) ** 2).sum(axis=0)
+        self._merge(count, mean, m2)
+        return self
+
+    def merge(self, other):
+        self._merge(other.count, other.mean, other.m2)
+        return self
+
+    def _merge(self, count, mean, m2):
+        total = self.count + count
+        safe = np.maximum(total, 1.0)
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / safe
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / safe
+        self.count = total
+
+    @property
+    def var(self):
+        return self.m2 / np.maximum(self.count, 1.0)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+def _flatten(x):
+    return x.reshape(-1, x.shape[-1])
+
+def _hist_features(pos, speed, extent, avail):
+    '''[x,y,vel,len,width] rows of each available history step, the input order of prepare_hist_in'''
+    lw = extent[..., :2].unsqueeze(-2).expand(pos.shape[:-1] + (2,))
+    feats = torch.cat([pos, speed.unsqueeze(-1), lw], dim=-1)
+    return _flatten(feats), avail.reshape(-1)
+
+def batch_moments(batch, horizon, dt):
+    '''
+    Moments of every normalization group in a parsed batch
+    - diffuser : state and action [x,y,vel,yaw,acc,yawvel] of the first @horizon future steps
+    - agent_hist : [x,y,vel,len,width] of the agent history
+    - neighbor_hist : [x,y,vel,len,width] of the neighbor histories
+    '''
+    moments = dict()
+    traj_state = torch.cat((batch["target_positions"][:, :horizon], batch["target_yaws"][:, :horizon]), dim=2)
+    traj = convert_state_to_state_and_action(traj_state, batch["curr_speed"], dt)
+    avail = batch["target_availabilities"][:, :horizon]
+    moments["diffuser"] = RunningMoments(traj.shape[-1]).update(_flatten(traj).numpy(), avail.reshape(-1).numpy())
+
+    feats, avail = _hist_features(batch["history_positions"], batch["history_speeds"],
+                                  batch["extent"], batch["history_availabilities"])
+    moments["agent_hist"] = RunningMoments(feats.shape[-1]).update(feats.numpy(), avail.numpy())
+
+    if "all_other_agents_history_positions" in batch:
+        feats, avail = _hist_features(batch["all_other_agents_history_positions"],
+                                      batch["all_other_agents_history_speeds"],
+                                      batch["all_other_agents_extents"],
+                                      batch["all_other_agents_history_availabilities"])
+        moments["neighbor_hist"] = RunningMoments(feats.shape[-1]).update(feats.numpy(), avail.numpy())
+    return moments
+
+
+class _MomentsCollate(object):
+    '''Collates, parses and reduces a batch inside the data loader worker, only the moments go back to the main process'''
+    def __init__(self, collate_fn, horizon, dt):
+        self.collate_fn = collate_fn
+        self.horizon = horizon
+        self.dt = dt
+
+    def __call__(self, elements):
+        batch = batch_utils().parse_batch(self.collate_fn(elements))
+        with torch.no_grad():
+            return batch_moments(batch, self.horizon, self.dt)
+
+
+def get_samples_desc(data_config):
+    """The data config fields that change the samples of a dataset, other than its data sources."""
+    return dict(
+        desired_dt=data_config.step_time,
+        history_num_frames=data_config.history_num_frames,
+        future_num_frames=data_config.future_num_frames,
+        centric=data_config.trajdata_centric,
+        only_types=sorted(data_config.trajdata_only_types),
+        predict_types=None if data_config.trajdata_predict_types is None else sorted(data_config.trajdata_predict_types),
+        other_agents_num=data_config.other_agents_num,
+        max_agents_distance=data_config.max_agents_distance,
+        standardize_data=data_config.trajdata_standardize_data,
+        scene_desc_contains=data_config.trajdata_scene_desc_contains,
+    )
+
+def get_stats_path(cache_location, data_config, horizon):
+    """Stats file of a dataset, unique to its data sources and to the config fields that change the statistics."""
+    desc = get_samples_desc(data_config)
+    desc.update(desired_data=sorted(data_config.trajdata_source_train), horizon=horizon)
+    key = hashlib.md5(json.dumps(desc, sort_keys=True).encode()).hexdigest()[:16]
+    return Path(cache_location).expanduser() / "norm_stats" / (key + ".json"), key, desc
+
+def compute_norm_stats(dataset, horizon, dt, batch_size=128, num_workers=0):
+    """Moments of every normalization group over one pass of @dataset."""
+    extras, incl_raster_map = dataset.extras, dataset.incl_raster_map
+    dataset.extras = {}
+    dataset.incl_raster_map = False
+    try:
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False,
+                            collate_fn=_MomentsCollate(dataset.get_collate_fn(return_dict=True), horizon, dt))
+        moments = dict()
+        for parts in tqdm(loader, desc="computing norm stats"):
+            for group, m in parts.items():
+                if group in moments:
+                    moments[group].merge(m)
+                else:
+                    moments[group] = m
+    finally:
+        dataset.extras, dataset.incl_raster_map = extras, incl_raster_map
+    return moments
+
+def write_norm_stats(stats_path, moments, key, desc, eps=1e-6):
+    """Write the stats file read by load_norm_stats. Dimensions without spread keep a div coeff of 1."""
+    norm_info = dict()
+    for group, m in moments.items():
+        std = np.where(m.std > eps, m.std, 1.0)
+        norm_info[group] = [(-m.mean).tolist(), std.tolist()]
+    stats = {
+        "version": NORM_STATS_VERSION,
+        "key": key,
+        "config": desc,
+        "count": {group: m.count.tolist() for group, m in moments.items()},
+        "mean": {group: m.mean.tolist() for group, m in moments.items()},
+        "std": {group: m.std.tolist() for group, m in moments.items()},
+        "norm_info": norm_info,
+    }
+    stats_path = Path(stats_path)
+    stats_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = stats_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(stats, f, indent=2)
+    os.replace(tmp_path, stats_path)
+    return stats_path
+
+def get_or_compute_norm_stats(datamodule, horizon, rebuild=False):
+    """Path of the stats file of the datamodule's training set, computing it first if it is not cached."""
+    data_cfg = datamodule._data_config
+    stats_path, key, desc = get_stats_path(data_cfg.trajdata_cache_location, data_cfg, horizon)
+    if stats_path.exists() and not rebuild:
+        return stats_path
+    moments = compute_norm_stats(datamodule.train_dataset, horizon, data_cfg.step_time,
+                                 batch_size=datamodule._train_config.training.batch_size,
+                                 num_workers=datamodule._train_config.training.num_data_workers)
+    return write_norm_stats(stats_path, moments, key, desc)
@@ -1,7 +1,8 @@
 from tbsim.utils.config_utils import translate_pass_trajdata_cfg
 from tbsim.datasets.trajdata_datamodules import PassUnifiedDataModule
+from tbsim.datasets.prefetch import PrefetchStatsCallback
 from datetime import  datetime
-import os,json,wandb
+import os,json,wandb,torch
 import pytorch_lightning as pl
 from pytorch_lightning.loggers import WandbLogger
 from configs.custom_config import serialize_object
@@ -9,6 +10,7 @@ from trainers.vae_trainer import VAELightningModule
 from trainers.dm_trainer import DMLightningModule
 from trainers.guide_dm_trainer import GuideDMLightningModule
 from configs.visualize_traj import TrajectoryVisualizationCallback
+from utils.latent_cache import prepare_latent_datamodule
 def prepare_trainer_and_data(cfg, train_mode,debug=False):
     trajdata_config = translate_pass_trajdata_cfg(cfg)
     datamodule = PassUnifiedDataModule(trajdata_config, cfg.train)
@@ -29,6 +31,12 @@ def prepare_trainer_and_data(cfg, train_mode,debug=False):
             modality_shapes=datamodule.modality_shapes,
             vae_model_path = checkpoint_vae,
                            )
+        if cfg.train.get("dm_latent_cache", False):
+            # the VAE is frozen: encode the datasets once and train the DM on the cached rows
+            assert checkpoint_vae is not None, "dm_latent_cache needs train.checkpoint_vae"
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            vae = model.ema_vae if model.use_ema else model.vae
+            datamodule = prepare_latent_datamodule(datamodule, vae.to(device), cfg.algo, cfg.train, device=device)
     else:
          raise ValueError(f"Unknown train mode: {train_mode}")
     
@@ -90,6 +98,9 @@ def prepare_trainer_and_data(cfg, train_mode,debug=False):
         vis_callback = TrajectoryVisualizationCallback(cfg, media_dir)
         train_callbacks.append(vis_callback)
 
+    if cfg.train.get("prefetch_to_device", False) and hasattr(datamodule, "train_prefetch_stats"):
+        train_callbacks.append(PrefetchStatsCallback(datamodule.train_prefetch_stats, cfg.train.logging.log_every_n_steps))
+
     trainer = pl.Trainer(
     
     default_root_dir=checkpoint_dir,
@@ -185,6 +196,9 @@ def prepare_for_guided_dm(cfg,debug=False):
         vis_callback = TrajectoryVisualizationCallback(cfg, media_dir)
         train_callbacks.append(vis_callback)
 
+    if cfg.train.get("prefetch_to_device", False) and hasattr(datamodule, "train_prefetch_stats"):
+        train_callbacks.append(PrefetchStatsCallback(datamodule.train_prefetch_stats, cfg.train.logging.log_every_n_steps))
+
     trainer = pl.Trainer(
     
     default_root_dir=checkpoint_dir,